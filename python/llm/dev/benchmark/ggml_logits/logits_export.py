@@ -0,0 +1,88 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the per-token overhead of exporting logits from the llama.cpp context in
+# `ipex_llm.ggml.model.llama.Llama.eval`, before (per-element ctypes copies into a deque
+# of lists) and after (a zero-copy NumPy view copied into a `LogitsRing`).
+# The llama.cpp logits buffer is simulated by a ctypes float array, so no model is needed.
+
+import argparse
+import ctypes
+import math
+import time
+from collections import deque
+
+import numpy
+
+
+def export_list(logits_view, rows, cols, eval_logits):
+    logits = [[logits_view[i * cols + j] for j in range(cols)] for i in range(rows)]
+    eval_logits.extend(logits)
+
+
+def logits_to_logprobs_list(logits):
+    exps = [math.exp(float(x)) for x in logits]
+    sum_exps = sum(exps)
+    return [math.log(x / sum_exps) for x in exps]
+
+
+def export_numpy(logits_view, rows, cols, eval_logits):
+    eval_logits.extend(numpy.ctypeslib.as_array(logits_view, shape=(rows, cols)))
+
+
+def bench(fn, n_iter):
+    fn()
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        fn()
+    return (time.perf_counter() - start) / n_iter * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark logits export of ggml Llama.eval')
+    parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[32000, 152064],
+                        help='vocabulary sizes to benchmark')
+    parser.add_argument('--n-ctx', type=int, default=512,
+                        help='context size, which is the ring size with `logits_all`')
+    parser.add_argument('--n-iter', type=int, default=20,
+                        help='number of measured tokens')
+    parser.add_argument('--logprobs', action='store_true',
+                        help='also measure `logits_to_logprobs` of each token')
+    args = parser.parse_args()
+
+    from ipex_llm.ggml.model.llama.llama import Llama, LogitsRing
+
+    print(f"{'vocab':>8} {'list(ms)':>10} {'numpy(ms)':>10} {'speedup':>8}")
+    for cols in args.vocab_sizes:
+        buffer = (ctypes.c_float * cols)(*numpy.random.randn(cols).astype(numpy.float32))
+        logits_view = ctypes.cast(buffer, ctypes.POINTER(ctypes.c_float))
+
+        eval_logits_list = deque(maxlen=args.n_ctx)
+        eval_logits_ring = LogitsRing(maxlen=args.n_ctx)
+
+        def step_list():
+            export_list(logits_view, 1, cols, eval_logits_list)
+            if args.logprobs:
+                logits_to_logprobs_list(eval_logits_list[-1])
+
+        def step_numpy():
+            export_numpy(logits_view, 1, cols, eval_logits_ring)
+            if args.logprobs:
+                Llama.logits_to_logprobs(eval_logits_ring[-1])
+
+        list_ms = bench(step_list, args.n_iter)
+        numpy_ms = bench(step_numpy, args.n_iter)
+        print(f"{cols:>8} {list_ms:>10.3f} {numpy_ms:>10.3f} {list_ms / numpy_ms:>7.1f}x")
@@ -0,0 +1,113 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the throughput of `convert_gptq2ggml` on a synthetic random GPTQ llama
+# checkpoint, so that no model needs to be downloaded. The checkpoint has 32 layers
+# (the converter infers the number of heads from the number of layers) and a small
+# sentencepiece tokenizer trained on random words.
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import string
+import tempfile
+import time
+import torch
+
+
+def make_tokenizer(model_dir, vocab_size):
+    import sentencepiece as spm
+
+    rng = random.Random(0)
+    text_file = os.path.join(model_dir, "text.txt")
+    with open(text_file, "w") as f:
+        for _ in range(2000):
+            f.write(" ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 8)))
+                             for _ in range(16)) + "\n")
+    spm.SentencePieceTrainer.train(input=text_file,
+                                   model_prefix=os.path.join(model_dir, "tokenizer"),
+                                   vocab_size=vocab_size, minloglevel=2)
+    os.remove(text_file)
+
+
+def make_gptq_checkpoint(model_dir, hidden_size, intermediate_size, vocab_size, group_size):
+    from safetensors.torch import save_file
+
+    def linear(prefix, in_features, out_features):
+        groups = in_features // group_size
+        tensors[f"{prefix}.qweight"] = torch.randint(-2 ** 31, 2 ** 31 - 1,
+                                                     (in_features // 8, out_features),
+                                                     dtype=torch.int32)
+        tensors[f"{prefix}.qzeros"] = torch.randint(-2 ** 31, 2 ** 31 - 1,
+                                                    (groups, out_features // 8),
+                                                    dtype=torch.int32)
+        tensors[f"{prefix}.scales"] = torch.rand(groups, out_features).half() / 100
+        tensors[f"{prefix}.g_idx"] = torch.arange(in_features, dtype=torch.int32) // group_size
+
+    tensors = {
+        "model.embed_tokens.weight": torch.randn(vocab_size, hidden_size).half(),
+        "model.norm.weight": torch.ones(hidden_size).half(),
+        "lm_head.weight": torch.randn(vocab_size, hidden_size).half(),
+    }
+    for i in range(32):
+        prefix = f"model.layers.{i}"
+        for name in ["q_proj", "k_proj", "v_proj", "o_proj"]:
+            linear(f"{prefix}.self_attn.{name}", hidden_size, hidden_size)
+        linear(f"{prefix}.mlp.gate_proj", hidden_size, intermediate_size)
+        linear(f"{prefix}.mlp.up_proj", hidden_size, intermediate_size)
+        linear(f"{prefix}.mlp.down_proj", intermediate_size, hidden_size)
+        tensors[f"{prefix}.input_layernorm.weight"] = torch.ones(hidden_size).half()
+        tensors[f"{prefix}.post_attention_layernorm.weight"] = torch.ones(hidden_size).half()
+    save_file(tensors, os.path.join(model_dir, "model.safetensors"))
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark GPTQ to ggml conversion')
+    parser.add_argument('--hidden-size', type=int, default=2048,
+                        help='hidden size of the synthetic model')
+    parser.add_argument('--intermediate-size', type=int, default=5632,
+                        help='intermediate size of the synthetic model')
+    parser.add_argument('--vocab-size', type=int, default=32000,
+                        help='vocab size of the synthetic model')
+    parser.add_argument('--group-size', type=int, default=128,
+                        help='GPTQ group size')
+    parser.add_argument('--workers', type=str, default=f"1,{os.cpu_count()}",
+                        help='comma separated numbers of conversion workers to compare')
+    args = parser.parse_args()
+
+    from ipex_llm.gptq.convert.convert_gptq_to_ggml import convert_gptq2ggml
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        checkpoint_bytes = make_gptq_checkpoint(model_dir, args.hidden_size,
+                                                args.intermediate_size, args.vocab_size,
+                                                args.group_size)
+        make_tokenizer(model_dir, min(args.vocab_size, 1000))
+        output_path = os.path.join(model_dir, "ggml.bin")
+
+        print(f"checkpoint: {checkpoint_bytes / 1024 ** 3:.2f} GB")
+        print(f"{'workers':>8} {'time(s)':>10} {'MB/s':>10}")
+        for workers in [int(workers) for workers in args.workers.split(",")]:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                convert_gptq2ggml(model_dir, output_path,
+                                  tokenizer_path=os.path.join(model_dir, "tokenizer.model"),
+                                  concurrency=workers)
+            elapsed = time.perf_counter() - start
+            print(f"{workers:>8} {elapsed:>10.2f} "
+                  f"{checkpoint_bytes / 1024 ** 2 / elapsed:>10.1f}")
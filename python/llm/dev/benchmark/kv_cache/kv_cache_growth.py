@@ -0,0 +1,85 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare the KV cache growth policy of `DynamicNormalCache` with `GeometricKVCache` on CPU.
+# Each run is executed in a fresh process so that its peak RSS is measured independently.
+
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+
+
+def run_policy(policy, context_len, prompt_len, num_layers, num_heads, head_dim, dtype):
+    from ipex_llm.transformers.kv import DynamicNormalCache, GeometricKVCache
+
+    dtype = getattr(torch, dtype)
+    cache = DynamicNormalCache() if policy == "normal" else GeometricKVCache()
+    copy_bytes = 0
+
+    start = time.perf_counter()
+    cur_len = 0
+    while cur_len < context_len:
+        seq_len = prompt_len if cur_len == 0 else 1
+        key_states = torch.randn(1, num_heads, seq_len, head_dim).to(dtype)
+        value_states = torch.randn(1, num_heads, seq_len, head_dim).to(dtype)
+        for layer_idx in range(num_layers):
+            if layer_idx < len(cache.key_cache):
+                k_cache = cache.key_cache[layer_idx]
+                if k_cache.stride(1) < (k_cache.size(2) + seq_len) * k_cache.size(3):
+                    # `update` will re-allocate and copy both k and v
+                    copy_bytes += 2 * k_cache.numel() * k_cache.element_size()
+            cache.update(key_states, value_states, layer_idx)
+        cur_len += seq_len
+    elapsed = time.perf_counter() - start
+    # allocated buffers, including the free room not used yet
+    alloc_bytes = sum(cache.untyped_storage().nbytes()
+                      for cache in cache.key_cache + cache.value_cache)
+
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return elapsed, copy_bytes, alloc_bytes, peak_rss
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark KV cache growth policies on CPU')
+    parser.add_argument('--context-lens', type=int, nargs='+', default=[8192, 20544, 22528, 32768],
+                        help='Total context length to grow each cache to')
+    parser.add_argument('--prompt-len', type=int, default=512,
+                        help='Number of tokens appended by the first (prefill) update')
+    parser.add_argument('--num-layers', type=int, default=4)
+    parser.add_argument('--num-heads', type=int, default=8,
+                        help='Number of key/value heads')
+    parser.add_argument('--head-dim', type=int, default=128)
+    parser.add_argument('--dtype', type=str, default='bfloat16')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'policy':>10} {'context':>8} {'time(s)':>9} {'copy(MB)':>10} {'alloc(MB)':>10} "
+          f"{'peak RSS(MB)':>13}")
+    for context_len in args.context_lens:
+        for policy in ["normal", "geometric"]:
+            with ctx.Pool(1) as pool:
+                elapsed, copy_bytes, alloc_bytes, peak_rss = pool.apply(
+                    run_policy,
+                    (policy, context_len, args.prompt_len, args.num_layers,
+                     args.num_heads, args.head_dim, args.dtype)
+                )
+            print(f"{policy:>10} {context_len:>8} {elapsed:>9.2f} "
+                  f"{copy_bytes / 1024 ** 2:>10.1f} {alloc_bytes / 1024 ** 2:>10.1f} "
+                  f"{peak_rss:>13.1f}")
@@ -0,0 +1,105 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare `load_low_bit` of the same low-bit model saved as pickled `.bin` shards
+# (`save_low_bit(path)`) and as safetensors shards (`save_low_bit(path, safe_serialization=True)`),
+# whose packed weights are mmap-ed instead of deserialized, and the safetensors shards loaded
+# with `lazy_load=True`, whose decoder layers are materialized on the first forward.
+# Each load runs in a fresh process, so that the load time and peak RSS are its own, and the
+# page cache is warmed up by one untimed load first.
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+import torch
+
+
+def load(model_path, lazy_load, prefetch_layers):
+    from ipex_llm.transformers import AutoModelForCausalLM
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.load_low_bit(model_path, trust_remote_code=True,
+                                              lazy_load=lazy_load,
+                                              lazy_prefetch_layers=prefetch_layers)
+    load_time = time.perf_counter() - start
+    with torch.inference_mode():
+        model(torch.ones(1, 32, dtype=torch.long))
+    first_forward_time = time.perf_counter() - start - load_time
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    print(f"{load_time:.2f} {first_forward_time:.2f} {peak_rss:.2f}")
+
+
+def save(model_path, low_bit, save_dir):
+    from ipex_llm.transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit=low_bit,
+                                                 trust_remote_code=True)
+    model.save_low_bit(os.path.join(save_dir, "pickle"))
+    model.save_low_bit(os.path.join(save_dir, "safetensors"), safe_serialization=True)
+
+
+def run(*extra_args):
+    output = subprocess.run([sys.executable, __file__, *extra_args],
+                            check=True, capture_output=True, text=True).stdout
+    return output.strip().splitlines()[-1].split() if output.strip() else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark load_low_bit of pickle and '
+                                                 'safetensors low-bit checkpoints')
+    parser.add_argument('--repo-id-or-model-path', type=str, required=True,
+                        help='the huggingface repo id or path of the full precision model')
+    parser.add_argument('--low-bit', type=str, default='sym_int4',
+                        help='the low-bit format to save the model in')
+    parser.add_argument('--save-dir', type=str, required=True,
+                        help='directory to save both low-bit checkpoints in')
+    parser.add_argument('--n-iter', type=int, default=3,
+                        help='number of timed loads of each format')
+    parser.add_argument('--prefetch-layers', type=int, default=2,
+                        help='number of decoder layers to prefetch with lazy_load')
+    parser.add_argument('--load', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--lazy-load', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--save', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load is not None:
+        load(args.load, args.lazy_load, args.prefetch_layers)
+        sys.exit(0)
+    if args.save:
+        save(args.repo_id_or_model_path, args.low_bit, args.save_dir)
+        sys.exit(0)
+
+    run('--repo-id-or-model-path', args.repo_id_or_model_path,
+        '--low-bit', args.low_bit, '--save-dir', args.save_dir, '--save')
+
+    print(f"{'format':>18} {'load(s)':>10} {'first forward(s)':>17} {'peak RSS(GB)':>13}")
+    for fmt, lazy_load in [('pickle', False), ('safetensors', False), ('safetensors', True)]:
+        load_args = ['--repo-id-or-model-path', args.repo_id_or_model_path,
+                     '--save-dir', args.save_dir, '--load', os.path.join(args.save_dir, fmt),
+                     '--prefetch-layers', str(args.prefetch_layers)]
+        if lazy_load:
+            load_args.append('--lazy-load')
+        run(*load_args)
+        results = [run(*load_args) for _ in range(args.n_iter)]
+        load_time = sum(float(r[0]) for r in results) / len(results)
+        first_forward_time = sum(float(r[1]) for r in results) / len(results)
+        peak_rss = max(float(r[2]) for r in results)
+        name = fmt + ' (lazy)' if lazy_load else fmt
+        print(f"{name:>18} {load_time:>10.2f} {first_forward_time:>17.2f} {peak_rss:>13.2f}")
@@ -0,0 +1,64 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare load time and peak host memory of `from_pretrained(load_in_low_bit=...)` with the
+# default path (materialize the full precision model, then convert it) and with
+# `streaming_load=True` (quantize each linear as soon as its weight is read from the
+# safetensors shards). Each mode runs in a fresh process, so that the peak RSS is its own.
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+
+def load(model_path, low_bit, streaming_load):
+    from ipex_llm.transformers import AutoModelForCausalLM
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit=low_bit,
+                                                 streaming_load=streaming_load,
+                                                 trust_remote_code=True,
+                                                 use_cache=True)
+    load_time = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    print(f"{load_time:.2f} {peak_rss:.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark streaming low-bit model loading')
+    parser.add_argument('--repo-id-or-model-path', type=str, required=True,
+                        help='path to a local safetensors checkpoint')
+    parser.add_argument('--low-bit', type=str, default='sym_int4',
+                        help='the low-bit format to load the model in')
+    parser.add_argument('--mode', type=str, choices=['default', 'streaming'], default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        load(args.repo_id_or_model_path, args.low_bit, args.mode == 'streaming')
+        sys.exit(0)
+
+    print(f"{'mode':>10} {'load(s)':>10} {'peak RSS(GB)':>13}")
+    for mode in ['default', 'streaming']:
+        output = subprocess.run([sys.executable, __file__,
+                                 '--repo-id-or-model-path', args.repo_id_or_model_path,
+                                 '--low-bit', args.low_bit, '--mode', mode],
+                                check=True, capture_output=True, text=True).stdout
+        load_time, peak_rss = output.strip().splitlines()[-1].split()
+        print(f"{mode:>10} {float(load_time):>10.2f} {float(peak_rss):>13.2f}")
@@ -0,0 +1,161 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the latency that `ipex_llm.serving.fastchat.tgi_api_server` adds to each request,
+# with a stand-in controller and stand-in workers which answer immediately, so that no
+# model is needed. The latency of `/generate` through the gateway is compared with a
+# direct `/worker_generate` call to a worker.
+
+import argparse
+import asyncio
+import time
+import aiohttp
+import uvicorn
+from fastapi import FastAPI
+
+MODEL_NAME = "stand-in-model"
+
+
+def create_controller(worker_addresses):
+    controller = FastAPI()
+    next_worker = [0]
+
+    @controller.post("/list_models")
+    async def list_models():
+        return {"models": [MODEL_NAME]}
+
+    @controller.post("/refresh_all_workers")
+    async def refresh_all_workers():
+        return {}
+
+    @controller.post("/get_worker_address")
+    async def get_worker_address():
+        next_worker[0] += 1
+        return {"address": worker_addresses[next_worker[0] % len(worker_addresses)]}
+
+    return controller
+
+
+def create_worker(latency):
+    worker = FastAPI()
+
+    @worker.post("/worker_get_status")
+    async def worker_get_status():
+        return {"model_names": [MODEL_NAME], "speed": 1, "queue_length": 0}
+
+    @worker.post("/worker_get_conv_template")
+    async def worker_get_conv_template():
+        return {"conv": {"name": "raw", "system_template": "{system_message}",
+                         "system_message": "", "roles": ["user", "assistant"],
+                         "messages": [], "offset": 0, "sep_style": 1, "sep": "\n",
+                         "sep2": None, "stop_str": None, "stop_token_ids": None}}
+
+    @worker.post("/model_details")
+    async def model_details():
+        return {"context_length": 4096}
+
+    @worker.post("/count_token")
+    async def count_token():
+        return {"count": 8, "error_code": 0}
+
+    @worker.post("/worker_generate")
+    async def worker_generate():
+        await asyncio.sleep(latency)
+        return {"text": "stand-in output", "error_code": 0, "finish_reason": "stop",
+                "usage": {"prompt_tokens": 8, "completion_tokens": 3, "total_tokens": 11}}
+
+    return worker
+
+
+def percentile(latencies, q):
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000
+
+
+async def run(url, payload, num_requests, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as session:
+        async def one():
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, json=payload) as response:
+                    await response.read()
+                    assert response.status == 200, await response.text()
+                latencies.append(time.perf_counter() - start)
+        # warm up the connections
+        await asyncio.gather(*[one() for _ in range(4 * concurrency)])
+        latencies.clear()
+        await asyncio.gather(*[one() for _ in range(num_requests)])
+    return latencies
+
+
+async def main(args):
+    from ipex_llm.serving.fastchat import tgi_api_server
+
+    worker_addresses = [f"http://127.0.0.1:{args.base_port + 2 + i}"
+                        for i in range(args.num_workers)]
+    apps = [(create_controller(worker_addresses), args.base_port),
+            (tgi_api_server.app, args.base_port + 1)]
+    apps += [(create_worker(args.worker_latency_ms / 1000), args.base_port + 2 + i)
+             for i in range(args.num_workers)]
+    tgi_api_server.app_settings.controller_address = f"http://127.0.0.1:{args.base_port}"
+    tgi_api_server.app_settings.worker_dispatch_method = args.dispatch_method
+
+    servers = [uvicorn.Server(uvicorn.Config(app=app, host="127.0.0.1", port=port,
+                                             log_level="error"))
+               for app, port in apps]
+    tasks = [asyncio.create_task(server.serve()) for server in servers]
+    while not all(server.started for server in servers):
+        await asyncio.sleep(0.1)
+
+    direct = await run(worker_addresses[0] + "/worker_generate",
+                       {"model": MODEL_NAME, "prompt": "hi"},
+                       args.num_requests, args.concurrency)
+    gateway = await run(f"http://127.0.0.1:{args.base_port + 1}/generate",
+                        {"inputs": "hi", "parameters": {"max_new_tokens": 16}},
+                        args.num_requests, args.concurrency)
+
+    print(f"{'':>10} {'p50(ms)':>10} {'p99(ms)':>10}")
+    for name, latencies in [("direct", direct), ("gateway", gateway)]:
+        print(f"{name:>10} {percentile(latencies, 0.5):>10.2f} "
+              f"{percentile(latencies, 0.99):>10.2f}")
+    print(f"{'added':>10} {percentile(gateway, 0.5) - percentile(direct, 0.5):>10.2f} "
+          f"{percentile(gateway, 0.99) - percentile(direct, 0.99):>10.2f}")
+
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the latency added by the '
+                                                 'TGI style API server')
+    parser.add_argument('--num-requests', type=int, default=500,
+                        help='number of timed requests')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of concurrent requests')
+    parser.add_argument('--num-workers', type=int, default=2,
+                        help='number of stand-in workers')
+    parser.add_argument('--worker-latency-ms', type=float, default=0,
+                        help='latency of each stand-in generation')
+    parser.add_argument('--dispatch-method', type=str, default='shortest_queue',
+                        choices=['shortest_queue', 'round_robin'],
+                        help='how the gateway chooses among the workers')
+    parser.add_argument('--base-port', type=int, default=21100,
+                        help='port of the stand-in controller, the gateway and the '
+                             'workers use the following ports')
+    asyncio.run(main(parser.parse_args()))
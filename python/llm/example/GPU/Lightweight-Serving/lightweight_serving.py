@@ -34,6 +34,17 @@ async def main():
                         help='The quantization type the model will convert to.')
     parser.add_argument('--port', type=int, default=8000,
                         help='The port number on which the server will run.')
+    parser.add_argument('--max-num-seqs', type=int, default=1,
+                        help='Max number of requests decoded together by continuous batching.')
+    parser.add_argument('--max-num-batched-tokens', type=int, default=None,
+                        help='Max sum of prompt and new tokens of requests in the running batch.')
+    parser.add_argument('--max-queue-size', type=int, default=None,
+                        help='Max number of waiting requests, more requests are rejected with 429.')
+    parser.add_argument('--max-running-requests', type=int, default=None,
+                        help='Max number of requests started together, default to be max-num-seqs '
+                             'when it is larger than 1, otherwise no limit.')
+    parser.add_argument('--request-timeout', type=float, default=None,
+                        help='Seconds to finish in of requests which do not set a timeout.')
     
     args = parser.parse_args()
     model_path = args.repo_id_or_model_path
@@ -41,7 +52,11 @@ async def main():
 
     processor = None
     if "whisper" not in model_path.lower():
-        local_model = ModelWorker(model_path, low_bit)
+        local_model = ModelWorker(model_path, low_bit, max_num_seqs=args.max_num_seqs,
+                                  max_num_batched_tokens=args.max_num_batched_tokens,
+                                  max_queue_size=args.max_queue_size,
+                                  max_running_requests=args.max_running_requests,
+                                  request_timeout=args.request_timeout)
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, padding_side='left')
         if tokenizer.pad_token is None:
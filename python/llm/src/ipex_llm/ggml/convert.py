@@ -64,6 +64,24 @@ def _convert_llama(model_path, outfile_dir, outtype):
     OutputFile.write_all(outfile_path, params, output_type, model, vocab)
 
 
+def _convert_llama_to_quantized(model_path, outfile_path, dtype):
+    """
+    Convert a Hugging Face llama-like checkpoint into a ggml file quantized to `dtype`,
+    without writing the intermediate f16 ggml file.
+    """
+    from ipex_llm.ggml.quantize import write_quantized_llama
+    model_path = Path(model_path)
+    model_plus = load_some_model(model_path)
+    if model_plus.vocab is not None:
+        vocab = model_plus.vocab
+    else:
+        vocab_dir = model_plus.paths[0].parent
+        vocab = load_vocab(vocab_dir, vocabtype='spm')
+    params = Params.load(model_plus)
+    model = do_necessary_conversions(model_plus.model, params)
+    write_quantized_llama(outfile_path, params, model, vocab, dtype)
+
+
 def _convert_gptneox(model_path, outfile_dir, outtype):
     _convert_gptneox_hf_to_ggml(model_path, outfile_dir, outtype)
 
@@ -16,7 +16,7 @@
 import os
 import time
 from pathlib import Path
-from ipex_llm.ggml.convert import _convert_to_ggml
+from ipex_llm.ggml.convert import _convert_to_ggml, _convert_llama_to_quantized
 from ipex_llm.ggml.quantize import quantize
 from ipex_llm.utils.common import invalidInputError
 import argparse
@@ -45,7 +45,8 @@ def convert_model(input_path: str,
             Now only `int4` and `int8` are supported, and `int8` only works for `llama`
             and `gptneox`.
     :param tmp_path: Which path to store the intermediate model during the conversion process.
-            Default to `None` so that intermediate model will not be saved.
+            Default to `None` so that intermediate model will not be saved. `llama` models
+            are then quantized directly without an intermediate model.
 
     :return: the path string to the converted lower precision checkpoint.
     """
@@ -78,7 +79,13 @@ def convert_model(input_path: str,
                           family('llama', 'gptneox', 'starcoder')",
                           "{} is not in the list.".format(model_family))
 
-    if tmp_path is not None:
+    if tmp_path is None and model_family == 'llama':
+        output_file_path = os.path.join(output_path, f"bigdl_llm_{model_family}_{dtype}.bin")
+        _convert_llama_to_quantized(model_path=input_path,
+                                    outfile_path=output_file_path,
+                                    dtype=dtype)
+        return output_file_path
+    elif tmp_path is not None:
         model_name = Path(input_path).stem
         tmp_ggml_file_path = os.path.join(tmp_path, f'{model_name}_{int(time.time())}')
         _convert_to_ggml(model_path=input_path,
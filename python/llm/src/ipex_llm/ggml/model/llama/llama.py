@@ -50,9 +50,9 @@ import os
 import sys
 import uuid
 import time
-import math
 import multiprocessing
-from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
+import numpy
+from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple, Dict
 from collections import deque, OrderedDict
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.model.generation import GenerationMixin
@@ -60,57 +60,302 @@ from . import llama_cpp
 from .llama_types import *
 
 
+def _common_prefix_len(a: Sequence[int], b: Sequence[int], start: int) -> int:
+    n = min(len(a), len(b) - start)
+    i = 0
+    while i < n and a[i] == b[start + i]:
+        i += 1
+    return i
+
+
+class _LlamaCacheNode:
+    __slots__ = ("edge", "parent", "children", "state")
+
+    def __init__(self, edge: Tuple[int, ...]=(), parent: Optional["_LlamaCacheNode"] = None):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[int, _LlamaCacheNode] = {}
+        # `LlamaState` or `_SpilledLlamaState` of the key ending at this node
+        self.state = None
+
+
+class _SpilledLlamaState:
+    """A `LlamaState` whose llama state data and logits are in a file of the spill dir."""
+
+    def __init__(self, path: str, state: "LlamaState"):
+        self.path = path
+        self.eval_tokens = state.eval_tokens
+        self.logits_maxlen = state.eval_logits.maxlen
+        logits = state.eval_logits.to_numpy()
+        self.logits_shape = logits.shape
+        self.llama_state_size = state.llama_state_size
+        with open(path, "wb") as f:
+            f.write(state.llama_state)
+            f.write(logits.tobytes())
+
+    def load(self) -> "LlamaState":
+        with open(self.path, "rb") as f:
+            llama_state = (llama_cpp.c_uint8 * self.llama_state_size)()
+            f.readinto(llama_state)
+            logits = numpy.fromfile(f, dtype=numpy.float32,
+                                    count=int(numpy.prod(self.logits_shape)))
+        eval_logits = LogitsRing(self.logits_maxlen)
+        eval_logits.extend(logits.reshape(self.logits_shape))
+        return LlamaState(
+            eval_tokens=self.eval_tokens.copy(),
+            eval_logits=eval_logits,
+            llama_state=llama_state,
+            llama_state_size=self.llama_state_size,
+        )
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
 class LlamaCache:
-    """Cache for a llama.cpp model."""
+    """Cache for a llama.cpp model.
+
+    States are indexed by their tokens in a radix tree, so looking up the state sharing the
+    longest prefix with a prompt costs O(prompt length) regardless of the number of states.
+    States are evicted in LRU order once their total size exceeds `capacity_bytes`.
+
+    If `spill_dir` is given, evicted states are written to files in this directory instead
+    of being dropped, up to `spill_capacity_bytes`, and are read back into memory on a hit.
+    """
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
-        self.cache_state: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
+    def __init__(self, capacity_bytes: int = (2 << 30), spill_dir: Optional[str] = None,
+                 spill_capacity_bytes: int = (16 << 30)):
         self.capacity_bytes = capacity_bytes
+        self.spill_dir = spill_dir
+        self.spill_capacity_bytes = spill_capacity_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.root = _LlamaCacheNode()
+        # LRU order of the nodes holding a state in memory / in the spill dir, and their sizes
+        self.memory_lru: OrderedDict[_LlamaCacheNode, int] = OrderedDict()
+        self.spill_lru: OrderedDict[_LlamaCacheNode, int] = OrderedDict()
+        self._cache_size = 0
+        self._spill_size = 0
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
 
-    def _find_longest_prefix_key(
-        self,
-        key: Tuple[int, ...],
-    ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+    @property
+    def spill_size(self):
+        return self._spill_size
+
+    def __len__(self) -> int:
+        return len(self.memory_lru) + len(self.spill_lru)
+
+    @staticmethod
+    def _state_size(state: "LlamaState") -> int:
+        logits = state.eval_logits
+        return state.llama_state_size + len(logits) * (0 if logits.data is None
+                                                       else logits.data[0].nbytes)
+
+    def _find_longest_prefix_node(self, key: Tuple[int, ...]) -> Optional[_LlamaCacheNode]:
+        node, pos = self.root, 0
+        while pos < len(key):
+            child = node.children.get(key[pos])
+            if child is None:
+                break
+            matched = _common_prefix_len(child.edge, key, pos)
+            pos += matched
+            node = child
+            if matched < len(child.edge):
+                break
+        if pos == 0:
+            return None
+        # every leaf holds a state, any state below `node` shares `pos` tokens with `key`
+        while node.state is None:
+            node = next(iter(node.children.values()))
+        return node
+
+    def get(self, key: Sequence[int]) -> Optional["LlamaState"]:
+        """Return the state sharing the longest prefix with `key`, or `None` on a miss."""
+        node = self._find_longest_prefix_node(tuple(key))
+        if node is None:
+            return None
+        if node in self.memory_lru:
+            self.memory_lru.move_to_end(node)
+            return node.state
+        # promote the spilled state back to memory
+        spilled = node.state
+        state = spilled.load()
+        self._spill_size -= self.spill_lru.pop(node)
+        spilled.remove()
+        self._insert_memory(node, state)
+        return state
 
     def __getitem__(self, key: Sequence[int]) -> "LlamaState":
-        key = tuple(key)
-        _key = self._find_longest_prefix_key(key)
-        invalidInputError(_key is not None, "Key not found.")
-        value = self.cache_state[_key]
-        self.cache_state.move_to_end(_key)
-        return value
+        state = self.get(key)
+        invalidInputError(state is not None, "Key not found.")
+        return state
 
     def __contains__(self, key: Sequence[int]) -> bool:
-        return self._find_longest_prefix_key(tuple(key)) is not None
+        return self._find_longest_prefix_node(tuple(key)) is not None
 
     def __setitem__(self, key: Sequence[int], value: "LlamaState"):
         key = tuple(key)
-        if key in self.cache_state:
-            del self.cache_state[key]
-        self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+        node, pos = self.root, 0
+        while pos < len(key):
+            child = node.children.get(key[pos])
+            if child is None:
+                child = _LlamaCacheNode(key[pos:], node)
+                node.children[key[pos]] = child
+                node = child
+                break
+            matched = _common_prefix_len(child.edge, key, pos)
+            if matched < len(child.edge):
+                # split the edge
+                mid = _LlamaCacheNode(child.edge[:matched], node)
+                node.children[key[pos]] = mid
+                child.edge = child.edge[matched:]
+                child.parent = mid
+                mid.children[child.edge[0]] = child
+                child = mid
+            node = child
+            pos += matched
+
+        if node in self.memory_lru:
+            self._cache_size -= self.memory_lru.pop(node)
+        elif node in self.spill_lru:
+            self._spill_size -= self.spill_lru.pop(node)
+            node.state.remove()
+        self._insert_memory(node, value)
+
+    def _insert_memory(self, node: _LlamaCacheNode, state: "LlamaState"):
+        node.state = state
+        size = self._state_size(state)
+        self.memory_lru[node] = size
+        self._cache_size += size
+        while self._cache_size > self.capacity_bytes and len(self.memory_lru) > 0:
+            self._evict(next(iter(self.memory_lru)))
+
+    def _evict(self, node: _LlamaCacheNode):
+        size = self.memory_lru.pop(node)
+        self._cache_size -= size
+        if self.spill_dir is not None and size <= self.spill_capacity_bytes:
+            path = os.path.join(self.spill_dir, f"llama-state-{uuid.uuid4().hex}.bin")
+            node.state = _SpilledLlamaState(path, node.state)
+            self.spill_lru[node] = size
+            self._spill_size += size
+            while self._spill_size > self.spill_capacity_bytes:
+                spilled = next(iter(self.spill_lru))
+                self._spill_size -= self.spill_lru.pop(spilled)
+                spilled.state.remove()
+                self._remove_node(spilled)
+        else:
+            self._remove_node(node)
+
+    def _remove_node(self, node: _LlamaCacheNode):
+        node.state = None
+        # prune nodes which hold no state and have no children
+        while node.parent is not None and node.state is None and not node.children:
+            del node.parent.children[node.edge[0]]
+            node = node.parent
+
+    def clear(self):
+        for node in self.spill_lru:
+            node.state.remove()
+        self.root = _LlamaCacheNode()
+        self.memory_lru.clear()
+        self.spill_lru.clear()
+        self._cache_size = 0
+        self._spill_size = 0
+
+
+class LogitsRing:
+    """
+    Logits rows kept in one `[capacity, n_vocab]` float32 array used as a ring, the array
+    grows with the rows appended up to `maxlen` rows, after which the oldest rows are
+    overwritten. Like a `deque`, index 0 is the oldest row, the returned rows are views
+    which stay valid until they are overwritten or the array grows.
+    """
+
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.data: Optional[numpy.ndarray] = None
+        self.start = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, idx: int) -> numpy.ndarray:
+        if idx < 0:
+            idx += self.length
+        invalidInputError(0 <= idx < self.length, "LogitsRing index out of range")
+        return self.data[(self.start + idx) % len(self.data)]
+
+    def __iter__(self) -> Iterator[numpy.ndarray]:
+        for idx in range(self.length):
+            yield self[idx]
+
+    def _grow(self, capacity: int, n_vocab: int):
+        data = numpy.empty((capacity, n_vocab), dtype=numpy.float32)
+        if self.length > 0:
+            data[:self.length] = self.to_numpy()
+        self.data = data
+        self.start = 0
+
+    def extend(self, rows: numpy.ndarray):
+        """Append the rows of a `[n, n_vocab]` array."""
+        rows = rows[-self.maxlen:]
+        n = len(rows)
+        if n == 0:
+            return
+        if self.data is not None and self.data.shape[1] != rows.shape[1]:
+            self.data = None
+            self.start = 0
+            self.length = 0
+        capacity = 0 if self.data is None else len(self.data)
+        if self.length + n > capacity and capacity < self.maxlen:
+            # grow geometrically, so that appending a row at a time copies O(1) per row
+            capacity = min(self.maxlen, max(self.length + n, 2 * capacity))
+            self._grow(capacity, rows.shape[1])
+        end = (self.start + self.length) % capacity
+        first = min(n, capacity - end)
+        self.data[end:end + first] = rows[:first]
+        self.data[:n - first] = rows[first:]
+        self.length += n
+        if self.length > capacity:
+            self.start = (self.start + self.length - capacity) % capacity
+            self.length = capacity
+
+    def pop(self) -> numpy.ndarray:
+        """Remove and return (a copy of) the newest row."""
+        invalidInputError(self.length > 0, "pop from an empty LogitsRing")
+        row = self[-1].copy()
+        self.length -= 1
+        return row
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def to_numpy(self) -> numpy.ndarray:
+        """Return a `[len, n_vocab]` copy of all rows, oldest first."""
+        if self.length == 0:
+            return numpy.empty((0, 0 if self.data is None else self.data.shape[1]),
+                               dtype=numpy.float32)
+        return self.data[(self.start + numpy.arange(self.length)) % len(self.data)]
+
+    def copy(self) -> "LogitsRing":
+        ring = LogitsRing(self.maxlen)
+        ring.extend(self.to_numpy())
+        return ring
 
 
 class LlamaState:
     def __init__(
         self,
         eval_tokens: Deque[int],
-        eval_logits: Deque[List[float]],
+        eval_logits: LogitsRing,
         llama_state,  # type: llama_cpp.Array[llama_cpp.c_uint8]
         llama_state_size: int,
     ):
@@ -189,7 +434,7 @@ class Llama(GenerationMixin):
         self.last_n_tokens_size = last_n_tokens_size
         self.n_batch = min(n_ctx, n_batch)
         self.eval_tokens: Deque[int] = deque(maxlen=n_ctx)
-        self.eval_logits: Deque[List[float]] = deque(maxlen=n_ctx if logits_all else 1)
+        self.eval_logits = LogitsRing(maxlen=n_ctx if logits_all else 1)
 
         self.cache: Optional[LlamaCache] = None
 
@@ -339,13 +584,17 @@ class Llama(GenerationMixin):
             self.eval_tokens.extend(batch)
             # Save logits
             rows = n_tokens if self.params.logits_all else 1
-            n_vocab = llama_cpp.llama_n_vocab(self.ctx)
-            cols = int(n_vocab)
-            logits_view = llama_cpp.llama_get_logits(self.ctx)
-            logits: List[List[float]] = [
-                [logits_view[i * cols + j] for j in range(cols)] for i in range(rows)
-            ]
-            self.eval_logits.extend(logits)
+            self.eval_logits.extend(self.get_logits(rows))
+
+    def get_logits(self, rows: int = 1) -> numpy.ndarray:
+        """Return a `[rows, n_vocab]` zero-copy view of the logits of the last `eval`.
+
+        The view is backed by the llama.cpp context and is overwritten by the next `eval`.
+        """
+        invalidInputError(self.ctx is not None, "The attribute `ctx` of `Llama` object is None.")
+        cols = int(llama_cpp.llama_n_vocab(self.ctx))
+        logits_view = llama_cpp.llama_get_logits(self.ctx)
+        return numpy.ctypeslib.as_array(logits_view, shape=(rows, cols))
 
     def _sample(
         self,
@@ -375,7 +624,7 @@ class Llama(GenerationMixin):
             else last_n_tokens_size
         )
         logits = self.eval_logits[-1]
-        nl_logit = logits[self._token_nl]
+        nl_logit = float(logits[self._token_nl])
         candidates = self._candidates
         llama_cpp.llama_init_candidates(
             ctx=self.ctx,
@@ -566,10 +815,8 @@ class Llama(GenerationMixin):
                 tokens = tokens[longest_prefix:]
                 for _ in range(len(self.eval_tokens) - longest_prefix):
                     self.eval_tokens.pop()
-                    try:
+                    if len(self.eval_logits) > 0:
                         self.eval_logits.pop()
-                    except IndexError:
-                        pass
 
         if reset:
             self.reset()
@@ -711,9 +958,12 @@ class Llama(GenerationMixin):
             invalidInputError(False,
                               "logprobs is not supported for models created with logits_all=False")
 
-        if self.cache:
-            try:
-                cache_item = self.cache[prompt_tokens]
+        if self.cache is not None:
+            cache_item = self.cache.get(prompt_tokens)
+            if cache_item is None:
+                if self.verbose:
+                    print("Llama._create_completion: cache miss", file=sys.stderr)
+            else:
                 cache_prefix_len = Llama.longest_token_prefix(
                     cache_item.eval_tokens, prompt_tokens
                 )
@@ -724,9 +974,6 @@ class Llama(GenerationMixin):
                     self.load_state(cache_item)
                     if self.verbose:
                         print("Llama._create_completion: cache hit", file=sys.stderr)
-            except KeyError:
-                if self.verbose:
-                    print("Llama._create_completion: cache miss", file=sys.stderr)
 
         finish_reason = "length"
         multibyte_fix = 0
@@ -805,19 +1052,16 @@ class Llama(GenerationMixin):
                         token_offset = len(prompt_tokens) + returned_tokens
                         logits = self.eval_logits[token_offset - 1]
                         current_logprobs = Llama.logits_to_logprobs(logits)
-                        sorted_logprobs = list(
-                            sorted(
-                                zip(current_logprobs, range(len(current_logprobs))),
-                                reverse=True,
-                            )
-                        )
+                        sorted_ids = Llama.sort_logprobs(current_logprobs)
                         top_logprob = {
                             self.detokenize([i]).decode(
                                 "utf-8", errors="ignore"
-                            ): logprob
-                            for logprob, i in sorted_logprobs[:logprobs]
+                            ): float(current_logprobs[i])
+                            for i in sorted_ids[:logprobs].tolist()
                         }
-                        top_logprob.update({token_str: current_logprobs[int(token)]})
+                        top_logprob.update(
+                            {token_str: float(current_logprobs[int(token)])}
+                        )
                         logprobs_or_none = {
                             "tokens": [
                                 self.detokenize([token]).decode(
@@ -825,7 +1069,9 @@ class Llama(GenerationMixin):
                                 )
                             ],
                             "text_offset": [text_offset],
-                            "token_logprobs": [sorted_logprobs[int(token)][0]],
+                            "token_logprobs": [
+                                float(current_logprobs[sorted_ids[int(token)]])
+                            ],
                             "top_logprobs": [top_logprob],
                         }
                     returned_tokens += 1
@@ -854,7 +1100,7 @@ class Llama(GenerationMixin):
                 finish_reason = "length"
                 break
 
-        if self.cache:
+        if self.cache is not None:
             if self.verbose:
                 print("Llama._create_completion: cache save", file=sys.stderr)
             self.cache[prompt_tokens + completion_tokens] = self.save_state()
@@ -886,23 +1132,19 @@ class Llama(GenerationMixin):
                     token_offset = len(prompt_tokens) + returned_tokens - 1
                     logits = self.eval_logits[token_offset]
                     current_logprobs = Llama.logits_to_logprobs(logits)
-                    sorted_logprobs = list(
-                        sorted(
-                            zip(current_logprobs, range(len(current_logprobs))),
-                            reverse=True,
-                        )
-                    )
+                    sorted_ids = Llama.sort_logprobs(current_logprobs)
                     top_logprob = {
-                        self.detokenize([i]).decode("utf-8", errors="ignore"): logprob
-                        for logprob, i in sorted_logprobs[:logprobs]
+                        self.detokenize([i]).decode("utf-8", errors="ignore"):
+                            float(current_logprobs[i])
+                        for i in sorted_ids[:logprobs].tolist()
                     }
-                    top_logprob.update({token_str: current_logprobs[int(token)]})
+                    top_logprob.update({token_str: float(current_logprobs[int(token)])})
                     logprobs_or_none = {
                         "tokens": [
                             self.detokenize([token]).decode("utf-8", errors="ignore")
                         ],
                         "text_offset": [text_offset],
-                        "token_logprobs": [sorted_logprobs[int(token)][0]],
+                        "token_logprobs": [float(current_logprobs[sorted_ids[int(token)]])],
                         "top_logprobs": [top_logprob],
                     }
 
@@ -982,27 +1224,21 @@ class Llama(GenerationMixin):
                 self.detokenize([token]).decode("utf-8", errors="ignore")
                 for token in all_tokens
             ]
-            all_logprobs = [
-                Llama.logits_to_logprobs(list(map(float, row)))
-                for row in self.eval_logits
-            ][token_offset:]
+            all_logprobs = Llama.logits_to_logprobs(self.eval_logits.to_numpy()[token_offset:])
             for token, token_str, logprobs_token in zip(
                 all_tokens, all_token_strs, all_logprobs
             ):
                 text_offsets.append(text_offset)
                 text_offset += len(token_str)
                 tokens.append(token_str)
-                sorted_logprobs = list(
-                    sorted(
-                        zip(logprobs_token, range(len(logprobs_token))), reverse=True
-                    )
-                )
-                token_logprobs.append(sorted_logprobs[int(token)][0])
+                sorted_ids = Llama.sort_logprobs(logprobs_token)
+                token_logprobs.append(float(logprobs_token[sorted_ids[int(token)]]))
                 top_logprob: Optional[Dict[str, float]] = {
-                    self.detokenize([i]).decode("utf-8", errors="ignore"): logprob
-                    for logprob, i in sorted_logprobs[:logprobs]
+                    self.detokenize([i]).decode("utf-8", errors="ignore"):
+                        float(logprobs_token[i])
+                    for i in sorted_ids[:logprobs].tolist()
                 }
-                top_logprob.update({token_str: logprobs_token[int(token)]})
+                top_logprob.update({token_str: float(logprobs_token[int(token)])})
                 top_logprobs.append(top_logprob)
             # Weird idosincracy of the OpenAI API where
             # token_logprobs and top_logprobs are null for
@@ -1403,10 +1639,16 @@ class Llama(GenerationMixin):
         return llama_cpp.llama_token_nl()
 
     @staticmethod
-    def logits_to_logprobs(logits: List[float]) -> List[float]:
-        exps = [math.exp(float(x)) for x in logits]
-        sum_exps = sum(exps)
-        return [math.log(x / sum_exps) for x in exps]
+    def logits_to_logprobs(logits: numpy.ndarray) -> numpy.ndarray:
+        """Log-softmax over the last axis of a logits row or a `[n, n_vocab]` array."""
+        logits = numpy.asarray(logits, dtype=numpy.float32)
+        shifted = logits - numpy.max(logits, axis=-1, keepdims=True)
+        return shifted - numpy.log(numpy.sum(numpy.exp(shifted), axis=-1, keepdims=True))
+
+    @staticmethod
+    def sort_logprobs(logprobs: numpy.ndarray) -> numpy.ndarray:
+        """Token ids by descending logprob, ties are ordered by descending token id."""
+        return numpy.argsort(logprobs, kind="stable")[::-1]
 
     @staticmethod
     def longest_token_prefix(a: Sequence[int], b: Sequence[int]):
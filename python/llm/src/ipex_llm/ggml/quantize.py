@@ -15,6 +15,7 @@
 #
 
 import os
+import struct
 import subprocess
 from ipex_llm.utils.common import invalidInputError
 import platform
@@ -83,9 +84,21 @@ _quantize_type = {"llama": _llama_quantize_type,
                   "gptneox": _gptneox_quantize_type,
                   "starcoder": _starcoder_quantize_type}
 
+# ggml tensor type of each llama file type above
+_llama_tensor_qtype = {"q4_0": ggml_tensor_qtype["sym_int4"],
+                       "q4_1": ggml_tensor_qtype["asym_int4"],
+                       "q5_0": ggml_tensor_qtype["sym_int5"],
+                       "q5_1": ggml_tensor_qtype["asym_int5"],
+                       "q8_0": ggml_tensor_qtype["sym_int8"]}
+# ggml tensor type of unquantized tensors
+_GGML_TYPE_F32 = 0
+_GGML_TYPE_F16 = 1
+# version of quantized files written by `libs/quantize-llama`
+_LLAMA_QUANTIZED_FILE_VERSION = 3
+
 
 def quantize(input_path: str, output_path: str,
-             model_family: str, dtype: str='q4_0'):
+             model_family: str, dtype: str='q4_0', n_threads: int=None):
     """
     Quantize ggml file to lower precision.
 
@@ -102,6 +115,8 @@ def quantize(input_path: str, output_path: str,
             bloom : "q4_0", "q4_1"
             gptneox : "q4_0", "q4_1", "q5_0", "q5_1", "q8_0"
             starcoder : "q4_0", "q4_1", "q5_0", "q5_1", "q8_0"
+    :param n_threads: Number of threads to quantize with, only used by `llama` which is
+            quantized in process. Default to `None`, which uses all CPUs.
 
     :return: the path str to the converted ggml binary checkpoint
     """
@@ -124,6 +139,9 @@ def quantize(input_path: str, output_path: str,
                       list(quantize_type_map.keys()),
                       dtype))
     quantize_type = quantize_type_map[dtype]
+    if model_family == "llama" and _is_unquantized_llama_file(input_path):
+        _quantize_llama_file(input_path, output_path, dtype, n_threads)
+        return str(output_path)
     if platform.platform().startswith('Windows'):
         suffix = '.exe'
     else:
@@ -140,3 +158,130 @@ def quantize(input_path: str, output_path: str,
                       "Fail to quantize {}, error message is {}.".format(str(input_path),
                                                                          error_message))
     return str(output_path)
+
+
+def _is_unquantized_llama_file(input_path):
+    # files written by `ipex_llm.ggml.convert`, i.e. ggjt v1 in f16 or f32
+    with open(input_path, "rb") as f:
+        magic = f.read(4)[::-1]
+        version, = struct.unpack("i", f.read(4))
+        file_type = struct.unpack("<7i", f.read(28))[-1]
+    return magic == b"ggjt" and version == 1 and file_type in [0, 1]
+
+
+def quantize_ndarray(ndarray, qtype: int, executor=None, rows_per_job: int=256):
+    """
+    Quantize a 2D float32 numpy array into ggml blocks of `qtype` row by row.
+
+    :param executor: an optional `concurrent.futures.Executor` to quantize chunks of
+            `rows_per_job` rows in parallel, ggml releases the GIL while quantizing.
+
+    :return: a uint8 numpy array of the quantized blocks
+    """
+    import ctypes
+    import numpy as np
+    import ipex_llm.ggml.model.llama.llama_cpp as ggml
+
+    ndarray = np.ascontiguousarray(ndarray, dtype=np.float32)
+    rows, k = ndarray.shape
+    qk = ggml.ggml_qk_size(qtype)
+    invalidInputError(k % qk == 0, f"Last dim of input array must be multiple of {qk}")
+    row_bytes = k // qk * ggml.ggml_type_size(qtype)
+    output = np.empty(rows * row_bytes, dtype=np.uint8)
+
+    def quantize_rows(start):
+        end = min(start + rows_per_job, rows)
+        src = ndarray[start:end].ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+        dst = ctypes.c_void_p(output.ctypes.data + start * row_bytes)
+        hist = (ctypes.c_int64 * 16)()
+        ggml.ggml_quantize_tensor(src, dst, qtype, (end - start) * k, k, hist, False)
+
+    starts = range(0, rows, rows_per_job)
+    if executor is None or len(starts) == 1:
+        for start in starts:
+            quantize_rows(start)
+    else:
+        for future in [executor.submit(quantize_rows, start) for start in starts]:
+            future.result()
+    return output
+
+
+def write_quantized_llama(output_path, params, model, vocab, dtype: str='q4_0',
+                          n_threads: int=None, max_inflight_bytes: int=2 * 1024 ** 3):
+    """
+    Write a llama ggml file quantized to `dtype` from a `convert_util.LazyModel`, in the
+    layout written by `libs/quantize-llama`: all 2D weights are quantized, 1D tensors are
+    kept in f32.
+
+    Tensors are loaded and converted to float32 by two prefetching threads, quantized by
+    `n_threads` threads and written in order, so the whole model is never in memory.
+    """
+    import concurrent.futures
+    import math
+    import time
+    import numpy as np
+    from ipex_llm.utils.convert_util import OutputFile, bounded_parallel_map, \
+        check_vocab_size, DT_F32, lazy_tensor_nbytes
+
+    qtype = _llama_tensor_qtype[dtype]
+    n_threads = n_threads or os.cpu_count() or 1
+    check_vocab_size(params, vocab)
+
+    def do_item(item):
+        name, lazy_tensor = item
+        ndarray = lazy_tensor.load().astype(DT_F32).ndarray
+        if ndarray.ndim == 2 and name.endswith("weight"):
+            return qtype, quantize_ndarray(ndarray, qtype, executor)
+        if ndarray.ndim == 2:
+            return _GGML_TYPE_F16, ndarray.astype(np.float16)
+        return _GGML_TYPE_F32, ndarray
+
+    of = OutputFile(output_path)
+    of.fout.write(b"ggjt"[::-1])
+    values = [_LLAMA_QUANTIZED_FILE_VERSION,
+              params.n_vocab,
+              params.n_embd,
+              params.n_mult,
+              params.n_head,
+              params.n_layer,
+              params.n_embd // params.n_head,  # rot (obsolete)
+              _llama_quantize_type[dtype]]
+    of.fout.write(struct.pack("i" * len(values), *values))
+    of.write_vocab(vocab)
+
+    start = time.perf_counter()
+    n_params = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        results = bounded_parallel_map(do_item, model.items(), concurrency=2,
+                                       max_bytes=max_inflight_bytes, nbytes=lazy_tensor_nbytes)
+        for i, ((name, lazy_tensor), (tensor_type, ndarray)) in \
+                enumerate(zip(model.items(), results)):
+            n_params += math.prod(lazy_tensor.shape)
+            sname = name.encode("utf-8")
+            of.fout.write(struct.pack("iii", len(lazy_tensor.shape), len(sname), tensor_type))
+            of.fout.write(struct.pack("i" * len(lazy_tensor.shape), *lazy_tensor.shape[::-1]))
+            of.fout.write(sname)
+            of.fout.seek((of.fout.tell() + 31) & -32)
+            ndarray.tofile(of.fout)
+            elapsed = time.perf_counter() - start
+            print(f"[{i + 1}/{len(model)}] Quantized {name:38s} | "
+                  f"{n_params / 1e6 / elapsed:8.1f}M params/s")
+    output_bytes = of.fout.tell()
+    of.fout.close()
+    elapsed = time.perf_counter() - start
+    print(f"Quantized {n_params / 1e9:.2f}B params into {output_bytes / 1024 ** 3:.2f} GB "
+          f"in {elapsed:.2f}s ({n_params / 1e6 / elapsed:.1f}M params/s) "
+          f"with {n_threads} threads")
+
+
+def _quantize_llama_file(input_path, output_path, dtype, n_threads):
+    from ipex_llm.utils.convert_util import lazy_load_ggml_file, Params
+
+    with open(input_path, "rb") as fp:
+        model_plus = lazy_load_ggml_file(fp, Path(input_path))
+        fp.seek(8)
+        n_vocab, n_embd, n_mult, n_head, n_layer, _, _ = struct.unpack("<7i", fp.read(28))
+        params = Params(n_vocab=n_vocab, n_embd=n_embd, n_mult=n_mult, n_head=n_head,
+                        n_layer=n_layer, n_kv_head=None)
+        write_quantized_llama(output_path, params, model_plus.model, model_plus.vocab,
+                              dtype, n_threads)
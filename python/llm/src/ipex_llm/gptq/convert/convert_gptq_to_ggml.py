@@ -17,12 +17,13 @@
 # Convert a GPTQ quantized LLaMA model to a ggml compatible file
 # Based on: https://github.com/ggerganov/llama.cpp
 #           /blob/20a1a4e09c522a80e2a0db51643d25fa38326065/convert-gptq-to-ggml.py
-# Current supported GPTQ model: 4bits, no act-order, no safetensors.
+# Current supported GPTQ model: 4bits, no act-order.
 #
 import os
 import re
 import sys
 import json
+import time
 import warnings
 import struct
 import numpy as np
@@ -30,6 +31,7 @@ import torch
 from sentencepiece import SentencePieceProcessor
 from pathlib import Path
 from ipex_llm.utils.common.log4Error import invalidInputError
+from ipex_llm.utils.convert_util import bounded_parallel_map, default_concurrency
 
 
 def write_header(fout, shape, dst_name, ftype_cur):
@@ -40,57 +42,39 @@ def write_header(fout, shape, dst_name, ftype_cur):
     fout.seek((fout.tell() + 31) & -32)
 
 
-def convert_non_q4(src_name, dst_name, model, fout):
+def prepare_non_q4(src_name, model):
     v = model[src_name]
-    shape = v.shape
-    print("Processing non-Q4 variable: " + src_name +
-          " with shape: ", shape, " and type: ", v.dtype)
-    if len(shape) == 1:
-        print("  Converting to float32")
+    src_dtype = v.dtype
+    if len(v.shape) == 1:
         v = v.to(torch.float32)
-
     ftype_cur = {torch.float16: 1, torch.float32: 0}[v.dtype]
-
-    # header
-    write_header(fout, shape, dst_name, ftype_cur)
-
-    # data
-    v.numpy().tofile(fout)
+    return v.shape, src_dtype, ftype_cur, v.numpy()
 
 
 def expandToInt4(qweight):
-    eweight = qweight.repeat(8, axis=2)
-    eweight = eweight.astype(np.uint32)
-    for i in range(0, eweight.shape[2]):
-        offset = i % (32 // 4) * 4
-        eweight[:, :, i] = eweight[:, :, i] >> offset & (2 ** 4 - 1)
-    return eweight
+    # Each int32 item holds 8 int4 items, the lowest 4 bits first.
+    qweight = np.asarray(qweight).view(np.uint32)
+    eweight = np.empty((*qweight.shape, 8), dtype=np.uint8)
+    for i in range(8):
+        np.bitwise_and(qweight >> (i * 4), 2 ** 4 - 1, out=eweight[..., i], casting='unsafe')
+    return eweight.reshape(*qweight.shape[:-1], qweight.shape[-1] * 8)
 
 
 def to_ggml_int16(eweight):
-    qweight = np.zeros((eweight.shape[0], eweight.shape[1], eweight.shape[2] // 4), dtype=np.uint16)
-    eweight = np.asarray(eweight, dtype=np.uint16)
-    for i in range(0, qweight.shape[2]):
-        qweight[:, :, i] = eweight[:, :, i * 2 + 0]
-        qweight[:, :, i] |= eweight[:, :, i * 2 + 32] << 1 * 4
-        qweight[:, :, i] |= eweight[:, :, i * 2 + 1] << 2 * 4
-        qweight[:, :, i] |= eweight[:, :, i * 2 + 33] << 3 * 4
-    return qweight.astype(np.int16)
+    # Byte i of each group of 64 int4 items holds item i in its low 4 bits
+    # and item i + 32 in its high 4 bits.
+    eweight = np.asarray(eweight, dtype=np.uint8)
+    qweight = eweight[:, :, :32] | (eweight[:, :, 32:] << 4)
+    return qweight.view(np.int16)
 
 
 def qzeros_to_zeros(qzeros, bits=4):
-    zeros = np.zeros((qzeros.shape[0], qzeros.shape[1] * (32 // bits)), dtype=np.float32)
-    i = 0
-    col = 0
-    while col < qzeros.shape[1]:
-        for j in range(i, i + (32 // bits)):
-            zeros[:, j] = (qzeros[:, col] >> (bits * (j - i)) & (2 ** bits - 1)) + 1
-        i += 32 // bits
-        col += 1
-    return zeros
-
-
-def convert_q4(src_name, dst_name, model, fout, n_head, permute=False):
+    shifts = np.arange(0, 32, bits, dtype=qzeros.dtype)
+    zeros = (qzeros[:, :, None] >> shifts) & (2 ** bits - 1)
+    return (zeros.reshape(qzeros.shape[0], -1) + 1).astype(np.float32)
+
+
+def prepare_q4(src_name, model, n_head, permute=False):
     qzeros = model[f"{src_name}.qzeros"].numpy()
     zeros = qzeros_to_zeros(qzeros).T
     scales = model[f"{src_name}.scales"].numpy().T
@@ -106,8 +90,6 @@ def convert_q4(src_name, dst_name, model, fout, n_head, permute=False):
     # Each int32 item is actually 8 int4 items packed together, and it's transposed.
     shape = (qweight.shape[0], qweight.shape[1] * 8)
 
-    print("Processing Q4 variable: " + src_name + " with shape: ", shape)
-
     # The output format has the int4 weights in groups of 32 rather than 8.
     # It looks like this:
     # For each row:
@@ -150,12 +132,58 @@ def convert_q4(src_name, dst_name, model, fout, n_head, permute=False):
         blob = (blob.reshape(n_head, 2, shape[0] // n_head // 2, *blob.shape[1:])
                 .swapaxes(1, 2)
                 .reshape(blob.shape))
+    return shape, ftype, blob
+
+
+class SafetensorsCheckpoint:
+    """
+    Read-only mapping of the tensors in a safetensors file, the file is memory-mapped
+    and each tensor is only read when accessed.
+    """
+
+    def __init__(self, path):
+        from safetensors import safe_open
+        self.file = safe_open(path, framework="pt")
+        self.names = list(self.file.keys())
 
-    # header
-    write_header(fout, shape, dst_name, ftype)  # ftype = Q4_1
+    def __getitem__(self, name):
+        return self.file.get_tensor(name)
 
-    # data
-    blob.tofile(fout)
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+def gptq_tensor_names(n_layer):
+    """
+    Yields `(src_name, dst_name, is_q4, permute)` of each tensor in the ggml file order.
+    """
+    yield "model.embed_tokens.weight", "tok_embeddings.weight", False, False
+    yield "model.norm.weight", "norm.weight", False, False
+    yield "lm_head.weight", "output.weight", False, False
+
+    for i in range(n_layer):
+        yield (f"model.layers.{i}.self_attn.q_proj",
+               f"layers.{i}.attention.wq.weight", True, True)
+        yield (f"model.layers.{i}.self_attn.k_proj",
+               f"layers.{i}.attention.wk.weight", True, True)
+        yield (f"model.layers.{i}.self_attn.v_proj",
+               f"layers.{i}.attention.wv.weight", True, False)
+        yield (f"model.layers.{i}.self_attn.o_proj",
+               f"layers.{i}.attention.wo.weight", True, False)
+        yield (f"model.layers.{i}.mlp.gate_proj",
+               f"layers.{i}.feed_forward.w1.weight", True, False)
+        yield (f"model.layers.{i}.mlp.down_proj",
+               f"layers.{i}.feed_forward.w2.weight", True, False)
+        yield (f"model.layers.{i}.mlp.up_proj",
+               f"layers.{i}.feed_forward.w3.weight", True, False)
+
+        yield (f"model.layers.{i}.input_layernorm.weight",
+               f"layers.{i}.attention_norm.weight", False, False)
+        yield (f"model.layers.{i}.post_attention_layernorm.weight",
+               f"layers.{i}.ffn_norm.weight", False, False)
 
 
 def find_quantized_model_file(model_path):
@@ -169,14 +197,20 @@ def find_quantized_model_file(model_path):
             return str(found[0])
 
 
-def convert_gptq2ggml(model_path, output_path, tokenizer_path=None):
+def convert_gptq2ggml(model_path, output_path, tokenizer_path=None, concurrency=None):
+    """
+    Convert a 4 bits no act-order GPTQ llama model to a ggml file.
+
+    Tensors are unpacked by `concurrency` threads, default to `IPEX_LLM_CONVERT_WORKERS`
+    or the number of CPUs, and written in order. Safetensors checkpoints are
+    memory-mapped, so only the tensors in flight are in memory.
+    """
     input_path = find_quantized_model_file(model_path)
 
     if input_path.endswith('pt'):
         model = torch.load(input_path, map_location="cpu")
     elif input_path.endswith('safetensors'):
-        from safetensors.torch import load_file
-        model = load_file(input_path)
+        model = SafetensorsCheckpoint(input_path)
     else:
         invalidInputError(False, "unknown input model path, only support .safetensors or .pt file.")
 
@@ -236,31 +270,33 @@ def convert_gptq2ggml(model_path, output_path, tokenizer_path=None):
         fout.write(text)
         fout.write(struct.pack("f", tokenizer.get_score(i)))
 
-    convert_non_q4("model.embed_tokens.weight", "tok_embeddings.weight", model, fout)
-    convert_non_q4("model.norm.weight", "norm.weight", model, fout)
-    convert_non_q4("lm_head.weight", "output.weight", model, fout)
-
-    for i in range(n_layer):
-        convert_q4(f"model.layers.{i}.self_attn.q_proj",
-                   f"layers.{i}.attention.wq.weight", model, fout, n_head, permute=True)
-        convert_q4(f"model.layers.{i}.self_attn.k_proj",
-                   f"layers.{i}.attention.wk.weight", model, fout, n_head, permute=True)
-        convert_q4(f"model.layers.{i}.self_attn.v_proj",
-                   f"layers.{i}.attention.wv.weight", model, fout, n_head)
-        convert_q4(f"model.layers.{i}.self_attn.o_proj",
-                   f"layers.{i}.attention.wo.weight", model, fout, n_head)
-        convert_q4(f"model.layers.{i}.mlp.gate_proj",
-                   f"layers.{i}.feed_forward.w1.weight", model, fout, n_head)
-        convert_q4(f"model.layers.{i}.mlp.down_proj",
-                   f"layers.{i}.feed_forward.w2.weight", model, fout, n_head)
-        convert_q4(f"model.layers.{i}.mlp.up_proj",
-                   f"layers.{i}.feed_forward.w3.weight", model, fout, n_head)
-
-        convert_non_q4(f"model.layers.{i}.input_layernorm.weight",
-                       f"layers.{i}.attention_norm.weight", model, fout)
-        convert_non_q4(f"model.layers.{i}.post_attention_layernorm.weight",
-                       f"layers.{i}.ffn_norm.weight", model, fout)
+    def do_item(item):
+        src_name, _, is_q4, permute = item
+        if is_q4:
+            return prepare_q4(src_name, model, n_head, permute)
+        return prepare_non_q4(src_name, model)
+
+    concurrency = concurrency or default_concurrency()
+    items = list(gptq_tensor_names(n_layer))
+    start = time.perf_counter()
+    results = bounded_parallel_map(do_item, items, concurrency=concurrency)
+    for (src_name, dst_name, is_q4, _), result in zip(items, results):
+        if is_q4:
+            shape, ftype, data = result
+            print("Processing Q4 variable: " + src_name + " with shape: ", shape)
+        else:
+            shape, src_dtype, ftype, data = result
+            print("Processing non-Q4 variable: " + src_name +
+                  " with shape: ", shape, " and type: ", src_dtype)
+            if len(shape) == 1:
+                print("  Converting to float32")
+        write_header(fout, shape, dst_name, ftype)
+        data.tofile(fout)
+    output_bytes = fout.tell()
     fout.close()
+    elapsed = time.perf_counter() - start
+    print(f"Converted {len(items)} tensors in {elapsed:.2f}s "
+          f"({output_bytes / 1024 ** 2 / elapsed:.1f} MB/s) with {concurrency} workers")
     print("Done. Output file: " + output_path)
     print("")
 
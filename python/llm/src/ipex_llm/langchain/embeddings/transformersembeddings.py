@@ -46,7 +46,8 @@
 
 """Wrapper around BigdlLLM embedding models."""
 import torch
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import numpy as np
 
 from pydantic import BaseModel, Extra, Field
@@ -54,6 +55,8 @@ from pydantic import BaseModel, Extra, Field
 from langchain.embeddings.base import Embeddings
 
 DEFAULT_MODEL_NAME = "gpt2"
+# `embed_documents` sorts texts by length within windows of this many batches
+SORT_WINDOW_BATCHES = 64
 
 
 class TransformersEmbeddings(BaseModel, Embeddings):
@@ -78,6 +81,12 @@ class TransformersEmbeddings(BaseModel, Embeddings):
     """Keyword arguments to pass to the model."""
     encode_kwargs: Dict[str, Any] = Field(default_factory=dict)
     """Keyword arguments to pass when calling the `encode` method of the model."""
+    batch_size: int = 16
+    """Max number of texts encoded in one forward pass by `embed_documents`."""
+    max_batch_tokens: Optional[int] = None
+    """Max number of padded tokens in one forward pass by `embed_documents`."""
+    tokenize_in_background: bool = False
+    """Whether `embed_documents` tokenizes the next texts in a thread while encoding."""
 
     @classmethod
     def from_model_id(
@@ -157,9 +166,75 @@ class TransformersEmbeddings(BaseModel, Embeddings):
         embeddings = np.mean(embeddings, axis=0)
         return embeddings
 
+    def _tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(texts, **self.encode_kwargs)["input_ids"]
+
+    def _tokenize_windows(self, texts: List[str]) -> Iterator[Tuple[int, List[List[int]]]]:
+        window = self.batch_size * SORT_WINDOW_BATCHES
+        starts = range(0, len(texts), window)
+        if not self.tokenize_in_background:
+            for start in starts:
+                yield start, self._tokenize(texts[start:start + window])
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            prev_start, prev_future = None, None
+            for start in starts:
+                # tokenize the next window while the current one is being encoded
+                future = executor.submit(self._tokenize, texts[start:start + window])
+                if prev_future is not None:
+                    yield prev_start, prev_future.result()
+                prev_start, prev_future = start, future
+            if prev_future is not None:
+                yield prev_start, prev_future.result()
+
+    def _make_batches(self, lengths: List[int]) -> List[List[int]]:
+        """Group text indices sorted by length into batches within the size limits."""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches, batch = [], []
+        for i in order:
+            # lengths are ascending, so the padded length of a batch is its last length
+            if batch and (len(batch) >= self.batch_size
+                          or (self.max_batch_tokens is not None
+                              and (len(batch) + 1) * lengths[i] > self.max_batch_tokens)):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor):
+        """Mean of the hidden states of non-padding tokens."""
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    @torch.no_grad()
+    def embed_batch(self, input_ids: List[List[int]]) -> torch.Tensor:
+        """Compute the embeddings of a batch of tokenized texts, padded to the right.
+
+        Returns:
+            A float tensor of shape [len(input_ids), N] on CPU.
+        """
+        max_len = max(len(ids) for ids in input_ids)
+        pad_token_id = self.tokenizer.pad_token_id
+        pad_token_id = 0 if pad_token_id is None else pad_token_id
+        padded_ids = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+        for row, ids in enumerate(input_ids):
+            padded_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+        device = self.model.device
+        hidden_states = self.model(padded_ids.to(device), attention_mask=attention_mask.to(device),
+                                   return_dict=False)[0]
+        embeddings = self.pool(hidden_states, attention_mask.to(hidden_states.device))
+        return embeddings.float().cpu()
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a HuggingFace transformer model.
 
+        Texts are sorted by token length and encoded in batches of at most `batch_size`
+        texts and `max_batch_tokens` padded tokens.
+
         Args:
             texts: The list of texts to embed.
 
@@ -167,7 +242,12 @@ class TransformersEmbeddings(BaseModel, Embeddings):
             List of embeddings, one for each text.
         """
         texts = list(map(lambda x: x.replace("\n", " "), texts))
-        embeddings = [self.embed(text, **self.encode_kwargs).tolist() for text in texts]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        for start, input_ids in self._tokenize_windows(texts):
+            for batch in self._make_batches([len(ids) for ids in input_ids]):
+                batch_embeddings = self.embed_batch([input_ids[i] for i in batch]).tolist()
+                for i, embedding in zip(batch, batch_embeddings):
+                    embeddings[start + i] = embedding
         return embeddings
 
     def embed_query(self, text: str) -> List[float]:
@@ -193,3 +273,7 @@ class TransformersBgeEmbeddings(TransformersEmbeddings):
         embeddings = self.model(input_ids, return_dict=False)[0].cpu()
         embeddings = torch.nn.functional.normalize(embeddings[:, 0], p=2, dim=1)
         return embeddings[0]
+
+    def pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor):
+        """Normalized hidden state of the first (CLS) token."""
+        return torch.nn.functional.normalize(hidden_states[:, 0], p=2, dim=1)
@@ -15,10 +15,12 @@
 #
 
 import os
+import math
+import time
 from ipex_llm.utils.common import invalidInputError
 from transformers.utils import logging
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from openai.types.chat import ChatCompletionMessageParam
 from pydantic import BaseModel
 from ipex_llm.utils.common import invalidInputError
@@ -27,6 +29,8 @@ import uuid
 from typing import List, Optional, Union, Dict
 from fastapi.middleware.cors import CORSMiddleware
 from .tgi_protocol import Parameters
+from .scheduler import PRIORITY_CLASSES, RequestQueue
+from .metrics import ServingMetrics
 from typing_extensions import Literal
 from fastapi import File, UploadFile, Form
 from .openai_protocol import (
@@ -45,6 +49,10 @@ from .openai_protocol import (
 )
 
 result_dict: Dict[str, str] = {}
+# request id -> future of its streamer, set once the worker creates the streamer
+streamer_waiters: Dict[str, asyncio.Future] = {}
+request_arrived = None
+serving_metrics = ServingMetrics()
 logger = logging.get_logger(__name__)
 
 
@@ -55,6 +63,9 @@ class InputsRequest(BaseModel):
     stream: Optional[bool] = False
     req_type: str = 'completion'
     transcription_request:  Optional[TranscriptionRequest] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+    # seconds to finish in, rejected or shed with 429 if it can not
+    timeout: Optional[float] = None
 
 
 class ChatCompletionRequest(BaseModel):
@@ -72,6 +83,8 @@ class ChatCompletionRequest(BaseModel):
     repetition_penalty: Optional[float] = None
     presence_penalty: Optional[float] = None
     temperature: Optional[float] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+    timeout: Optional[float] = None
 
 
 class CompletionRequest(BaseModel):
@@ -85,6 +98,8 @@ class CompletionRequest(BaseModel):
     repetition_penalty: Optional[float] = None
     presence_penalty: Optional[float] = None
     temperature: Optional[float] = None
+    priority: Literal["interactive", "batch"] = "interactive"
+    timeout: Optional[float] = None
 
 
 app = FastAPI()
@@ -111,9 +126,13 @@ class FastApp():
         self.app = app
 
 
-def get_queue_next_token(delta_text_queue):
+async def get_queue_next_token(delta_text_queue):
+    if isinstance(delta_text_queue, asyncio.Queue):
+        # streamers of PPModelWorker
+        remain, delta_text = await delta_text_queue.get()
+        return delta_text, remain
     timeout = int(os.getenv("IPEX_LLM_FASTAPI_TIMEOUT", 60))
-    delta_text = delta_text_queue.text_queue.get(timeout=timeout)
+    delta_text = await delta_text_queue.get(timeout=timeout)
     if "whisper" in local_model.model_name.lower():
         if delta_text is not None and "<|" in delta_text and "|>" in delta_text:
             import re
@@ -136,110 +155,90 @@ def should_return_end_token(next_token):
 async def chat_stream_generator(local_model, delta_text_queue, request_id):
     model_name = local_model.model_name
     index = 0
-    while True:
-        await asyncio.sleep(0)
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
-            else:
-                await asyncio.sleep(0)
-                continue
-        if remain == 0 and delta_text is not None or remain != 0:
-            if should_return_end_token(delta_text):
+    try:
+        while True:
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
+            if remain == 0 and delta_text is not None or remain != 0:
+                if should_return_end_token(delta_text):
+                    choice_data = ChatCompletionResponseStreamChoice(
+                        index=index,
+                        delta=DeltaMessage(role="assistant", content=delta_text),
+                        logprobs=None,
+                        finish_reason=None)
+                    chunk = ChatCompletionStreamResponse(
+                        id=request_id,
+                        choices=[choice_data],
+                        model=model_name)
+                    data = chunk.model_dump_json(exclude_unset=True)
+                    yield f"data: {data}\n\n"
+                    index = index + 1
+            if remain == 0:
                 choice_data = ChatCompletionResponseStreamChoice(
                     index=index,
-                    delta=DeltaMessage(role="assistant", content=delta_text),
+                    delta=DeltaMessage(role="assistant", content=None),
                     logprobs=None,
-                    finish_reason=None)
+                    finish_reason="length")
                 chunk = ChatCompletionStreamResponse(
                     id=request_id,
                     choices=[choice_data],
                     model=model_name)
                 data = chunk.model_dump_json(exclude_unset=True)
                 yield f"data: {data}\n\n"
-                index = index + 1
-        if remain == 0:
-            choice_data = ChatCompletionResponseStreamChoice(
-                index=index,
-                delta=DeltaMessage(role="assistant", content=None),
-                logprobs=None,
-                finish_reason="length")
-            chunk = ChatCompletionStreamResponse(
-                id=request_id,
-                choices=[choice_data],
-                model=model_name)
-            data = chunk.model_dump_json(exclude_unset=True)
-            yield f"data: {data}\n\n"
-            break
-    local_model.streamer.pop(request_id, None)
+                break
+    finally:
+        local_model.streamer.pop(request_id, None)
+        serving_metrics.finish_stream(request_id)
 
 
 async def completion_stream_generator(local_model, delta_text_queue, request_id):
     model_name = local_model.model_name
     index = 0
-    while True:
-        await asyncio.sleep(0)
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
-            else:
-                await asyncio.sleep(0)
-                continue
-        if remain == 0 and delta_text is not None or remain != 0:
-            if should_return_end_token(delta_text):
+    try:
+        while True:
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
+            if remain == 0 and delta_text is not None or remain != 0:
+                if should_return_end_token(delta_text):
+                    choice_data = CompletionResponseStreamChoice(
+                        index=index,
+                        text=delta_text,
+                        logprobs=None,
+                        finish_reason=None)
+                    chunk = CompletionStreamResponse(
+                        id=request_id,
+                        choices=[choice_data],
+                        model=model_name)
+                    data = chunk.model_dump_json(exclude_unset=True)
+                    yield f"data: {data}\n\n"
+                    index = index + 1
+            if remain == 0:
                 choice_data = CompletionResponseStreamChoice(
                     index=index,
-                    text=delta_text,
+                    text="",
                     logprobs=None,
-                    finish_reason=None)
+                    finish_reason="length")
                 chunk = CompletionStreamResponse(
                     id=request_id,
                     choices=[choice_data],
                     model=model_name)
                 data = chunk.model_dump_json(exclude_unset=True)
                 yield f"data: {data}\n\n"
-                index = index + 1
-        if remain == 0:
-            choice_data = CompletionResponseStreamChoice(
-                index=index,
-                text="",
-                logprobs=None,
-                finish_reason="length")
-            chunk = CompletionStreamResponse(
-                id=request_id,
-                choices=[choice_data],
-                model=model_name)
-            data = chunk.model_dump_json(exclude_unset=True)
-            yield f"data: {data}\n\n"
-            break
-    local_model.streamer.pop(request_id, None)
+                break
+    finally:
+        local_model.streamer.pop(request_id, None)
+        serving_metrics.finish_stream(request_id)
 
 
 async def generator(local_model, delta_text_queue, request_id):
-    while True:
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-            if delta_text is None:
-                break
-            else:
-                yield delta_text
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
+    try:
+        while True:
+            delta_text, remain = await get_queue_next_token(delta_text_queue)
+            if delta_text is not None:
                 yield delta_text
-                if remain == 0:
-                    break
-            else:
-                await asyncio.sleep(0)
-                continue
-    local_model.streamer.pop(request_id, None)
+            if remain == 0:
+                break
+    finally:
+        local_model.streamer.pop(request_id, None)
+        serving_metrics.finish_stream(request_id)
 
 
 @app.post("/generate")
@@ -248,15 +247,11 @@ async def generate(inputs_request: InputsRequest):
         result = await generate_stream_api(inputs_request)
         return result
     request_id = str(uuid.uuid4())
-    await local_model.waiting_requests.put((request_id, inputs_request))
-    while True:
-        await asyncio.sleep(0)
-        cur_streamer = local_model.streamer.get(request_id, None)
-        if cur_streamer is not None:
-            output_str = []
-            async for item in generator(local_model, cur_streamer, request_id):
-                output_str.append(item)
-            return request_id, "".join(output_str)
+    cur_streamer = await submit_request(request_id, inputs_request)
+    output_str = []
+    async for item in generator(local_model, cur_streamer, request_id):
+        output_str.append(item)
+    return request_id, "".join(output_str)
 
 
 @app.post("/generate_stream")
@@ -267,20 +262,16 @@ async def generate_stream_api(inputs_request: InputsRequest):
 
 async def generate_stream(inputs_request: InputsRequest):
     request_id = str(uuid.uuid4()) + "stream"
-    await local_model.waiting_requests.put((request_id, inputs_request))
-    while True:
-        await asyncio.sleep(0.1)
-        cur_streamer = local_model.streamer.get(request_id, None)
-        if cur_streamer is not None:
-            if inputs_request.req_type == 'completion':
-                cur_generator = completion_stream_generator(local_model, cur_streamer, request_id)
-            elif inputs_request.req_type == 'chat':
-                cur_generator = chat_stream_generator(local_model, cur_streamer, request_id)
-            else:
-                invalidInputError(False, "Invalid Request Type.")
-            return request_id, StreamingResponse(
-                content=cur_generator, media_type="text/event-stream"
-            )
+    cur_streamer = await submit_request(request_id, inputs_request)
+    if inputs_request.req_type == 'completion':
+        cur_generator = completion_stream_generator(local_model, cur_streamer, request_id)
+    elif inputs_request.req_type == 'chat':
+        cur_generator = chat_stream_generator(local_model, cur_streamer, request_id)
+    else:
+        invalidInputError(False, "Invalid Request Type.")
+    return request_id, StreamingResponse(
+        content=cur_generator, media_type="text/event-stream"
+    )
 
 
 def get_prompt(messages) -> str:
@@ -357,7 +348,9 @@ async def create_chat_completion(request: ChatCompletionRequest):
         parameters=set_parameters(request),
         image_list=image_list if len(image_list) >= 1 else None,
         stream=request.stream,
-        req_type="chat"
+        req_type="chat",
+        priority=request.priority,
+        timeout=request.timeout,
     )
     if request.stream:
         request_id, result = await generate_stream(inputs_request)
@@ -382,7 +375,9 @@ async def create_completion(request: CompletionRequest):
         inputs=request.prompt,
         parameters=set_parameters(request),
         stream=request.stream,
-        req_type="completion"
+        req_type="completion",
+        priority=request.priority,
+        timeout=request.timeout,
     )
     if request.stream:
         request_id, result = await generate_stream(inputs_request)
@@ -428,10 +423,114 @@ async def transcriptions(
 
 @app.on_event("startup")
 async def startup_event():
+    global request_arrived
+    request_arrived = asyncio.Event()
+    if isinstance(local_model.waiting_requests, RequestQueue):
+        # a finished request may let a waiting one start
+        local_model.waiting_requests.on_release = request_arrived.set
     asyncio.create_task(process_requests(local_model, result_dict))
 
 
+@app.get("/queue_stats")
+async def queue_stats():
+    waiting_requests = local_model.waiting_requests
+    if isinstance(waiting_requests, RequestQueue):
+        return waiting_requests.get_stats()
+    return {"num_waiting": waiting_requests.qsize()}
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(serving_metrics.render(local_model),
+                             media_type="text/plain; version=0.0.4")
+
+
+def estimate_cost(inputs_request: InputsRequest, prompt_len: int) -> int:
+    parameters = inputs_request.parameters
+    if parameters is None:
+        parameters = Parameters()
+    return prompt_len * parameters.max_new_tokens
+
+
+async def admit_request(waiting_requests, request_id, inputs_request):
+    """Queues a request to `waiting_requests`, raises 429 if it is rejected."""
+    # tokenize off the event loop, the worker reuses the prompt inputs
+    prompt_inputs = await asyncio.to_thread(tokenizer, inputs_request.inputs,
+                                            return_tensors="pt")
+    cost = estimate_cost(inputs_request, prompt_inputs.input_ids.size(1))
+    reason = waiting_requests.admit(request_id, (request_id, inputs_request, prompt_inputs),
+                                    inputs_request.priority, cost, inputs_request.timeout)
+    if reason is not None:
+        retry_after = waiting_requests.estimate_finish_time(
+            PRIORITY_CLASSES[inputs_request.priority], cost)
+        raise HTTPException(status_code=429, detail=f"Request rejected: {reason}",
+                            headers={"Retry-After": str(math.ceil(retry_after or 1))})
+
+
+async def wait_streamer(waiting_requests, request_id, future):
+    """Waits for the streamer of a request, sheds it if it can not start in time."""
+    try:
+        time_to_start = waiting_requests.time_to_start(request_id)
+        if time_to_start is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), max(time_to_start, 0))
+            except asyncio.TimeoutError:
+                if waiting_requests.remove(request_id, shed=True):
+                    raise HTTPException(status_code=429,
+                                        detail="Request shed: it can not finish in its "
+                                               "timeout")
+        return await future
+    except asyncio.CancelledError:
+        # do not run the request of a disconnected client
+        waiting_requests.remove(request_id)
+        raise
+
+
+async def submit_request(request_id, inputs_request):
+    """Queues a request to `local_model` and waits until its streamer is created."""
+    arrival_time = time.perf_counter()
+    waiting_requests = local_model.waiting_requests
+    if isinstance(waiting_requests, RequestQueue):
+        await admit_request(waiting_requests, request_id, inputs_request)
+    else:
+        await waiting_requests.put((request_id, inputs_request))
+    request_arrived.set()
+    cur_streamer = local_model.streamer.get(request_id, None)
+    if cur_streamer is None:
+        future = asyncio.get_running_loop().create_future()
+        streamer_waiters[request_id] = future
+        try:
+            if isinstance(waiting_requests, RequestQueue):
+                cur_streamer = await wait_streamer(waiting_requests, request_id, future)
+            else:
+                cur_streamer = await future
+        finally:
+            streamer_waiters.pop(request_id, None)
+    serving_metrics.start_stream(request_id, cur_streamer, arrival_time)
+    return cur_streamer
+
+
+def notify_streamer_waiters():
+    for request_id, future in list(streamer_waiters.items()):
+        cur_streamer = local_model.streamer.get(request_id, None)
+        if cur_streamer is not None and not future.done():
+            future.set_result(cur_streamer)
+
+
+def is_idle(local_model):
+    # PPModelWorker keeps stepping while any batch is in its pipeline
+    on_going_batches = getattr(local_model, "on_going_batches", [])
+    return local_model.waiting_requests.empty() and \
+        all(batch is None for batch in on_going_batches)
+
+
 async def process_requests(local_model, result_dict):
     while True:
-        await asyncio.sleep(0)
+        if is_idle(local_model):
+            # sleep until the next request instead of polling the queue
+            request_arrived.clear()
+            if is_idle(local_model):
+                await request_arrived.wait()
         await local_model.process_step(tokenizer, result_dict, processor)
+        notify_streamer_waiters()
+        await asyncio.sleep(0)
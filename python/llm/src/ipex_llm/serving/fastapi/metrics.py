@@ -0,0 +1,194 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Serving metrics in the Prometheus text exposition format, without depending on
+# `prometheus_client`.
+#
+# The generation threads only count tokens and take timestamps in the fields of their
+# own streamer (see `AsyncTextStreamer.put`). Metrics below are observed from those
+# fields in the event loop when a stream finishes, so a single thread writes them and
+# no lock is taken on the generation path.
+
+import bisect
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from .scheduler import RequestQueue
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def render_metric(name: str, metric_type: str, documentation: str,
+                  samples: List[Tuple[str, float]]) -> List[str]:
+    """Returns the lines of a metric, `samples` are `(labels, value)`."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {format_value(value)}")
+    return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def render(self, labels: str) -> List[str]:
+        return render_metric(self.name, "counter", self.documentation,
+                             [(labels, self.value)])
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: List[float]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        # the last count is of the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, labels: str) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{{{labels},le=\"{format_value(bound)}\"}} "
+                         f"{cumulative}")
+        lines.append(f"{self.name}_sum{{{labels}}} {format_value(self.sum)}")
+        lines.append(f"{self.name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class ServingMetrics:
+    """
+    Latency, token and load metrics of a served model, rendered by `render` for a
+    `/metrics` endpoint.
+
+    A request is tracked from `start_stream`, once the worker created its streamer, to
+    `finish_stream`, once its stream is consumed or abandoned. Timings are taken from the
+    fields an `AsyncTextStreamer` records, streamers without them, e.g. the queues of
+    `PPModelWorker`, are only counted as requests and active streams.
+    """
+
+    def __init__(self):
+        self.queue_time = Histogram(
+            "ipex_llm_request_queue_time_seconds",
+            "Time from the arrival of a request to the start of its generation.",
+            [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120])
+        self.time_to_first_token = Histogram(
+            "ipex_llm_time_to_first_token_seconds",
+            "Time from the arrival of a request to its first generated token.",
+            [0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2.5, 5, 10, 20, 60])
+        self.time_per_output_token = Histogram(
+            "ipex_llm_time_per_output_token_seconds",
+            "Mean time between the generated tokens of a request after the first one.",
+            [0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1, 2.5])
+        self.tokens_per_second = Histogram(
+            "ipex_llm_request_generation_tokens_per_second",
+            "Generated tokens of a request per second from the start of its generation.",
+            [1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500, 1000])
+        self.prompt_tokens = Counter("ipex_llm_prompt_tokens_total",
+                                     "Number of prefilled prompt tokens.")
+        self.generation_tokens = Counter("ipex_llm_generation_tokens_total",
+                                         "Number of generated tokens.")
+        self.requests = Counter("ipex_llm_requests_total",
+                                "Number of finished or abandoned streams.")
+        # request id -> (arrival time, streamer) of the active streams
+        self.streams: Dict[str, Tuple[float, Any]] = {}
+
+    def start_stream(self, request_id: str, streamer, arrival_time: float):
+        self.streams[request_id] = (arrival_time, streamer)
+        start_time = getattr(streamer, "start_time", None)
+        if start_time is None:
+            start_time = time.perf_counter()
+        self.queue_time.observe(max(start_time - arrival_time, 0.0))
+
+    def finish_stream(self, request_id: str):
+        arrival_time, streamer = self.streams.pop(request_id, (None, None))
+        if streamer is None:
+            return
+        self.requests.inc()
+        self.prompt_tokens.inc(getattr(streamer, "prompt_tokens", 0))
+        completion_tokens = getattr(streamer, "completion_tokens", 0)
+        self.generation_tokens.inc(completion_tokens)
+        first_token_time = getattr(streamer, "first_token_time", None)
+        if first_token_time is None:
+            return
+        last_token_time = streamer.last_token_time
+        self.time_to_first_token.observe(max(first_token_time - arrival_time, 0.0))
+        if completion_tokens > 1:
+            self.time_per_output_token.observe(
+                (last_token_time - first_token_time) / (completion_tokens - 1))
+        if last_token_time > streamer.start_time:
+            self.tokens_per_second.observe(
+                completion_tokens / (last_token_time - streamer.start_time))
+
+    def render(self, local_model) -> str:
+        labels = f"model_name=\"{escape_label(local_model.model_name)}\""
+        lines = []
+        for metric in [self.queue_time, self.time_to_first_token,
+                       self.time_per_output_token, self.tokens_per_second,
+                       self.prompt_tokens, self.generation_tokens, self.requests]:
+            lines += metric.render(labels)
+        lines += render_metric("ipex_llm_active_streams", "gauge",
+                               "Number of streams being generated or consumed.",
+                               [(labels, len(self.streams))])
+
+        get_kv_cache_bytes = getattr(local_model, "get_kv_cache_bytes", None)
+        kv_cache_bytes = get_kv_cache_bytes() if get_kv_cache_bytes is not None else None
+        if kv_cache_bytes is not None:
+            lines += render_metric("ipex_llm_kv_cache_bytes", "gauge",
+                                   "Bytes of the KV cache of the running requests.",
+                                   [(labels, kv_cache_bytes)])
+
+        waiting_requests = local_model.waiting_requests
+        if isinstance(waiting_requests, RequestQueue):
+            stats = waiting_requests.get_stats()
+            lines += render_metric(
+                "ipex_llm_requests_waiting", "gauge", "Number of waiting requests.",
+                [(f"{labels},priority=\"{priority}\"", num)
+                 for priority, num in stats["num_waiting_by_priority"].items()])
+            lines += render_metric("ipex_llm_requests_running", "gauge",
+                                   "Number of started and unfinished requests.",
+                                   [(labels, stats["num_running"])])
+            for name, documentation in [("admitted", "Number of admitted requests."),
+                                        ("rejected", "Number of requests rejected with 429."),
+                                        ("shed", "Number of waiting requests shed with 429.")]:
+                lines += render_metric(f"ipex_llm_requests_{name}_total", "counter",
+                                       documentation, [(labels, stats[f"num_{name}"])])
+        else:
+            lines += render_metric("ipex_llm_requests_waiting", "gauge",
+                                   "Number of waiting requests.",
+                                   [(labels, waiting_requests.qsize())])
+        return "\n".join(lines) + "\n"
@@ -19,20 +19,100 @@ from transformers.utils import logging
 import os
 import time
 import asyncio
+import functools
+import threading
 from PIL import Image
 import requests
-from transformers import TextIteratorStreamer
+from transformers import TextStreamer
+from .scheduler import ContinuousBatchingScheduler, RequestQueue
 logger = logging.get_logger(__name__)
 
 
+class AsyncTextStreamer(TextStreamer):
+    """
+    A `TextStreamer` fed by a generation thread and consumed by `await get()` in the
+    event loop.
+
+    The generation thread never blocks on a slow consumer: text is appended to a buffer
+    and the consumer is woken by `loop.call_soon_threadsafe` only when it is waiting, so a
+    consumer which falls behind receives the buffered text in one larger chunk instead of
+    stalling the decode loop shared with other requests. `on_end` is called in the event
+    loop once generation ends.
+    """
+
+    def __init__(self, tokenizer, loop, skip_prompt=True, on_end=None, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.loop = loop
+        self.on_end = on_end
+        # written only by the generation thread, read by `ServingMetrics`
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.last_token_time = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.ended = False
+        self.waiting = False
+        self.event = asyncio.Event()
+
+    def put(self, value):
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.prompt_tokens += value.numel()
+        else:
+            self.last_token_time = time.perf_counter()
+            if self.first_token_time is None:
+                self.first_token_time = self.last_token_time
+            self.completion_tokens += value.numel()
+        super().put(value)
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        with self.lock:
+            if text:
+                self.buffer.append(text)
+            just_ended = stream_end and not self.ended
+            self.ended = self.ended or stream_end
+            wake_up = self.waiting
+            self.waiting = False
+        if wake_up:
+            self.loop.call_soon_threadsafe(self.event.set)
+        if just_ended and self.on_end is not None:
+            self.loop.call_soon_threadsafe(self.on_end)
+
+    async def get(self, timeout=None):
+        """
+        Returns all text generated since the last call, or `None` once generation ended.
+        Raises `asyncio.TimeoutError` if no text is generated in `timeout` seconds.
+        """
+        while True:
+            with self.lock:
+                if self.buffer:
+                    text = "".join(self.buffer)
+                    self.buffer = []
+                    return text
+                if self.ended:
+                    return None
+                self.waiting = True
+                self.event.clear()
+            await asyncio.wait_for(self.event.wait(), timeout)
+
+
 class ModelWorker:
-    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16):
+    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16,
+                 max_num_seqs=1, max_num_batched_tokens=None, max_queue_size=None,
+                 max_running_requests=None, request_timeout=None):
         self.dtype = torch_dtype
         start = time.perf_counter()
+        self.scheduler = None
         if model_type == "audio":
             self.model = self.load_model(checkpoint, low_bit, "audio")
         else:
             model = self.load_model(checkpoint, low_bit)
+            if max_num_seqs > 1:
+                # decode concurrent text requests in a single continuous batching loop
+                self.scheduler = ContinuousBatchingScheduler(model, max_num_seqs,
+                                                             max_num_batched_tokens)
+                self.scheduler.start()
             if "glm-4v" not in checkpoint.lower():
                 from ipex_llm.utils import BenchmarkWrapper
                 self.model = BenchmarkWrapper(model, do_print=True)
@@ -41,7 +121,11 @@ class ModelWorker:
                 self.model = model
         end = time.perf_counter()
         logger.info(f"Time to load weights: {end - start:.2f}s")
-        self.waiting_requests = asyncio.Queue()
+        if max_running_requests is None and self.scheduler is not None:
+            # requests beyond the running batch wait in `waiting_requests` by priority
+            max_running_requests = max_num_seqs
+        self.waiting_requests = RequestQueue(max_queue_size, max_running_requests,
+                                             request_timeout)
         self.streamer = {}
         self.model_name = checkpoint
 
@@ -98,7 +182,7 @@ class ModelWorker:
         if self.waiting_requests.empty():
             return
         tmp_result = await self.waiting_requests.get()
-        request_id, request = tmp_result
+        request_id, request = tmp_result[:2]
         transcription_request = request.transcription_request
         forced_decoder_ids = processor.get_decoder_prompt_ids(
             language=transcription_request.language, task="transcribe")
@@ -118,7 +202,9 @@ class ModelWorker:
         if self.waiting_requests.empty():
             return
         tmp_result = await self.waiting_requests.get()
-        request_id, prompt_request = tmp_result
+        request_id, prompt_request = tmp_result[:2]
+        # the prompt is tokenized when it is admitted, if it is queued by `admit`
+        prompt_inputs = tmp_result[2] if len(tmp_result) > 2 else None
         plain_texts = prompt_request.inputs
         input_ids = None
         inputs_embeds = None
@@ -160,17 +246,57 @@ class ModelWorker:
                                                    return_dict=True)
             inputs = inputs.to('xpu')
         else:
-            inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
+            inputs = prompt_inputs
+            if inputs is None:
+                inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
             input_ids = inputs.input_ids.to('xpu')
         parameters = prompt_request.parameters
         return input_ids, parameters, request_id, inputs_embeds, inputs
 
+    def get_kv_cache_bytes(self):
+        """
+        Returns the bytes of the KV cache of the running requests, which is estimated from
+        the model config and their numbers of tokens without continuous batching, or
+        `None` if the config is not known.
+        """
+        if self.scheduler is not None:
+            past_key_values = self.scheduler.past_key_values
+            if past_key_values is None:
+                return 0
+            return sum(cache.untyped_storage().nbytes()
+                       for caches in [past_key_values.key_cache, past_key_values.value_cache]
+                       for cache in list(caches))
+
+        config = getattr(self.model, "config", None)
+        num_layers = getattr(config, "num_hidden_layers", None) or \
+            getattr(config, "num_layers", None)
+        num_heads = getattr(config, "num_attention_heads", None)
+        hidden_size = getattr(config, "hidden_size", None)
+        if num_layers is None or num_heads is None or hidden_size is None:
+            return None
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or \
+            getattr(config, "multi_query_group_num", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or hidden_size // num_heads
+        bytes_per_token = 2 * num_layers * num_kv_heads * head_dim * \
+            torch.finfo(self.dtype).bits // 8
+        num_tokens = sum(streamer.prompt_tokens + streamer.completion_tokens
+                         for streamer in list(self.streamer.values())
+                         if isinstance(streamer, AsyncTextStreamer) and not streamer.ended)
+        return num_tokens * bytes_per_token
+
+    def create_streamer(self, tokenizer, request_id):
+        # the request is finished in `waiting_requests` once its generation ends
+        self.streamer[request_id] = AsyncTextStreamer(
+            tokenizer, asyncio.get_running_loop(),
+            on_end=functools.partial(self.waiting_requests.finish, request_id))
+        return self.streamer[request_id]
+
     @torch.no_grad()
     async def process_step(self, tokenizer, result_dict, processor=None):
         if not self.waiting_requests.empty():
             if processor is not None and "whisper" in self.model_name.lower():
                 input_features, decoder_ids, request_id = await self.add_asr_request(processor)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
+                streamer = self.create_streamer(tokenizer, request_id)
 
                 def model_generate():
                     self.model.generate(input_features,
@@ -179,20 +305,31 @@ class ModelWorker:
             else:
                 input_ids, parameters, request_id, inputs_embeds, inputs = \
                     await self.add_request(tokenizer)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
+                streamer = self.create_streamer(tokenizer, request_id)
+
+                eos_token_id = None
+                if "codegeex" in self.model_name.lower():
+                    eos_token_id = [tokenizer.eos_token_id,
+                                    tokenizer.convert_tokens_to_ids("<|user|>"),
+                                    tokenizer.convert_tokens_to_ids("<|observation|>")]
+                elif "internlm-xcomposer2-vl-7b" in self.model_name.lower():
+                    eos_token_id = [
+                        tokenizer.eos_token_id,
+                        tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
+                    ]
+
+                if self.scheduler is not None and input_ids is not None \
+                        and input_ids.size(0) == 1 \
+                        and "internlm-xcomposer2-vl-7b" not in self.model_name.lower():
+                    if eos_token_id is None:
+                        eos_token_id = self.scheduler.model.generation_config.eos_token_id
+                    self.scheduler.add_request(request_id, input_ids, parameters,
+                                               self.streamer[request_id], eos_token_id)
+                    return
 
                 def model_generate():
                     generate_kwargs = {k: v for k, v in parameters.dict().items() if v is not None}
-                    if "codegeex" in self.model_name.lower():
-                        eos_token_id = [tokenizer.eos_token_id,
-                                        tokenizer.convert_tokens_to_ids("<|user|>"),
-                                        tokenizer.convert_tokens_to_ids("<|observation|>")]
-                        generate_kwargs["eos_token_id"] = eos_token_id
-                    elif "internlm-xcomposer2-vl-7b" in self.model_name.lower():
-                        eos_token_id = [
-                            tokenizer.eos_token_id,
-                            tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
-                        ]
+                    if eos_token_id is not None:
                         generate_kwargs["eos_token_id"] = eos_token_id
                     if input_ids is not None:
                         self.model.generate(input_ids,
@@ -205,6 +342,15 @@ class ModelWorker:
                                             streamer=self.streamer[request_id], **generate_kwargs)
             torch.xpu.empty_cache()
             torch.xpu.synchronize()
+
+            def generate_and_end():
+                try:
+                    model_generate()
+                finally:
+                    # end the stream if generate failed, to finish the request
+                    if not streamer.ended:
+                        streamer.end()
+
             from threading import Thread
-            t1 = Thread(target=model_generate)
+            t1 = Thread(target=generate_and_end)
             t1.start()
@@ -0,0 +1,558 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import torch
+import asyncio
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+from transformers import LogitsProcessorList
+from transformers.cache_utils import DynamicCache
+from transformers.generation.logits_process import (
+    MinNewTokensLengthLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+from transformers.utils import logging
+from ipex_llm.utils.common import invalidInputError
+from .tgi_protocol import Parameters
+logger = logging.get_logger(__name__)
+
+# priority classes of `RequestQueue`, smaller is served first
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+
+
+class SequenceState:
+    """A request being decoded by `ContinuousBatchingScheduler`."""
+    def __init__(self, request_id, input_ids, parameters, streamer, eos_token_id):
+        self.request_id = request_id
+        # 1D prompt token ids on CPU
+        self.input_ids = input_ids
+        self.streamer = streamer
+        self.prompt_len = input_ids.size(0)
+        self.max_new_tokens = parameters.max_new_tokens
+        self.do_sample = bool(parameters.do_sample)
+        self.output_ids: List[int] = []
+
+        if eos_token_id is None:
+            eos_token_id = []
+        elif isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = set(eos_token_id)
+
+        self.logits_processor = LogitsProcessorList()
+        if parameters.repetition_penalty is not None and parameters.repetition_penalty != 1.0:
+            self.logits_processor.append(
+                RepetitionPenaltyLogitsProcessor(parameters.repetition_penalty))
+        if parameters.min_new_tokens and len(eos_token_id) > 0:
+            self.logits_processor.append(
+                MinNewTokensLengthLogitsProcessor(self.prompt_len, parameters.min_new_tokens,
+                                                  list(eos_token_id)))
+        if self.do_sample:
+            if parameters.temperature is not None and parameters.temperature != 1.0:
+                self.logits_processor.append(TemperatureLogitsWarper(parameters.temperature))
+            if parameters.top_k is not None and parameters.top_k != 0:
+                self.logits_processor.append(TopKLogitsWarper(parameters.top_k))
+            if parameters.top_p is not None and parameters.top_p < 1.0:
+                self.logits_processor.append(TopPLogitsWarper(parameters.top_p))
+
+    @property
+    def num_tokens(self) -> int:
+        return self.prompt_len + self.max_new_tokens
+
+    def sample(self, logits: torch.Tensor) -> int:
+        if len(self.logits_processor) > 0:
+            all_ids = torch.cat((self.input_ids,
+                                 torch.tensor(self.output_ids, dtype=self.input_ids.dtype)))
+            logits = self.logits_processor(all_ids.unsqueeze(0).to(logits.device),
+                                           logits.unsqueeze(0).float())[0]
+        if self.do_sample:
+            probs = torch.softmax(logits.float(), dim=-1)
+            return torch.multinomial(probs, num_samples=1).item()
+        else:
+            return torch.argmax(logits, dim=-1).item()
+
+    def append_token(self, token_id: int) -> bool:
+        """Appends a generated token, returns whether this sequence is finished."""
+        self.output_ids.append(token_id)
+        self.streamer.put(torch.tensor([token_id]))
+        return token_id in self.eos_token_id or len(self.output_ids) >= self.max_new_tokens
+
+
+class ContinuousBatchingScheduler:
+    """
+    Iteration-level scheduler which runs all requests in a single decode loop.
+
+    New requests are prefilled and then merged into the running decode batch at step
+    granularity, finished sequences are retired after each step, so that requests
+    never wait for a whole batch to finish. Sequences in the batch are left-padded to
+    a common KV cache length and masked by an attention mask.
+
+    Args:
+        model: the (unwrapped) causal LM, its forward should accept `attention_mask` and
+            `position_ids` and return a `DynamicCache` based `past_key_values`, whose
+            `key_cache` and `value_cache` hold the kv of all tokens.
+        max_num_seqs (`int`): max number of sequences in the running batch.
+        max_num_batched_tokens (`int`): max sum of `prompt_len + max_new_tokens` over all
+            running sequences, `None` means no limit.
+    """
+
+    def __init__(self, model, max_num_seqs: int = 8,
+                 max_num_batched_tokens: Optional[int] = None):
+        self.model = model
+        self.max_num_seqs = max_num_seqs
+        self.max_num_batched_tokens = max_num_batched_tokens
+
+        # requests from other threads
+        self.pending = queue.Queue()
+        # requests fetched by the decode loop but not admitted yet
+        self.waiting: Deque[SequenceState] = deque()
+        self.running: List[SequenceState] = []
+        self.past_key_values = None
+        # [bsz, kv_len], 0 for left padding
+        self.attention_mask = None
+        # [bsz, 1], number of valid tokens in kv cache of each sequence
+        self.position_ids = None
+        # [bsz, 1], the last sampled token of each sequence
+        self.next_input_ids = None
+
+        self.thread = None
+        self.stopped = False
+
+    def add_request(self, request_id, input_ids, parameters, streamer, eos_token_id):
+        """
+        Queues a request, this can be called from any thread.
+        `input_ids` is a `[1, prompt_len]` tensor, generated text is put into `streamer`.
+        """
+        input_ids = input_ids[0].cpu()
+        if parameters is None:
+            parameters = Parameters()
+        streamer.put(input_ids)
+        self.pending.put(SequenceState(request_id, input_ids, parameters, streamer,
+                                       eos_token_id))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.pending.put(None)
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Continuous batching step failed: {e}")
+                self.fail_requests()
+
+    def fail_requests(self):
+        """Ends the streams of all running, waiting and pending requests."""
+        for seq in self.running:
+            seq.streamer.end()
+        self.running = []
+        self.past_key_values = None
+        while len(self.waiting) > 0:
+            self.waiting.popleft().streamer.end()
+        while True:
+            try:
+                seq = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if seq is not None:
+                seq.streamer.end()
+
+    def get_num_batched_tokens(self) -> int:
+        return sum(seq.num_tokens for seq in self.running)
+
+    def can_admit(self, seq: SequenceState) -> bool:
+        if len(self.running) >= self.max_num_seqs:
+            return False
+        if self.max_num_batched_tokens is None or len(self.running) == 0:
+            return True
+        return self.get_num_batched_tokens() + seq.num_tokens <= self.max_num_batched_tokens
+
+    def fetch_requests(self):
+        # block when idle, otherwise only take what is already queued
+        block = len(self.running) == 0 and len(self.waiting) == 0
+        while True:
+            try:
+                seq = self.pending.get(block=block)
+            except queue.Empty:
+                break
+            if seq is None:
+                break
+            self.waiting.append(seq)
+            block = False
+
+    @torch.no_grad()
+    def step(self):
+        self.fetch_requests()
+        # admit in FIFO order
+        while len(self.waiting) > 0 and self.can_admit(self.waiting[0]):
+            seq = self.waiting.popleft()
+            try:
+                self.prefill(seq)
+            except Exception:
+                seq.streamer.end()
+                raise
+
+        if len(self.running) > 0:
+            self.decode()
+
+    def prefill(self, seq: SequenceState):
+        device = self.model.device
+        output = self.model(input_ids=seq.input_ids.unsqueeze(0).to(device),
+                            use_cache=True, return_dict=True)
+        if seq.append_token(seq.sample(output.logits[0, -1, :])):
+            seq.streamer.end()
+            return
+        self.merge(seq, output.past_key_values)
+
+    def merge(self, seq: SequenceState, past_key_values):
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        device = self.model.device
+        new_len = seq.prompt_len
+        # sequences are merged by padding and concatenating `key_cache` and `value_cache`,
+        # which must hold the kv of all tokens, unlike e.g. `DynamicCompressCache`
+        invalidInputError(
+            len(past_key_values.key_cache) > 0 and
+            all(cache.size(2) == new_len
+                for cache in past_key_values.key_cache + past_key_values.value_cache),
+            f"{type(past_key_values).__name__} is not supported by continuous batching, "
+            "its key_cache and value_cache should hold the kv of all tokens.")
+        attention_mask = torch.ones(1, new_len, dtype=torch.int64, device=device)
+        position_ids = torch.tensor([[new_len]], device=device)
+        next_input_ids = torch.tensor([[seq.output_ids[-1]]], device=device)
+
+        if len(self.running) == 0:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.position_ids = position_ids
+            self.next_input_ids = next_input_ids
+            self.running.append(seq)
+            return
+
+        cur_len = self.attention_mask.size(1)
+        kv_len = max(cur_len, new_len)
+        for layer_idx in range(len(self.past_key_values.key_cache)):
+            for caches, new_caches in [(self.past_key_values.key_cache,
+                                        past_key_values.key_cache),
+                                       (self.past_key_values.value_cache,
+                                        past_key_values.value_cache)]:
+                caches[layer_idx] = torch.cat([
+                    left_pad_kv(caches[layer_idx], kv_len - cur_len),
+                    left_pad_kv(new_caches[layer_idx], kv_len - new_len),
+                ], dim=0)
+        self.attention_mask = torch.cat([
+            left_pad_mask(self.attention_mask, kv_len - cur_len),
+            left_pad_mask(attention_mask, kv_len - new_len),
+        ], dim=0)
+        self.position_ids = torch.cat([self.position_ids, position_ids], dim=0)
+        self.next_input_ids = torch.cat([self.next_input_ids, next_input_ids], dim=0)
+        self.running.append(seq)
+
+    def decode(self):
+        self.attention_mask = torch.cat([self.attention_mask,
+                                         torch.ones_like(self.attention_mask[:, :1])], dim=1)
+        output = self.model(input_ids=self.next_input_ids,
+                            attention_mask=self.attention_mask,
+                            position_ids=self.position_ids,
+                            past_key_values=self.past_key_values,
+                            use_cache=True, return_dict=True)
+        self.past_key_values = output.past_key_values
+        self.position_ids = self.position_ids + 1
+
+        logits = output.logits[:, -1, :]
+        next_ids, keep = [], []
+        for idx, seq in enumerate(self.running):
+            token_id = seq.sample(logits[idx])
+            next_ids.append(token_id)
+            if seq.append_token(token_id):
+                seq.streamer.end()
+            else:
+                keep.append(idx)
+        self.next_input_ids = torch.tensor(next_ids, device=self.next_input_ids.device)[:, None]
+
+        if len(keep) < len(self.running):
+            self.retire(keep)
+
+    def retire(self, keep: List[int]):
+        self.running = [self.running[idx] for idx in keep]
+        if len(keep) == 0:
+            self.past_key_values = None
+            self.attention_mask = None
+            self.position_ids = None
+            self.next_input_ids = None
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the left padding columns shared by all remaining sequences
+        start = int((attention_mask.sum(dim=0) == 0).int().argmin())
+        self.attention_mask = attention_mask[:, start:]
+        self.position_ids = self.position_ids.index_select(0, index)
+        self.next_input_ids = self.next_input_ids.index_select(0, index)
+        for caches in [self.past_key_values.key_cache, self.past_key_values.value_cache]:
+            for layer_idx in range(len(caches)):
+                # kv cache must start at storage offset 0, see `append_kv_cache`
+                caches[layer_idx] = caches[layer_idx].index_select(
+                    0, index.to(caches[layer_idx].device))[:, :, start:, :].contiguous()
+
+
+class QueuedRequest:
+    """A request admitted by `RequestQueue`."""
+    def __init__(self, request_id, item, priority, cost, deadline):
+        self.request_id = request_id
+        self.item = item
+        self.priority = priority
+        self.cost = cost
+        # `time.monotonic()` to finish by, `None` for no deadline
+        self.deadline = deadline
+        self.arrival_time = time.monotonic()
+        self.start_time = None
+        self.removed = False
+
+
+class RequestQueue:
+    """
+    Queue of the waiting requests of a model worker with admission control, which can be
+    used in place of its `asyncio.Queue`.
+
+    Requests are served by priority class, "interactive" before "batch", then in arrival
+    order. `empty()` is true while `max_running` requests are started and not finished,
+    so that the worker leaves the requests beyond its batch waiting here, by priority,
+    instead of in its own FIFO. A request is finished by `finish(request_id)`.
+
+    A request is rejected by `admit` when `max_queue_size` requests are waiting, or when
+    it is estimated to finish after its deadline. The cost of a request is estimated as
+    `prompt_len * max_new_tokens`, and the worker throughput in cost per second is learned
+    from the finished requests, so a request is estimated to finish when the requests
+    running and waiting ahead of it, and itself, are done at that throughput.
+
+    Args:
+        max_queue_size (`int`): max number of waiting requests, `None` means no limit.
+        max_running (`int`): max number of started and unfinished requests, `None` means
+            no limit.
+        default_timeout (`float`): seconds to finish in of the requests which do not set
+            one, `None` means no deadline.
+    """
+
+    def __init__(self, max_queue_size: Optional[int] = None, max_running: Optional[int] = None,
+                 default_timeout: Optional[float] = None):
+        self.max_queue_size = max_queue_size
+        self.max_running = max_running
+        self.default_timeout = default_timeout
+        # (priority, arrival order, request), removed requests are skipped when popped
+        self.heap = []
+        self.counter = itertools.count()
+        self.waiting: Dict[Any, QueuedRequest] = {}
+        self.running: Dict[Any, QueuedRequest] = {}
+        self.not_empty = asyncio.Event()
+        # called when a request finishes, e.g. to wake up the serving loop
+        self.on_release = None
+
+        # decayed sums of finished cost and busy time, for the throughput estimate
+        self.finished_cost = 0.0
+        self.busy_time = 0.0
+        self.last_update = time.monotonic()
+
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.num_shed = 0
+        self.num_started = 0
+        self.num_finished = 0
+        self.wait_time_sum = 0.0
+
+    def qsize(self) -> int:
+        return len(self.waiting)
+
+    def empty(self) -> bool:
+        """Whether no request can be started now."""
+        return len(self.waiting) == 0 or \
+            (self.max_running is not None and len(self.running) >= self.max_running)
+
+    def throughput(self) -> Optional[float]:
+        """Cost finished per second while any request runs, `None` before any finishes."""
+        if self.finished_cost <= 0 or self.busy_time <= 0:
+            return None
+        return self.finished_cost / self.busy_time
+
+    def estimate_finish_time(self, priority: int, cost: float) -> Optional[float]:
+        """Seconds until a new request of `priority` and `cost` would finish."""
+        rate = self.throughput()
+        if rate is None:
+            return None
+        now = time.monotonic()
+        ahead = sum(request.cost for request in self.waiting.values()
+                    if request.priority <= priority)
+        if len(self.running) > 0:
+            # running requests share the throughput
+            share = rate / len(self.running)
+            ahead += sum(max(request.cost - (now - request.start_time) * share, 0)
+                         for request in self.running.values())
+        return (ahead + cost) / rate
+
+    def admit(self, request_id, item, priority: str = "interactive", cost: float = 0,
+              timeout: Optional[float] = None) -> Optional[str]:
+        """
+        Queues `item` unless the request is rejected, returns the reason of the rejection
+        or `None`. `timeout` is the seconds the request should finish in.
+        """
+        invalidInputError(priority in PRIORITY_CLASSES,
+                          f"priority should be one of {list(PRIORITY_CLASSES)}")
+        priority = PRIORITY_CLASSES[priority]
+        if self.max_queue_size is not None and len(self.waiting) >= self.max_queue_size:
+            self.num_rejected += 1
+            return f"{len(self.waiting)} requests are waiting"
+        if timeout is None:
+            timeout = self.default_timeout
+        deadline = None
+        if timeout is not None:
+            estimate = self.estimate_finish_time(priority, cost)
+            if estimate is not None and estimate > timeout:
+                self.num_rejected += 1
+                return f"estimated to finish in {estimate:.1f}s, after its timeout {timeout}s"
+            deadline = time.monotonic() + timeout
+        self.push(QueuedRequest(request_id, item, priority, cost, deadline))
+        self.num_admitted += 1
+        return None
+
+    def push(self, request: QueuedRequest):
+        heapq.heappush(self.heap, (request.priority, next(self.counter), request))
+        self.waiting[request.request_id] = request
+        self.not_empty.set()
+
+    async def put(self, item):
+        """Queues a `(request_id, request)` item as `asyncio.Queue.put`, without checks."""
+        self.push(QueuedRequest(item[0], item, PRIORITY_CLASSES["interactive"], 0, None))
+        self.num_admitted += 1
+
+    def start_next(self):
+        """Starts the next waiting request and returns its item, `None` if none waits."""
+        while len(self.heap) > 0:
+            _, _, request = heapq.heappop(self.heap)
+            if request.removed:
+                continue
+            del self.waiting[request.request_id]
+            if len(self.waiting) == 0:
+                self.not_empty.clear()
+            self.update_busy_time()
+            request.start_time = time.monotonic()
+            self.running[request.request_id] = request
+            self.num_started += 1
+            self.wait_time_sum += request.start_time - request.arrival_time
+            return request.item
+        return None
+
+    async def get(self):
+        while len(self.waiting) == 0:
+            await self.not_empty.wait()
+        return self.start_next()
+
+    def time_to_start(self, request_id) -> Optional[float]:
+        """
+        Seconds left for a waiting request to start to finish before its deadline,
+        `None` if it is not waiting or has no deadline.
+        """
+        request = self.waiting.get(request_id, None)
+        if request is None or request.deadline is None:
+            return None
+        rate = self.throughput()
+        service_time = request.cost / rate if rate is not None else 0
+        return request.deadline - service_time - time.monotonic()
+
+    def remove(self, request_id, shed: bool = False) -> bool:
+        """Removes a waiting request, returns whether it was waiting."""
+        request = self.waiting.pop(request_id, None)
+        if request is None:
+            return False
+        request.removed = True
+        if len(self.waiting) == 0:
+            self.not_empty.clear()
+        if shed:
+            self.num_shed += 1
+        return True
+
+    def finish(self, request_id):
+        """Marks a started request as finished, so that another one can start."""
+        if request_id not in self.running:
+            return
+        self.update_busy_time()
+        request = self.running.pop(request_id)
+        # decay the past, so that the estimate follows the current load
+        self.finished_cost = self.finished_cost * 0.9 + request.cost
+        self.busy_time *= 0.9
+        self.num_finished += 1
+        if self.on_release is not None:
+            self.on_release()
+
+    def update_busy_time(self):
+        now = time.monotonic()
+        if len(self.running) > 0:
+            self.busy_time += now - self.last_update
+        self.last_update = now
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth, wait time and admission counters, e.g. for autoscaling."""
+        now = time.monotonic()
+        num_waiting = {name: 0 for name in PRIORITY_CLASSES}
+        names = {priority: name for name, priority in PRIORITY_CLASSES.items()}
+        for request in self.waiting.values():
+            num_waiting[names[request.priority]] += 1
+        throughput = self.throughput()
+        estimated_wait_time = self.estimate_finish_time(PRIORITY_CLASSES["batch"], 0)
+        return {
+            "num_waiting": len(self.waiting),
+            "num_waiting_by_priority": num_waiting,
+            "num_running": len(self.running),
+            "num_admitted": self.num_admitted,
+            "num_rejected": self.num_rejected,
+            "num_shed": self.num_shed,
+            "num_started": self.num_started,
+            "num_finished": self.num_finished,
+            "wait_time_sum": self.wait_time_sum,
+            "mean_wait_time": self.wait_time_sum / max(self.num_started, 1),
+            "max_wait_time": max((now - request.arrival_time
+                                  for request in self.waiting.values()), default=0.0),
+            "estimated_wait_time": estimated_wait_time,
+            "throughput": throughput,
+        }
+
+
+def left_pad_kv(cache: torch.Tensor, pad_len: int) -> torch.Tensor:
+    if pad_len == 0:
+        return cache
+    bsz, num_heads, _, head_dim = cache.shape
+    padding = torch.zeros(bsz, num_heads, pad_len, head_dim,
+                          dtype=cache.dtype, device=cache.device)
+    return torch.cat([padding, cache], dim=2)
+
+
+def left_pad_mask(attention_mask: torch.Tensor, pad_len: int) -> torch.Tensor:
+    if pad_len == 0:
+        return attention_mask
+    return torch.cat([attention_mask.new_zeros(attention_mask.size(0), pad_len),
+                      attention_mask], dim=1)
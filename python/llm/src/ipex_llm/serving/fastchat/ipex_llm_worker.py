@@ -23,6 +23,7 @@ import os
 import torch
 import torch.nn.functional as F
 import gc
+import base64
 import argparse
 import asyncio
 import atexit
@@ -142,14 +143,58 @@ class BigDLLLMWorker(BaseModelWorker):
 
         return sum_embeddings, token_num
 
-    @torch.inference_mode()
+    def __encode_base64(self, embeddings: torch.Tensor) -> List[str]:
+        embeddings = embeddings.cpu()
+        return [
+            base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
+        ]
+
     def get_embeddings(self, params):
-        self.call_ct += 1
+        return self.get_embeddings_batch([params])[0]
+
+    def tokenize_embedding_inputs(self, params) -> List[List[int]]:
+        """Returns the token ids of the inputs of an embedding request."""
+        if self.embed_in_truncate:
+            encoding = self.tokenizer(
+                params["input"],
+                truncation="longest_first",
+                max_length=self.context_len,
+            )
+        else:
+            encoding = self.tokenizer(params["input"])
+        return encoding["input_ids"]
+
+    @torch.inference_mode()
+    def get_embeddings_batch(self, params_list: List[dict],
+                             input_ids_list: List[List[List[int]]]=None) -> List[dict]:
+        """
+        Encodes the inputs of several embedding requests in one padded batch, and
+        returns the result of each request as `get_embeddings` returns it.
+        `input_ids_list` is the token ids of each request from
+        `tokenize_embedding_inputs`, the requests are tokenized here if it is `None`.
+        """
+        self.call_ct += len(params_list)
 
         try:
             # Get tokenizer
             tokenizer = self.tokenizer
-            ret = {"embedding": [], "token_num": 0}
+            if input_ids_list is None:
+                input_ids_list = [self.tokenize_embedding_inputs(params)
+                                  for params in params_list]
+            # index of the request of each input
+            request_index = torch.repeat_interleave(
+                torch.arange(len(params_list)),
+                torch.tensor([len(input_ids) for input_ids in input_ids_list]),
+            ).to(self.device)
+            use_cls_pooling = (
+                hasattr(self.model, "use_cls_pooling") and self.model.use_cls_pooling
+            )
+
+            def request_token_num(token_num):
+                # number of tokens of the request of each input
+                return torch.zeros(
+                    len(params_list), dtype=token_num.dtype, device=token_num.device
+                ).index_add_(0, request_index, token_num)
 
             # Based on conditions of different model_type
             model_type_dict = {
@@ -160,35 +205,23 @@ class BigDLLLMWorker(BaseModelWorker):
                 "is_robert": "robert" in str(type(self.model)),
             }
 
-            if self.embed_in_truncate:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"],
-                    padding=True,
-                    truncation="longest_first",
-                    return_tensors="pt",
-                    max_length=self.context_len,
-                )
-            else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
-                )
+            encoding = tokenizer.pad(
+                {"input_ids": [ids for input_ids in input_ids_list for ids in input_ids]},
+                padding=True,
+                return_tensors="pt",
+            )
             input_ids = encoding["input_ids"].to(self.device)
             # Check if we need attention_mask or not.
             attention_mask = input_ids != tokenizer.pad_token_id
 
-            base64_encode = params.get("encoding_format", None)
-
             if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
+                embedding, _ = self.__process_embed_chunk(
                     input_ids, attention_mask, **model_type_dict
                 )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
-                ):
-                    embedding = embedding / token_num
+                all_token_num = request_token_num(attention_mask.sum(dim=1))
+                if not use_cls_pooling:
+                    embedding = embedding / all_token_num[request_index].unsqueeze(-1)
                 normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
             else:
                 all_embeddings = []
                 all_token_num = 0
@@ -197,10 +230,7 @@ class BigDLLLMWorker(BaseModelWorker):
                     chunk_attention_mask = attention_mask[:, i:i + self.context_len]
 
                     # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
+                    if use_cls_pooling:
                         cls_tokens = (
                             torch.zeros(
                                 (chunk_input_ids.size(0), 1),
@@ -212,38 +242,43 @@ class BigDLLLMWorker(BaseModelWorker):
                         chunk_input_ids = torch.cat(
                             [cls_tokens, chunk_input_ids], dim=-1
                         )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
+                        # inputs shorter than the batch have no cls token in their
+                        # chunks of only padding
+                        mask = chunk_attention_mask.any(dim=1, keepdim=True).to(
+                            chunk_attention_mask.dtype
                         )
                         chunk_attention_mask = torch.cat(
                             [mask, chunk_attention_mask], dim=-1
                         )
 
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
+                    chunk_embeddings, _ = self.__process_embed_chunk(
                         chunk_input_ids, chunk_attention_mask, **model_type_dict
                     )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
+                    # weight the chunks of each request by its number of tokens in them,
+                    # as if the request was encoded alone
+                    token_num = request_token_num(chunk_attention_mask.sum(dim=1))
+                    if use_cls_pooling:
+                        all_embeddings.append(
+                            chunk_embeddings * token_num[request_index].unsqueeze(-1)
+                        )
                     else:
                         all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
+                    all_token_num = all_token_num + token_num
 
                 all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
+                embedding = (torch.sum(all_embeddings_tensor, dim=0) /
+                             all_token_num[request_index].unsqueeze(-1))
                 normalized_embeddings = F.normalize(embedding, p=2, dim=1)
 
-                ret["token_num"] = all_token_num
-
-            if base64_encode == "base64":
-                out_embeddings = self.__encode_base64(normalized_embeddings)
-            else:
-                out_embeddings = normalized_embeddings.tolist()
-            ret["embedding"] = out_embeddings
+            rets = []
+            all_token_num = all_token_num.tolist()
+            for idx, params in enumerate(params_list):
+                request_embeddings = normalized_embeddings[request_index == idx]
+                if params.get("encoding_format", None) == "base64":
+                    out_embeddings = self.__encode_base64(request_embeddings)
+                else:
+                    out_embeddings = request_embeddings.tolist()
+                rets.append({"embedding": out_embeddings, "token_num": all_token_num[idx]})
 
             gc.collect()
             torch.cuda.empty_cache()
@@ -251,17 +286,20 @@ class BigDLLLMWorker(BaseModelWorker):
                 torch.xpu.empty_cache()
             if self.device == "npu":
                 torch.npu.empty_cache()
-        except torch.cuda.OutOfMemoryError as e:
-            ret = {
-                "text": f"{SERVER_ERROR_MSG}\n\n({e})",
-                "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
-            }
         except (ValueError, RuntimeError) as e:
-            ret = {
+            if len(params_list) > 1:
+                # Encode the requests one by one, so that an invalid or too large
+                # request does not fail the other requests of the batch
+                return [self.get_embeddings(params) for params in params_list]
+            if isinstance(e, torch.cuda.OutOfMemoryError):
+                error_code = ErrorCode.CUDA_OUT_OF_MEMORY
+            else:
+                error_code = ErrorCode.INTERNAL_ERROR
+            rets = [{
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
-                "error_code": ErrorCode.INTERNAL_ERROR,
-            }
-        return ret
+                "error_code": error_code,
+            }]
+        return rets
 
     def generate_stream_gate(self, params):
         self.call_ct += 1
@@ -420,6 +458,97 @@ class BigDLLLMWorker(BaseModelWorker):
         return json.loads(x[:-1].decode())
 
 
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests of a worker into padded batches.
+
+    A batch starts with the oldest waiting request, and takes the requests which arrive
+    within `max_wait_ms` after it, until it has `max_batch_size` inputs or its padded
+    batch has `max_batch_tokens` tokens. Requests which arrive while a batch runs form
+    the next batch, so a larger `max_wait_ms` only trades the latency of a request
+    arriving at an idle worker for larger batches.
+    """
+
+    def __init__(self, worker, max_wait_ms: float = 2, max_batch_size: int = 64,
+                 max_batch_tokens: int = 16384):
+        self.worker = worker
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = None
+        self.pending = None
+        self.batch_task = None
+
+    async def submit(self, params):
+        if self.batch_task is None:
+            self.queue = asyncio.Queue()
+            self.batch_task = asyncio.create_task(self.batch_loop())
+        future = asyncio.get_running_loop().create_future()
+        # tokenize off the event loop, the batch is encoded from these token ids
+        input_ids = await asyncio.to_thread(self.worker.tokenize_embedding_inputs, params)
+        max_len = max((len(ids) for ids in input_ids), default=0)
+        self.queue.put_nowait((params, input_ids, max_len, future))
+        return await future
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        if self.pending is None:
+            self.pending = await self.queue.get()
+        batch = [self.pending]
+        self.pending = None
+        _, input_ids, max_len, _ = batch[0]
+        num_inputs = len(input_ids)
+        deadline = loop.time() + self.max_wait
+        while num_inputs < self.max_batch_size:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            _, item_input_ids, item_len, _ = item
+            item_inputs = len(item_input_ids)
+            if (num_inputs + item_inputs > self.max_batch_size or
+                    (num_inputs + item_inputs) * max(max_len, item_len) >
+                    self.max_batch_tokens):
+                self.pending = item
+                break
+            batch.append(item)
+            num_inputs += item_inputs
+            max_len = max(max_len, item_len)
+        return batch
+
+    async def run_batch(self, batch):
+        try:
+            rets = await asyncio.to_thread(
+                self.worker.get_embeddings_batch,
+                [params for params, _, _, _ in batch],
+                [input_ids for _, input_ids, _, _ in batch],
+            )
+        except Exception as e:
+            if len(batch) > 1:
+                # an invalid request only fails itself
+                for item in batch:
+                    await self.run_batch([item])
+                return
+            _, _, _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, _, _, future), ret in zip(batch, rets):
+            # the client may have disconnected
+            if not future.done():
+                future.set_result(ret)
+
+    async def batch_loop(self):
+        while True:
+            await self.run_batch(await self.next_batch())
+
+
 # Below are api interfaces
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
@@ -448,8 +577,10 @@ async def api_get_status(request: Request):
 async def api_get_embeddings(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
-    release_worker_semaphore()
+    try:
+        embedding = await embedding_batcher.submit(params)
+    finally:
+        release_worker_semaphore()
     return JSONResponse(content=embedding)
 
 
@@ -518,6 +649,24 @@ if __name__ == "__main__":
         help="Load models that have been converted/saved using ipex-llm's save_low_bit interface",
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--embed-max-wait-ms",
+        type=float,
+        default=2,
+        help="Time to wait for concurrent embedding requests to batch together",
+    )
+    parser.add_argument(
+        "--embed-max-batch-size",
+        type=int,
+        default=64,
+        help="Maximum number of embedding inputs in a batch",
+    )
+    parser.add_argument(
+        "--embed-max-batch-tokens",
+        type=int,
+        default=16384,
+        help="Maximum number of padded tokens in a batch of embedding inputs",
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -538,4 +687,10 @@ if __name__ == "__main__":
         args.stream_interval,
         args.benchmark,
     )
+    embedding_batcher = EmbeddingBatcher(
+        worker,
+        args.embed_max_wait_ms,
+        args.embed_max_batch_size,
+        args.embed_max_batch_tokens,
+    )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
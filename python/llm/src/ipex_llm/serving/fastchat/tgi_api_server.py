@@ -31,6 +31,7 @@ import asyncio
 import argparse
 import json
 import os
+import time
 from typing import Generator, Optional, Union, Dict, List, Any
 
 import aiohttp
@@ -40,7 +41,6 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-import httpx
 
 try:
     from pydantic.v1 import BaseSettings
@@ -93,12 +93,28 @@ from fastchat.utils import build_logger
 logger = build_logger("tgi_api_server", "tgi_api_server.log")
 
 conv_template_map = {}
+# (worker address, model name) -> context length of the model
+context_length_map = {}
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
+# session shared by all requests, so that connections to the controller and workers
+# are kept alive instead of opened for every call
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=app_settings.max_connections,
+                                         limit_per_host=app_settings.max_connections_per_host,
+                                         keepalive_timeout=app_settings.keepalive_timeout)
+        _session = aiohttp.ClientSession(timeout=fetch_timeout, connector=connector)
+    return _session
+
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
+    try:
+        async with get_session().post(url, json=pload) as response:
             chunks = []
             if response.status != 200:
                 ret = {
@@ -109,7 +125,11 @@ async def fetch_remote(url, pload=None, name=None):
 
             async for chunk, _ in response.content.iter_chunks():
                 chunks.append(chunk)
-        output = b"".join(chunks)
+    except aiohttp.ClientConnectionError:
+        # the worker may be gone, ask the controller for workers of its models again
+        worker_address_cache.invalidate_worker(url.rsplit("/", 1)[0])
+        raise
+    output = b"".join(chunks)
 
     if name is not None:
         res = json.loads(output)
@@ -120,18 +140,156 @@ async def fetch_remote(url, pload=None, name=None):
     return output
 
 
+class WorkerInfo:
+    def __init__(self, speed=1, queue_length=0):
+        self.speed = speed
+        self.queue_length = queue_length
+        # requests dispatched to this worker since its last status
+        self.dispatched = 0
+
+    @property
+    def load(self):
+        return (self.queue_length + self.dispatched) / max(self.speed, 1e-6)
+
+
+class WorkerAddressCache:
+    """
+    Model list and worker addresses of each model, refreshed from the controller every
+    `ttl` seconds in background instead of at every request.
+
+    Workers of a model are discovered by asking the controller for a worker address,
+    and their queue lengths are read from their `/worker_get_status`, as the controller
+    receives them in heartbeats. A request goes to the worker with the shortest queue
+    (`dispatch_method="shortest_queue"`) or to the workers in turn ("round_robin").
+    A worker which fails its status or a request is removed with its cached conversation
+    templates and context lengths.
+    """
+
+    def __init__(self, ttl: float = 10, dispatch_method: str = "shortest_queue"):
+        self.ttl = ttl
+        self.dispatch_method = dispatch_method
+        self.models: Optional[List[str]] = None
+        self.models_time = 0.0
+        # model name -> {worker address -> WorkerInfo}
+        self.workers: Dict[str, Dict[str, WorkerInfo]] = {}
+        self.workers_time: Dict[str, float] = {}
+        self.round_robin_index: Dict[str, int] = {}
+        self.refresh_task = None
+
+    def is_stale(self, refresh_time: float) -> bool:
+        return time.monotonic() - refresh_time > self.ttl
+
+    async def list_models(self, refresh=False) -> List[str]:
+        if refresh or self.models is None or self.is_stale(self.models_time):
+            controller_address = app_settings.controller_address
+            if refresh:
+                await fetch_remote(controller_address + "/refresh_all_workers")
+            self.models = await fetch_remote(controller_address + "/list_models", None,
+                                             "models")
+            self.models_time = time.monotonic()
+        return self.models
+
+    async def refresh_model(self, model_name: str):
+        controller_address = app_settings.controller_address
+        worker_addr = await fetch_remote(
+            controller_address + "/get_worker_address", {"model": model_name}, "address"
+        )
+        workers = self.workers.setdefault(model_name, {})
+        if worker_addr != "" and worker_addr not in workers:
+            workers[worker_addr] = WorkerInfo()
+
+        async def get_status(worker_addr):
+            try:
+                return await fetch_remote(worker_addr + "/worker_get_status", None, "")
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                return None
+
+        addresses = list(workers.keys())
+        statuses = await asyncio.gather(*[get_status(addr) for addr in addresses])
+        for worker_addr, status in zip(addresses, statuses):
+            if not isinstance(status, dict) or model_name not in status.get("model_names", []):
+                self.invalidate_worker(worker_addr)
+                continue
+            worker = workers.get(worker_addr, None)
+            if worker is not None:
+                worker.speed = status.get("speed", 1)
+                worker.queue_length = status.get("queue_length", 0)
+                worker.dispatched = 0
+        self.workers_time[model_name] = time.monotonic()
+
+    async def get_worker_address(self, model_name: str) -> str:
+        workers = self.workers.get(model_name, None)
+        if not workers or self.is_stale(self.workers_time.get(model_name, 0.0)):
+            await self.refresh_model(model_name)
+            workers = self.workers.get(model_name, None)
+        # No available worker
+        if not workers:
+            raise ValueError(f"No available worker for {model_name}")
+
+        addresses = list(workers.keys())
+        if self.dispatch_method == "round_robin":
+            index = self.round_robin_index.get(model_name, 0) % len(addresses)
+            self.round_robin_index[model_name] = index + 1
+            worker_addr = addresses[index]
+        else:
+            worker_addr = min(addresses, key=lambda addr: workers[addr].load)
+        workers[worker_addr].dispatched += 1
+        return worker_addr
+
+    def invalidate_worker(self, worker_addr: str):
+        for workers in self.workers.values():
+            workers.pop(worker_addr, None)
+        for cache in [conv_template_map, context_length_map]:
+            for key in [key for key in cache if key[0] == worker_addr]:
+                cache.pop(key, None)
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            try:
+                await self.list_models(refresh=True)
+                for model_name in list(self.workers.keys()):
+                    await self.refresh_model(model_name)
+            except Exception as e:
+                logger.warning(f"Failed to refresh worker addresses: {e}")
+
+
 class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # connection pool of the session to the controller and workers
+    max_connections: int = 1000
+    max_connections_per_host: int = 0
+    keepalive_timeout: float = 60
+    # seconds to cache the model list and worker addresses for
+    worker_address_ttl: float = 10
+    # "shortest_queue" or "round_robin"
+    worker_dispatch_method: str = "shortest_queue"
 
 
 app_settings = AppSettings()
+worker_address_cache = WorkerAddressCache()
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
 
 
+@app.on_event("startup")
+async def startup_event():
+    worker_address_cache.ttl = app_settings.worker_address_ttl
+    worker_address_cache.dispatch_method = app_settings.worker_dispatch_method
+    worker_address_cache.refresh_task = asyncio.create_task(worker_address_cache.refresh_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if worker_address_cache.refresh_task is not None:
+        worker_address_cache.refresh_task.cancel()
+    if _session is not None:
+        await _session.close()
+
+
 async def check_api_key(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(get_bearer_token),
 ) -> str:
@@ -165,10 +323,9 @@ async def validation_exception_handler(request, exc):
 
 
 async def check_model(request) -> Optional[JSONResponse]:
-    controller_address = app_settings.controller_address
     ret = None
 
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    models = await worker_address_cache.list_models()
     if request.model not in models:
         ret = create_error_response(
             ErrorCode.INVALID_MODEL,
@@ -183,9 +340,12 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
+    context_len = context_length_map.get((worker_addr, request.model))
+    if context_len is None:
+        context_len = await fetch_remote(
+            worker_addr + "/model_details", {"model": request.model}, "context_length"
+        )
+        context_length_map[(worker_addr, request.model)] = context_len
     token_num = await fetch_remote(
         worker_addr + "/count_token",
         {"model": request.model, "prompt": prompt},
@@ -392,17 +552,10 @@ async def get_worker_address(model_name: str) -> str:
     Get worker address based on the requested model
 
     :param model_name: The worker's model name
-    :return: Worker address from the controller
+    :return: Worker address from the controller, cached by `worker_address_cache`
     :raises: :class:`ValueError`: No available worker for requested model
     """
-    controller_address = app_settings.controller_address
-    worker_addr = await fetch_remote(
-        controller_address + "/get_worker_address", {"model": model_name}, "address"
-    )
-
-    # No available worker
-    if worker_addr == "":
-        raise ValueError(f"No available worker for {model_name}")
+    worker_addr = await worker_address_cache.get_worker_address(model_name)
     logger.debug(f"model_name: {model_name}, worker_addr: {worker_addr}")
     return worker_addr
 
@@ -418,11 +571,7 @@ async def get_conv(model_name: str, worker_addr: str):
 
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
 async def show_available_models():
-    controller_address = app_settings.controller_address
-    ret = await fetch_remote(controller_address + "/refresh_all_workers")
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
- 
-    models.sort()
+    models = sorted(await worker_address_cache.list_models(refresh=True))
     # TODO: return real model permission details
     model_cards = []
     for m in models:
@@ -430,8 +579,8 @@ async def show_available_models():
     return ModelList(data=model_cards)
 
 async def get_last_model_name_from_list():
-    models = await show_available_models()
-    return models.data[-1].id
+    models = sorted(await worker_address_cache.list_models())
+    return models[-1]
 
 @app.post("/generate", dependencies=[Depends(check_api_key)])
 async def create_chat_completion(request: ChatCompletionRequest):
@@ -608,25 +757,21 @@ async def chat_completion_stream_generator(
     yield "data: [DONE]\n\n"
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            buffer = b""
-            async for raw_chunk in response.aiter_raw():
-                buffer += raw_chunk
-                while (chunk_end := buffer.find(delimiter)) >= 0:
-                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
-                    if not chunk:
-                        continue
-                    yield json.loads(chunk.decode())
+    delimiter = b"\0"
+    async with get_session().post(
+        worker_addr + "/worker_generate_stream",
+        headers=headers,
+        json=payload,
+        timeout=aiohttp.ClientTimeout(total=WORKER_API_TIMEOUT),
+    ) as response:
+        buffer = b""
+        async for raw_chunk in response.content.iter_any():
+            buffer += raw_chunk
+            while (chunk_end := buffer.find(delimiter)) >= 0:
+                chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                if not chunk:
+                    continue
+                yield json.loads(chunk.decode())
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
@@ -661,6 +806,25 @@ def create_openai_api_server():
         type=lambda s: s.split(","),
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--worker-address-ttl",
+        type=float,
+        default=10,
+        help="Seconds to cache the model list and worker addresses from the controller for",
+    )
+    parser.add_argument(
+        "--worker-dispatch-method",
+        type=str,
+        choices=["shortest_queue", "round_robin"],
+        default="shortest_queue",
+        help="How to choose among the workers of a model",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=1000,
+        help="Max number of pooled connections to the controller and workers",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -679,6 +843,9 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    app_settings.worker_address_ttl = args.worker_address_ttl
+    app_settings.worker_dispatch_method = args.worker_dispatch_method
+    app_settings.max_connections = args.max_connections
 
     logger.info(f"args: {args}")
     return args
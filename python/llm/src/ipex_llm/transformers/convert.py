@@ -36,6 +36,7 @@
 
 
 import platform
+import contextlib
 import torch
 import torch.distributed
 import torch.nn as nn
@@ -52,6 +53,9 @@ from typing import List, Optional, Tuple, Union
 from types import MethodType
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 _IS_VLLM_AVAILABLE = None
 _USE_VLLM = False
@@ -466,6 +470,64 @@ def use_scale_search(model_config, qtype):
     return False
 
 
+# weights being quantized at the same time per convert thread, in float32 bytes
+CONVERT_INFLIGHT_BYTES_PER_THREAD = 1024 ** 3
+
+
+def get_convert_threads(convert_threads=None):
+    if convert_threads is None:
+        convert_threads = int(os.environ.get("IPEX_LLM_CONVERT_THREADS", "1"))
+    return max(convert_threads, 1)
+
+
+class QuantizeJobPool:
+    """
+    Quantize `FP4Params` on a thread pool, ggml quantization is a C call which releases
+    the GIL. Each weight is quantized exactly as in serial conversion. Jobs are only
+    submitted while at most `max_inflight_bytes` (as float32) are queued or running, so
+    that the float32 copies made by `FP4Params.quantize` are bounded.
+    All jobs are finished when leaving the `with` block.
+    """
+
+    def __init__(self, num_threads, max_inflight_bytes=None):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads,
+                                           thread_name_prefix="ipex_llm_convert")
+        if max_inflight_bytes is None:
+            max_inflight_bytes = num_threads * CONVERT_INFLIGHT_BYTES_PER_THREAD
+        self.max_inflight_bytes = max_inflight_bytes
+        self.inflight_bytes = 0
+        self.cond = threading.Condition()
+        self.futures = []
+
+    def submit(self, param, device):
+        nbytes = param.numel() * 4
+        with self.cond:
+            # a weight larger than the limit runs alone
+            self.cond.wait_for(lambda: self.inflight_bytes == 0 or
+                               self.inflight_bytes + nbytes <= self.max_inflight_bytes)
+            self.inflight_bytes += nbytes
+        future = self.executor.submit(param.quantize, device)
+        future.add_done_callback(partial(self._release, nbytes))
+        self.futures.append(future)
+
+    def _release(self, nbytes, future):
+        with self.cond:
+            self.inflight_bytes -= nbytes
+            self.cond.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                for future in self.futures:
+                    future.result()
+        finally:
+            self.executor.shutdown(wait=True)
+            self.futures = []
+
+
 def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  convert_shape_only=False,
                                  cpu_embedding=False,
@@ -475,6 +537,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  mixed_precision=False,
                                  act_order=False,
                                  enable_scale_search=False,
+                                 quantize_pool=None,
                                  ):
     from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
         FP16Linear, BF16Linear
@@ -496,7 +559,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
             model._modules[name] = model._modules["transformer"]._modules["output_layer"]
             continue
 
-        if is_linear and not isinstance(module, LowBitLinear):
+        if is_linear and not isinstance(module, (LowBitLinear, FP16Linear, BF16Linear)):
             in_features, out_features, mp_group = linear_args
             optimize_lm_head = (
                 is_lm_head(name, model_config, out_features)
@@ -653,7 +716,12 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                              qtype=cur_qtype,
                                              imatrix=cur_imatrix,
                                              in_features=in_features,
-                                             enable_scale_search=enable_scale_search).to(device)
+                                             enable_scale_search=enable_scale_search)
+                    if quantize_pool is not None and device.type == "cpu" and not _USE_VLLM:
+                        # quantized in place by `quantize_pool`, vLLM linears stay serial
+                        quantize_pool.submit(paramsLowBit, device.type)
+                    else:
+                        paramsLowBit = paramsLowBit.to(device)
                     new_linear._parameters['weight'] = paramsLowBit
                     if module.bias is not None:
                         new_linear._parameters['bias'] = nn.Parameter(module.bias.data)\
@@ -743,6 +811,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                 mixed_precision=mixed_precision,
                 act_order=act_order,
                 enable_scale_search=enable_scale_search,
+                quantize_pool=quantize_pool,
             )
             has_been_replaced = _flag or has_been_replaced
     return model, has_been_replaced
@@ -883,6 +952,71 @@ def replace_with_low_bit_linear_for_module(model, qtype, module_name=None,
     return model
 
 
+def replace_with_quantized_linear_for_module(model, qtype, module_name, weight):
+    """
+    Replace the bias-free linear of `module_name` (e.g. `model.layers.0.mlp.up_proj.weight`)
+    with a `LowBitLinear` whose weight is `weight`, which is already quantized to `qtype`
+    in its CPU layout (e.g. ggml q4_0 blocks for sym_int4).
+    """
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params
+
+    linear_name = module_name.rsplit(".", 1)[0]
+    parent_name, _, child_name = linear_name.rpartition(".")
+    parent_module = model.get_submodule(parent_name)
+    module = parent_module._modules[child_name]
+    invalidInputError(isinstance(module, nn.Linear) and module.bias is None,
+                      f"{linear_name} should be a linear without bias")
+
+    with init_empty_weights():
+        new_linear = LowBitLinear(module.in_features, module.out_features, qtype, bias=False)
+    new_linear._parameters['weight'] = FP4Params(data=weight.reshape(-1),
+                                                 requires_grad=False,
+                                                 quantized=True,
+                                                 _shape=(module.out_features, module.in_features),
+                                                 qtype=qtype)
+    if not module.training:
+        new_linear.eval()
+    new_linear.requires_grad_(False)
+    parent_module._modules[child_name] = new_linear
+    convert_bigdl_other_module(model, torch.float32)
+    return model
+
+
+def replace_with_low_bit_linear_for_loaded_module(model, qtype, module_name,
+                                                  modules_to_not_convert=None,
+                                                  imatrix_data=None,
+                                                  torch_dtype="auto",
+                                                  mixed_precision=False):
+    """
+    Convert the single, already loaded linear `module_name` (e.g. `model.layers.0.mlp.up_proj`)
+    the same way as `ggml_convert_low_bit`, while the rest of `model` may still be on meta
+    device, so that its full precision weight can be freed right after loading.
+    """
+    model_config = getattr(model, "config", None)
+    parent_name, _, child_name = module_name.rpartition(".")
+    if getattr(model_config, "model_type", None) == "chatglm" and child_name == "lm_head":
+        # re-referenced to `output_layer` by `ggml_convert_low_bit`
+        return model
+    parent_module = model.get_submodule(parent_name)
+
+    # only convert this child, its siblings may not be loaded yet
+    holder = nn.Module()
+    holder.config = model_config
+    holder._modules[child_name] = parent_module._modules[child_name]
+    _replace_with_low_bit_linear(
+        holder, qtype,
+        [] if modules_to_not_convert is None else modules_to_not_convert,
+        prefix_name=parent_name,
+        imatrix_data=imatrix_data,
+        model_config=model_config,
+        torch_dtype=torch_dtype,
+        mixed_precision=mixed_precision,
+        enable_scale_search=use_scale_search(model_config, qtype),
+    )
+    parent_module._modules[child_name] = holder._modules[child_name]
+    return model
+
+
 def _optimize_pre(model, qtype=None):
     try:
         from sentence_transformers.SentenceTransformer import SentenceTransformer
@@ -1076,6 +1210,48 @@ def _optimize_pre(model, qtype=None):
     return model
 
 
+def optimize_pre_on_meta(model, qtype=None):
+    """
+    Apply `_optimize_pre` to `model` before its weights are loaded, i.e. while its parameters
+    are still on meta device.
+
+    Returns where each parameter of the original model is loaded into the optimized one, as
+    `{original_name: (name, offset)}`: a parameter moved to another module has `offset=None`,
+    a linear merged by `merge_linear` (e.g. q, k and v into qkv_proj) has the first row of
+    its part in the merged weight, unchanged parameters are left out. Returns `None` if
+    `_optimize_pre` changes this model in any other way, e.g. scales or pads weights.
+    """
+    # their `_optimize_pre` scales weights in place
+    if model.config.model_type in ["rwkv", "minicpm", "minicpmv"]:
+        return None
+
+    # tied parameters have several names
+    original_names = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        original_names.setdefault(id(param), []).append(name)
+    _optimize_pre(model, qtype)
+
+    key_map = {}
+    for module_name, module in model.named_modules():
+        merged_linears = module.__dict__.pop("merged_linears", None)
+        for param_name, param in module.named_parameters(recurse=False):
+            name = f"{module_name}.{param_name}" if module_name else param_name
+            if id(param) in original_names:
+                if name not in original_names[id(param)]:
+                    key_map[original_names[id(param)][0]] = (name, None)
+            elif merged_linears is not None:
+                offset = 0
+                for linear in merged_linears:
+                    part = getattr(linear, param_name)
+                    if id(part) not in original_names:
+                        return None
+                    key_map[original_names[id(part)][0]] = (name, offset)
+                    offset += part.size(0)
+            else:
+                return None
+    return key_map
+
+
 def ggml_convert_low_bit(model, qtype, optimize_model=True,
                          convert_shape_only=False, device="cpu",
                          modules_to_not_convert=None,
@@ -1084,7 +1260,8 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
                          imatrix_data=None,
                          embedding_qtype=None,
                          mixed_precision=False,
-                         disable_optimize_pre=False):
+                         disable_optimize_pre=False,
+                         convert_threads=None):
     if qtype in ggml_tensor_qtype.values():
         index = list(ggml_tensor_qtype.values()).index(qtype)
         logger.info(f"Converting the current model to "
@@ -1120,17 +1297,27 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
 
     # mixed quantization needs model_config to choose custom quantization strategy
     if qtype is not None:
-        model, has_been_replaced = _replace_with_low_bit_linear(
-            model, qtype, modules_to_not_convert,
-            convert_shape_only, cpu_embedding,
-            imatrix_data=imatrix_data,
-            embedding_qtype=embedding_qtype,
-            model_config=model_config,
-            torch_dtype=torch_dtype,
-            mixed_precision=mixed_precision,
-            act_order=act_order,
-            enable_scale_search=enable_scale_search,
-        )
+        convert_threads = get_convert_threads(convert_threads)
+        quantize_pool = QuantizeJobPool(convert_threads) if convert_threads > 1 else None
+        with quantize_pool or contextlib.nullcontext():
+            model, has_been_replaced = _replace_with_low_bit_linear(
+                model, qtype, modules_to_not_convert,
+                convert_shape_only, cpu_embedding,
+                imatrix_data=imatrix_data,
+                embedding_qtype=embedding_qtype,
+                model_config=model_config,
+                torch_dtype=torch_dtype,
+                mixed_precision=mixed_precision,
+                act_order=act_order,
+                enable_scale_search=enable_scale_search,
+                quantize_pool=quantize_pool,
+            )
+        if not has_been_replaced:
+            # linears may be converted while loading already, e.g. with `streaming_load`
+            from ipex_llm.transformers.low_bit_linear import LowBitLinear, \
+                FP16Linear, BF16Linear
+            has_been_replaced = any(isinstance(m, (LowBitLinear, FP16Linear, BF16Linear))
+                                    for m in model.modules())
         if not has_been_replaced:
             warnings.warn(
                 "No linear modules were found in "
@@ -0,0 +1,168 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Cache of dequantized weights for the CPU prefill path of `LowBitLinear`.
+# On servers without AMX, `LowBitLinear` dequantizes a sym_int4 weight for every
+# large-batch forward, this cache keeps the dequantized weights of the linears
+# which run prefill most often under a byte budget.
+
+import threading
+import torch
+from collections import OrderedDict
+from typing import Callable, Dict
+from ipex_llm.utils.common import invalidInputError
+
+
+class _Entry:
+    __slots__ = ("weight", "data_ptr", "nbytes")
+
+    def __init__(self, weight: torch.Tensor, data_ptr: int):
+        self.weight = weight
+        self.data_ptr = data_ptr
+        self.nbytes = weight.numel() * weight.element_size()
+
+
+class DequantizedWeightCache:
+    """
+    A byte-budgeted cache of dequantized `LowBitLinear` weights for CPU prefill.
+
+    Every large-batch forward of an attached linear counts as one prefill of it. A linear
+    is only cached from its `min_prefill_count`-th prefill on, and a new weight only
+    evicts cached weights (in LRU order) which have been used for prefill less often than
+    it, so that the budget is spent on the hottest linears, e.g. the frequently routed
+    experts of a MoE model. When all linears are equally hot, as the layers of a dense
+    model, the first cached ones are kept instead of evicting each other at every prefill.
+
+    Args:
+        max_cache_bytes (`int`):
+            Byte budget of all cached weights.
+        dtype (`torch.dtype`):
+            dtype of cached weights, ``torch.float32`` keeps the results unchanged,
+            ``torch.bfloat16`` halves the memory.
+        min_prefill_count (`int`):
+            Number of prefills of a linear before its weight is cached.
+    """
+
+    def __init__(self, max_cache_bytes: int, dtype: torch.dtype = torch.float32,
+                 min_prefill_count: int = 2):
+        invalidInputError(max_cache_bytes > 0, "max_cache_bytes should be positive")
+        invalidInputError(dtype in [torch.float32, torch.bfloat16],
+                          f"dtype should be torch.float32 or torch.bfloat16, but got {dtype}")
+        self.max_cache_bytes = max_cache_bytes
+        self.dtype = dtype
+        self.min_prefill_count = min_prefill_count
+        # id(module) -> _Entry, least recently used first
+        self.lru: "OrderedDict[int, _Entry]" = OrderedDict()
+        # id(module) -> number of prefills
+        self.prefill_counts: Dict[int, int] = {}
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.num_evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.lru)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hits / self.num_lookups if self.num_lookups > 0 else 0.0
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "num_lookups": self.num_lookups,
+            "num_hits": self.num_hits,
+            "hit_rate": self.hit_rate,
+            "num_evictions": self.num_evictions,
+            "num_entries": len(self),
+            "cache_bytes": self.cache_bytes,
+            "max_cache_bytes": self.max_cache_bytes,
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.num_lookups = 0
+            self.num_hits = 0
+            self.num_evictions = 0
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+            self.prefill_counts.clear()
+            self.cache_bytes = 0
+
+    def attach(self, model):
+        """Makes all sym_int4 `LowBitLinear` in `model` use this cache for CPU prefill."""
+        from ipex_llm.transformers.low_bit_linear import LowBitLinear, SYM_INT4
+        for module in model.modules():
+            if isinstance(module, LowBitLinear) and module.qtype == SYM_INT4:
+                module.dequant_cache = self
+
+    def get_weight(self, module, dequantize: Callable[[], torch.Tensor]) -> torch.Tensor:
+        """
+        Returns the dequantized weight of `module`, from the cache if possible,
+        otherwise by calling `dequantize` and caching the result if the policy admits it.
+        """
+        key = id(module)
+        data_ptr = module.weight.data.data_ptr()
+        with self.lock:
+            self.num_lookups += 1
+            count = self.prefill_counts.get(key, 0) + 1
+            self.prefill_counts[key] = count
+            entry = self.lru.get(key, None)
+            if entry is not None:
+                if entry.data_ptr == data_ptr:
+                    self.num_hits += 1
+                    self.lru.move_to_end(key)
+                    return entry.weight
+                # the weight of this module has been replaced
+                self._remove(key)
+
+        weight = dequantize().to(self.dtype)
+        if count < self.min_prefill_count:
+            return weight
+
+        with self.lock:
+            if key not in self.lru and self._make_room(weight.numel() * weight.element_size(),
+                                                       count):
+                entry = _Entry(weight, data_ptr)
+                self.lru[key] = entry
+                self.cache_bytes += entry.nbytes
+        return weight
+
+    def _make_room(self, nbytes: int, count: int) -> bool:
+        if nbytes > self.max_cache_bytes:
+            return False
+        victims, freed = [], 0
+        for key, entry in self.lru.items():
+            if self.cache_bytes - freed + nbytes <= self.max_cache_bytes:
+                break
+            if self.prefill_counts.get(key, 0) >= count:
+                # only evict colder weights
+                continue
+            victims.append(key)
+            freed += entry.nbytes
+        if self.cache_bytes - freed + nbytes > self.max_cache_bytes:
+            return False
+        for key in victims:
+            self._remove(key)
+            self.num_evictions += 1
+        return True
+
+    def _remove(self, key: int):
+        entry = self.lru.pop(key)
+        self.cache_bytes -= entry.nbytes
@@ -15,8 +15,11 @@
 #
 
 
+import os
 import numpy
+import tempfile
 import torch
+from collections import OrderedDict
 from torch import Tensor
 from torch.nn import Parameter
 from typing import Optional
@@ -94,6 +97,14 @@ class CPUEmbedding(torch.nn.Embedding):
 
 
 class DiskEmbedding(torch.nn.Embedding):
+    """
+    An Embedding whose fp16 table is written to a file and memory-mapped, the most
+    recently used `cache_rows` rows are kept in memory.
+
+    The file is created in `embedding_dir`, which defaults to the environment variable
+    `IPEX_LLM_DISK_EMBEDDING_DIR` or the system temporary directory, and is removed when
+    this module is deleted.
+    """
     def __init__(self,
                  num_embeddings: int,
                  embedding_dim: int,
@@ -105,29 +116,84 @@ class DiskEmbedding(torch.nn.Embedding):
                  _weight: Optional[Tensor] = None,
                  _freeze: bool = False,
                  device=None,
-                 dtype=None) -> None:
+                 dtype=None,
+                 embedding_dir: Optional[str] = None,
+                 cache_rows: int = 1024) -> None:
         super().__init__(num_embeddings, embedding_dim, padding_idx,
                          max_norm, norm_type, scale_grad_by_freq,
                          sparse, _weight, True, device, dtype)
-        self.filename = "embeddings.bin"
+        if embedding_dir is None:
+            embedding_dir = os.environ.get("IPEX_LLM_DISK_EMBEDDING_DIR", tempfile.gettempdir())
+        os.makedirs(embedding_dir, exist_ok=True)
+        self.embedding_dir = embedding_dir
+        fd, self.filename = tempfile.mkstemp(prefix="embeddings_", suffix=".bin",
+                                             dir=embedding_dir)
+        os.close(fd)
         self.weight.data.flatten().to(device='cpu', dtype=torch.half).numpy().tofile(self.filename)
         dummy_weight = torch.empty(0, 0, dtype=self.weight.dtype, device=self.weight.device)
         self.weight = torch.nn.Parameter(dummy_weight, requires_grad=False)
 
+        # copy-on-write mapping so that torch accepts it, the file is never written
+        self.table = torch.from_numpy(numpy.memmap(self.filename, dtype=numpy.float16, mode='c',
+                                                   shape=(num_embeddings, embedding_dim)))
+        self.cache_rows = cache_rows
+        self.cache = torch.empty(cache_rows, embedding_dim, dtype=torch.half)
+        # token id -> row of `self.cache`, in LRU order
+        self.cache_slots: OrderedDict[int, int] = OrderedDict()
+
+    def __del__(self):
+        self.table = None
+        try:
+            os.remove(self.filename)
+        except (AttributeError, OSError):
+            pass
+
+    def lookup(self, ids: Tensor) -> Tensor:
+        """Gather the fp16 rows of unique `ids`, from the cache or the mapped file."""
+        if self.cache_rows <= 0:
+            return self.table.index_select(0, ids)
+
+        hit_idx, hit_slots, miss_idx = [], [], []
+        for i, idx in enumerate(ids.tolist()):
+            slot = self.cache_slots.get(idx)
+            if slot is None:
+                miss_idx.append(i)
+            else:
+                self.cache_slots.move_to_end(idx)
+                hit_idx.append(i)
+                hit_slots.append(slot)
+        if len(miss_idx) == 0:
+            return self.cache[hit_slots]
+
+        rows = torch.empty(len(ids), self.embedding_dim, dtype=torch.half)
+        if len(hit_idx) > 0:
+            rows[hit_idx] = self.cache[hit_slots]
+        miss_ids = ids[miss_idx]
+        miss_rows = self.table.index_select(0, miss_ids)
+        rows[miss_idx] = miss_rows
+
+        # cache the misses, evicting the least recently used rows
+        miss_ids, miss_rows = miss_ids[-self.cache_rows:], miss_rows[-self.cache_rows:]
+        slots = []
+        for idx in miss_ids.tolist():
+            if len(self.cache_slots) < self.cache_rows:
+                slot = len(self.cache_slots)
+            else:
+                _, slot = self.cache_slots.popitem(last=False)
+            self.cache_slots[idx] = slot
+            slots.append(slot)
+        self.cache[slots] = miss_rows
+        return rows
+
     def forward(self, input_ids: Tensor):
         ids = input_ids.cpu().flatten()
-
-        embeds = []
-        with open(self.filename, 'rb') as f:
-            for idx in ids:
-                f.seek(idx * self.embedding_dim * 2)
-                buffer = f.read(self.embedding_dim * 2)
-                embeds.append(torch.frombuffer(buffer, dtype=torch.half))
-        embeds = torch.stack(embeds).to(device=input_ids.device, dtype=self.weight.dtype)
+        unique_ids, inverse = torch.unique(ids, return_inverse=True)
+        embeds = self.lookup(unique_ids)[inverse]
+        embeds = embeds.to(device=input_ids.device, dtype=self.weight.dtype)
         return embeds.view(*input_ids.size(), self.embedding_dim)
 
     @classmethod
-    def from_embedding(cls, embedding: torch.nn.Embedding):
+    def from_embedding(cls, embedding: torch.nn.Embedding, embedding_dir: Optional[str] = None):
         return cls(
             embedding.num_embeddings,
             embedding.embedding_dim,
@@ -140,15 +206,11 @@ class DiskEmbedding(torch.nn.Embedding):
             True,
             embedding.weight.device,
             embedding.weight.dtype,
+            embedding_dir,
         )
 
     def to_embedding(self):
-        with open(self.filename, 'rb') as f:
-            buffer = f.read()
-        embeds = torch.frombuffer(buffer, dtype=torch.half).clone()
-        embeds = embeds.view(self.num_embeddings, self.embedding_dim).to(
-            device=self.weight.device, dtype=self.weight.dtype
-        )
+        embeds = self.table.clone().to(device=self.weight.device, dtype=self.weight.dtype)
         return torch.nn.Embedding(
             self.num_embeddings,
             self.embedding_dim,
@@ -164,10 +226,10 @@ class DiskEmbedding(torch.nn.Embedding):
         )
 
     @staticmethod
-    def replace_normal_embedding(m: torch.nn.Module):
+    def replace_normal_embedding(m: torch.nn.Module, embedding_dir: Optional[str] = None):
         for name, module in m.named_children():
             if type(module) == torch.nn.Embedding:
-                m._modules[name] = DiskEmbedding.from_embedding(module)
+                m._modules[name] = DiskEmbedding.from_embedding(module, embedding_dir)
 
     @staticmethod
     def restore_normal_embedding(m: torch.nn.Module):
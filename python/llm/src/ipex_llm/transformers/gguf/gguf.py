@@ -18,16 +18,22 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import os
 import struct
 import functools
 import torch
 import numpy
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BufferedReader
 from tqdm import tqdm
 from ipex_llm.utils.common import invalidInputError
 
 
+K_QUANT_LOW_BITS = ["q4_k", "q5_k", "q6_k"]
+
+
 class GGUFReader:
     def __init__(self, f: BufferedReader):
         self.f = f
@@ -193,12 +199,12 @@ class GGUFTensorLoader:
             7: 24,      # q5_1
             8: 34,      # q8_0
             9: 40,      # q8_1
-            10: 0,      # q2_k
-            11: 0,      # q3_k
-            12: 0,      # q4_k
-            13: 0,      # q5_k
+            10: 84,     # q2_k
+            11: 110,    # q3_k
+            12: 144,    # q4_k
+            13: 176,    # q5_k
             14: 210,    # q6_k
-            15: 0,      # q8_k
+            15: 292,    # q8_k
             16: 1,      # i8
             17: 2,      # i16
             18: 4,      # i32
@@ -213,59 +219,92 @@ class GGUFTensorLoader:
             7: self.convert_q5_1_tensor,        # q5_1
             8: self.convert_q8_0_tensor,        # q8_0
             9: self.convert_unknown_tensor,     # q8_1
-            10: self.convert_unknown_tensor,    # q2_k
-            11: self.convert_unknown_tensor,    # q3_k
-            12: self.convert_unknown_tensor,    # q4_k
-            13: self.convert_unknown_tensor,    # q5_k
+            10: self.convert_q2_k_tensor,       # q2_k
+            11: self.convert_q3_k_tensor,       # q3_k
+            12: self.convert_q4_k_tensor,       # q4_k
+            13: self.convert_q5_k_tensor,       # q5_k
             14: self.convert_q6_k_tensor,       # q6_k
-            15: self.convert_unknown_tensor,    # q8_k
+            15: self.convert_q8_k_tensor,       # q8_k
             16: self.convert_unknown_tensor,    # i8
             17: self.convert_unknown_tensor,    # i16
             18: self.convert_unknown_tensor,    # i32
         }
 
+        # ggml qtypes whose blocks are the CPU layout of an ipex-llm qtype
+        self.low_bit_qtypes = {
+            2: "sym_int4",      # q4_0
+            3: "asym_int4",     # q4_1
+            6: "sym_int5",      # q5_0
+            7: "asym_int5",     # q5_1
+            8: "sym_int8",      # q8_0
+            12: "q4_k",         # q4_k
+            13: "q5_k",         # q5_k
+            14: "q6_k",         # q6_k
+        }
+
         self.fpath = fpath
         self.infos = tensor_infos.infos
         self.base_offset = tensor_infos.base_offset
 
     def __iter__(self):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8).copy()
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                yield name, tensor
-
-    def load_while_process(self, process):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8)
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                process(name, tensor)
+        for name, tensor in self.load_iter():
+            yield name, tensor
+
+    def load_iter(self, low_bit: str = None, num_workers: int = None):
+        """
+        Yield `(name, tensor)` in file order, tensors are dequantized on a thread pool
+        of `num_workers` threads reading from a memory-mapped file.
+
+        If `low_bit` is given, 2D tensors whose ggml qtype is stored as-is by this
+        ipex-llm qtype are not dequantized, but yielded as `GGUFQuantizedTensor`.
+        If `low_bit` is a k-quant qtype, tensors of any k-quant qtype ipex-llm supports
+        are kept as they are, as files like Q4_K_M mix q4_k with q6_k tensors by design.
+        """
+        if num_workers is None:
+            num_workers = min(4, os.cpu_count() or 1)
+        num_workers = max(num_workers, 1)
+        # copy-on-write mapping, tensor views share the page cache and never touch the file
+        mm = numpy.memmap(self.fpath, dtype=numpy.uint8, mode='c')
+
+        def load(info):
+            name, ndims, dims, qtype, offset = info
+            total_ne = functools.reduce(lambda x, y: x * y, dims)
+            invalidInputError(total_ne % self.block_ne[qtype] == 0,
+                              f"wrong elements num: {dims}")
+
+            size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
+            invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
+
+            offset += self.base_offset
+            tensor = torch.from_numpy(mm[offset:offset + size])
+            direct_low_bit = self.low_bit_qtypes.get(qtype)
+            if direct_low_bit is not None and ndims == 2 and (
+                direct_low_bit == low_bit
+                or (direct_low_bit in K_QUANT_LOW_BITS and low_bit in K_QUANT_LOW_BITS)
+            ):
+                return name, GGUFQuantizedTensor(self, tensor, qtype, dims)
+            return name, self.convert_funcs[qtype](tensor, size, ndims, dims)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor, \
+                tqdm(total=len(self.infos), desc="Loading gguf tensors") as pbar:
+            # at most `num_workers` converted tensors wait for the consumer
+            futures = deque()
+            for info in self.infos:
+                futures.append(executor.submit(load, info))
+                if len(futures) > num_workers:
+                    yield futures.popleft().result()
+                    pbar.update(1)
+            while futures:
+                yield futures.popleft().result()
+                pbar.update(1)
+
+    def load_while_process(self, process, low_bit: str = None, num_workers: int = None):
+        for name, tensor in self.load_iter(low_bit, num_workers):
+            process(name, tensor)
 
     def convert_f32_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
-        return tensor.view(torch.float)
+        # `tensor` is a view of the mapped file, don't hand it out
+        return tensor.view(torch.float).reshape(dims).clone()
 
     def convert_f16_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         return tensor.view(torch.half).reshape(dims)
@@ -341,6 +380,98 @@ class GGUFTensorLoader:
         result = (data * scales).reshape(dims)
         return result
 
+    def convert_q2_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L1875
+
+        block_size = self.block_size[10]
+        tensor = tensor.reshape((-1, block_size))
+        scales, qs, d, dmin = (tensor[:, :16], tensor[:, 16:80],
+                               tensor[:, 80:82], tensor[:, 82:84])
+        # 2 x 128 values, each 32 bytes of `qs` hold 4 groups of 32 values
+        shift = torch.tensor([0, 2, 4, 6], dtype=torch.uint8).reshape(1, 1, 4, 1)
+        data = (qs.reshape(-1, 2, 1, 32) >> shift) & 0B11
+        # 16 groups of 16 values, each with a 4 bit scale and a 4 bit min
+        data = data.reshape(-1, 16, 16)
+        sc = (scales & 0xF).reshape(-1, 16, 1)
+        m = (scales >> 4).reshape(-1, 16, 1)
+        result = (d.view(torch.half).reshape(-1, 1, 1) * sc * data
+                  - dmin.view(torch.half).reshape(-1, 1, 1) * m)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q3_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2122
+
+        block_size = self.block_size[11]
+        tensor = tensor.reshape((-1, block_size))
+        hmask, qs, scales, d = (tensor[:, :32], tensor[:, 32:96],
+                                tensor[:, 96:108], tensor[:, 108:])
+        shift = torch.tensor([0, 2, 4, 6], dtype=torch.uint8).reshape(1, 1, 4, 1)
+        data = ((qs.reshape(-1, 2, 1, 32) >> shift) & 0B11).reshape(-1, 8, 32)
+        # the 8 bits of `hmask` are the high bits of the 8 groups of 32 values,
+        # a cleared high bit means subtracting 4
+        shift = torch.arange(0, 8, 1, dtype=torch.uint8).reshape(1, 8, 1)
+        hdata = (hmask.reshape(-1, 1, 32) >> shift) & 1
+        data = data.view(torch.int8) - ((1 - hdata) << 2).view(torch.int8)
+        # 16 6-bit scales, the low 4 bits are in the first 8 bytes,
+        # the high 2 bits are in the last 4 bytes
+        lscales = torch.cat([scales[:, :8] & 0xF, scales[:, :8] >> 4], dim=-1)
+        shift = torch.tensor([0, 2, 4, 6], dtype=torch.uint8).reshape(1, 4, 1)
+        hscales = ((scales[:, 8:].reshape(-1, 1, 4) >> shift) & 0B11).reshape(-1, 16)
+        sc = (lscales | (hscales << 4)).view(torch.int8) - 32
+        result = (d.view(torch.half).reshape(-1, 1, 1) * sc.reshape(-1, 16, 1)
+                  * data.reshape(-1, 16, 16))
+        result = result.reshape(dims)
+        return result
+
+    def get_k_quant_scale_min(self, scales: torch.Tensor):
+        # see `get_scale_min_k4` in ggml-quants.c
+        # 8 6-bit scales and 8 6-bit mins are packed in 12 bytes
+        sc = torch.cat([scales[:, 0:4] & 63,
+                        (scales[:, 8:12] & 0xF) | ((scales[:, 0:4] >> 6) << 4)], dim=-1)
+        m = torch.cat([scales[:, 4:8] & 63,
+                       (scales[:, 8:12] >> 4) | ((scales[:, 4:8] >> 6) << 4)], dim=-1)
+        return sc.reshape(-1, 8, 1), m.reshape(-1, 8, 1)
+
+    def convert_q4_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2410
+
+        block_size = self.block_size[12]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qs = (tensor[:, :2], tensor[:, 2:4],
+                               tensor[:, 4:16], tensor[:, 16:])
+        # 4 x 64 values, each 32 bytes of `qs` hold 2 groups of 32 values
+        qs = qs.reshape(-1, 4, 1, 32)
+        data = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape(-1, 8, 32)
+        sc, m = self.get_k_quant_scale_min(scales)
+        result = (d.view(torch.half).reshape(-1, 1, 1) * sc * data
+                  - dmin.view(torch.half).reshape(-1, 1, 1) * m)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q5_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2609
+
+        block_size = self.block_size[13]
+        tensor = tensor.reshape((-1, block_size))
+        d, dmin, scales, qh, qs = (tensor[:, :2], tensor[:, 2:4], tensor[:, 4:16],
+                                   tensor[:, 16:48], tensor[:, 48:])
+        qs = qs.reshape(-1, 4, 1, 32)
+        ldata = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape(-1, 8, 32)
+        # the 8 bits of `qh` are the 5th bits of the 8 groups of 32 values
+        shift = torch.arange(0, 8, 1, dtype=torch.uint8).reshape(1, 8, 1)
+        hdata = ((qh.reshape(-1, 1, 32) >> shift) & 1) << 4
+        data = ldata | hdata
+        sc, m = self.get_k_quant_scale_min(scales)
+        result = (d.view(torch.half).reshape(-1, 1, 1) * sc * data
+                  - dmin.view(torch.half).reshape(-1, 1, 1) * m)
+        result = result.reshape(dims)
+        return result
+
     def convert_q6_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         # see https://github.com/ggerganov/llama.cpp/blob
         # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2263
@@ -366,10 +497,38 @@ class GGUFTensorLoader:
         result = result.reshape(dims)
         return result
 
+    def convert_q8_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2863
+
+        block_size = self.block_size[15]
+        tensor = tensor.reshape((-1, block_size))
+        # clone `d` to fix memory address alignment, `bsums` are not needed
+        d, qs = tensor[:, :4].clone().view(torch.float), tensor[:, 4:260]
+        result = (qs.view(torch.int8) * d).reshape(dims)
+        return result
+
     def convert_unknown_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         invalidInputError(False, "Unsupported qtype")
 
 
+class GGUFQuantizedTensor:
+    """
+    A 2D gguf weight kept in its ggml blocks, `data` is a `[rows, row_bytes]` uint8 view
+    of the mapped file which can be passed to `FP4Params` as an already quantized weight.
+    """
+    def __init__(self, loader: GGUFTensorLoader, data: torch.Tensor, qtype: int, dims):
+        self.loader = loader
+        self.data = data.reshape(dims[0], -1)
+        self.qtype = qtype
+        self.shape = torch.Size(dims)
+        self.low_bit = loader.low_bit_qtypes[qtype]
+
+    def dequantize(self) -> torch.Tensor:
+        return self.loader.convert_funcs[self.qtype](self.data.reshape(-1), self.data.numel(),
+                                                     len(self.shape), list(self.shape))
+
+
 class GGUFFileLoader:
     def __init__(self, fpath: str):
         with open(fpath, 'rb') as f:
@@ -21,9 +21,10 @@ from accelerate.utils import set_module_tensor_to_device
 from tempfile import NamedTemporaryFile
 from transformers import MistralConfig, MistralForCausalLM, LlamaTokenizer
 
-from ..gguf import GGUFFileLoader
+from ..gguf import GGUFFileLoader, GGUFQuantizedTensor
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
-from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
+from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module, \
+    replace_with_quantized_linear_for_module
 
 
 def load_gguf_mistral(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
@@ -54,34 +55,43 @@ def load_gguf_mistral(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
     with init_empty_weights():
         model = MistralForCausalLM(mistral_config)
 
+    def reverse_permute(tensor, n_head):
+        # gguf weight needs to reshape for q_proj and k_proj
+        head, hd_size = tensor.shape[0], tensor.shape[1:]
+        return (tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
+                      .swapaxes(1, 2)
+                      .reshape(tensor.shape))
+
     def process_mistral(name, tensor):
         nonlocal model
         module_name = get_mistral_module_name(name)
+        if isinstance(tensor, GGUFQuantizedTensor):
+            if name == 'token_embd.weight':
+                tensor = tensor.dequantize()
+            else:
+                # already in ggml blocks, permuting rows keeps the blocks intact
+                weight = tensor.data
+                if name.endswith("attn_q.weight"):
+                    weight = reverse_permute(weight, n_head)
+                elif name.endswith("attn_k.weight"):
+                    weight = reverse_permute(weight, n_head_kv)
+                else:
+                    weight = weight.clone()
+                model = replace_with_quantized_linear_for_module(
+                    model, ggml_tensor_qtype[tensor.low_bit], module_name, weight)
+                return
         if name.endswith("attn_q.weight"):
-            # gguf weight needs to reshape for q_proj
-            head, hd_size = tensor.shape[0], tensor.shape[1:]
             set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
+                                        reverse_permute(tensor, n_head), dtype=dtype)
         elif name.endswith("attn_k.weight"):
-            # gguf weight needs to reshape for k_proj
-            head, hd_size = tensor.shape[0], tensor.shape[1:]
             set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head_kv,
-                                                       head // n_head_kv // 2,
-                                                       2,
-                                                       *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
+                                        reverse_permute(tensor, n_head_kv), dtype=dtype)
         else:
             set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
         model = replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
 
     tensor_loader = loader.tensor_loader
-    tensor_loader.load_while_process(process_mistral)
+    tensor_loader.load_while_process(process_mistral, low_bit=low_bit)
 
     # see https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
     from transformers.convert_slow_tokenizer import import_protobuf
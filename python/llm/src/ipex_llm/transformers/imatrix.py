@@ -0,0 +1,234 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Collect the importance matrix of a model from a text file, in the format of
+# llama.cpp `imatrix` which `load_imatrix_data` reads, so that the importance matrix
+# for `load_in_low_bit="gguf_iq2_xxs"` etc. can be computed in process.
+#
+# Usage:
+#   python -m ipex_llm.transformers.imatrix -m /path/to/model -f wiki.train.raw -o model.imatrix
+
+import argparse
+import struct
+import time
+import torch
+from typing import Dict, Iterator, List, Optional
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger, module_name_process
+
+# `module_name_process` module name -> llama.cpp tensor name
+_IMATRIX_MODULE_NAMES = {"q": "attn_q", "k": "attn_k", "v": "attn_v", "o": "attn_output",
+                         "gate": "ffn_gate", "up": "ffn_up", "down": "ffn_down",
+                         "gate_inp": "ffn_gate_inp"}
+
+
+def imatrix_entry_name(full_module_name) -> Optional[str]:
+    """
+    Returns the llama.cpp tensor name of a linear, e.g. ``blk.0.attn_q.weight`` for
+    ``model.layers.0.self_attn.q_proj``, which `load_imatrix_data` maps back to the key
+    used by `get_cur_qtype_and_imatrix`, or `None` if the linear has no such name.
+    """
+    _, layer, cur_module, dq_idx = module_name_process(full_module_name)
+    if layer is None or dq_idx is not None or cur_module not in _IMATRIX_MODULE_NAMES:
+        return None
+    names = ["blk", layer, _IMATRIX_MODULE_NAMES[cur_module]]
+    full_names = full_module_name.split('.')
+    if len(full_names) == 7 and full_names[3] == 'block_sparse_moe':
+        # mixtral experts, e.g. model.layers.0.block_sparse_moe.experts.3.w1
+        names.append(full_names[-2])
+    return '.'.join(names + ["weight"])
+
+
+class ImatrixCollector:
+    """
+    Accumulates the sum of squared inputs of each input channel of the linears of a model.
+
+    Every forward of an attached linear adds the squares of all its input rows, and counts
+    `num_sequences` calls, so that the saved sums divided by the calls, as
+    `load_imatrix_data` does, are the mean sums per sequence, as llama.cpp `imatrix` does
+    for its chunks.
+
+    Args:
+        model: the model to collect the importance matrix of, its linears can be
+            `nn.Linear` or low-bit linears of ipex-llm.
+    """
+
+    def __init__(self, model):
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.ncalls: Dict[str, int] = {}
+        # llama.cpp tensor name -> key of `get_cur_qtype_and_imatrix`
+        self.keys: Dict[str, str] = {}
+        self.num_sequences = 1
+        self.hook_handles = []
+        for full_module_name, module in model.named_modules():
+            if not isinstance(module, torch.nn.Linear):
+                continue
+            name = imatrix_entry_name(full_module_name)
+            if name is not None:
+                self.keys[name], _, _, _ = module_name_process(full_module_name)
+                self.hook_handles.append(
+                    module.register_forward_pre_hook(self.make_hook(name)))
+        invalidInputError(len(self.hook_handles) > 0,
+                          f"No linear of {type(model).__name__} has an importance matrix name")
+
+    def make_hook(self, name):
+        def hook(module, args):
+            if len(args) == 0 or args[0].numel() == 0:
+                return
+            x = args[0].detach()
+            x = x.reshape(-1, x.shape[-1]).float()
+            sums = torch.sum(x * x, dim=0)
+            if name in self.sums:
+                self.sums[name] += sums
+                self.ncalls[name] += self.num_sequences
+            else:
+                self.sums[name] = sums
+                self.ncalls[name] = self.num_sequences
+        return hook
+
+    def remove(self):
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+
+    def get_imatrix_data(self) -> Dict[str, torch.Tensor]:
+        """Returns the importance matrix as `load_imatrix_data` returns it."""
+        return {self.keys[name]: (sums / self.ncalls[name]).cpu()
+                for name, sums in self.sums.items()}
+
+    def save(self, imatrix_file):
+        """Saves the importance matrix in the format of llama.cpp `imatrix`."""
+        invalidInputError(len(self.sums) > 0, "No importance matrix is collected yet")
+        with open(imatrix_file, "wb") as f:
+            f.write(struct.pack("<i", len(self.sums)))
+            for name, sums in self.sums.items():
+                encoded_name = name.encode("utf-8")
+                f.write(struct.pack("<i", len(encoded_name)))
+                f.write(encoded_name)
+                f.write(struct.pack("<ii", self.ncalls[name], sums.numel()))
+                f.write(sums.cpu().numpy().tobytes())
+
+
+def iter_text_chunks(tokenizer, text_file, ctx_len, read_size=1 << 16) -> Iterator[List[int]]:
+    """
+    Yields chunks of `ctx_len` tokens of `text_file`, each starting with BOS if the
+    tokenizer has one. The file is read and tokenized `read_size` characters at a time.
+    """
+    bos = [tokenizer.bos_token_id] if tokenizer.bos_token_id is not None else []
+    chunk_len = ctx_len - len(bos)
+    tokens = []
+    with open(text_file, "r", encoding="utf-8") as f:
+        while True:
+            lines = f.readlines(read_size)
+            if not lines:
+                break
+            tokens.extend(tokenizer.encode("".join(lines), add_special_tokens=False))
+            while len(tokens) >= chunk_len:
+                yield bos + tokens[:chunk_len]
+                tokens = tokens[chunk_len:]
+
+
+def collect_imatrix(model, tokenizer, text_file, imatrix_file=None, ctx_len=512,
+                    batch_size=4, num_chunks=None) -> Dict[str, torch.Tensor]:
+    """
+    Collect the importance matrix of `model` over `text_file` by a prefill of each
+    `batch_size` chunks of `ctx_len` tokens.
+
+    :param model: the model to calibrate, e.g. loaded by
+           `AutoModelForCausalLM.from_pretrained(..., load_in_low_bit="sym_int8")`.
+    :param tokenizer: the tokenizer of `model`.
+    :param text_file: path of the calibration text file.
+    :param imatrix_file: path to save the importance matrix to, which can be passed
+           to `from_pretrained` as `imatrix`. Default to be ``None``, not to save it.
+    :param ctx_len: number of tokens of each chunk.
+    :param batch_size: number of chunks to run in one forward.
+    :param num_chunks: maximum number of chunks to run. Default to be ``None``, to run
+           over the whole file.
+
+    :return: the importance matrix as `load_imatrix_data` returns it.
+    """
+    collector = ImatrixCollector(model)
+    start = time.perf_counter()
+    num_tokens = 0
+
+    def forward(batch):
+        nonlocal num_tokens
+        collector.num_sequences = len(batch)
+        input_ids = torch.tensor(batch, dtype=torch.long, device=model.device)
+        model(input_ids, use_cache=False)
+        num_tokens += input_ids.numel()
+        elapsed = time.perf_counter() - start
+        logger.info(f"Collected {num_tokens} tokens in {elapsed:.2f}s "
+                    f"({num_tokens / elapsed:.1f} tokens/s)")
+
+    try:
+        with torch.inference_mode():
+            batch = []
+            for idx, chunk in enumerate(iter_text_chunks(tokenizer, text_file, ctx_len)):
+                if num_chunks is not None and idx >= num_chunks:
+                    break
+                batch.append(chunk)
+                if len(batch) == batch_size:
+                    forward(batch)
+                    batch = []
+            if batch:
+                forward(batch)
+    finally:
+        collector.remove()
+    invalidInputError(num_tokens > 0,
+                      f"{text_file} has less than ctx_len={ctx_len} tokens")
+
+    if imatrix_file is not None:
+        collector.save(imatrix_file)
+        logger.info(f"Saved {len(collector.sums)} importance matrix entries to {imatrix_file}")
+    return collector.get_imatrix_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect the importance matrix of a model')
+    parser.add_argument('-m', '--repo-id-or-model-path', type=str, required=True,
+                        help='the huggingface repo id or the path of the model')
+    parser.add_argument('-f', '--text-file', type=str, required=True,
+                        help='path of the calibration text file')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='path to save the importance matrix to')
+    parser.add_argument('--low-bit', type=str, default='sym_int8',
+                        help='the low-bit format to load the model in for calibration')
+    parser.add_argument('--ctx-len', type=int, default=512,
+                        help='number of tokens of each chunk')
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='number of chunks to run in one forward')
+    parser.add_argument('--num-chunks', type=int, default=None,
+                        help='maximum number of chunks to run')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='the device to run calibration on, e.g. cpu or xpu')
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+    from ipex_llm.transformers import AutoModelForCausalLM
+
+    model = AutoModelForCausalLM.from_pretrained(args.repo_id_or_model_path,
+                                                 load_in_low_bit=args.low_bit,
+                                                 trust_remote_code=True)
+    model = model.to(args.device)
+    tokenizer = AutoTokenizer.from_pretrained(args.repo_id_or_model_path,
+                                              trust_remote_code=True)
+    collect_imatrix(model, tokenizer, args.text_file, args.output, ctx_len=args.ctx_len,
+                    batch_size=args.batch_size, num_chunks=args.num_chunks)
+
+
+if __name__ == '__main__':
+    main()
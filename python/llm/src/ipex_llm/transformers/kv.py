@@ -107,7 +107,7 @@ class DynamicNormalCache(DynamicCache):
         if len(self.key_cache) <= layer_idx:
             k_cache, v_cache = init_kv_cache(
                 batch_size, num_heads, head_dim,
-                0, key_states.size(2) + self.KV_ALLOC_BLOCK_LENGTH,
+                0, self.get_alloc_length(key_states.size(2)),
                 key_states.dtype, key_states.device
             )
             k_cache, v_cache = append_kv_cache(k_cache, v_cache, key_states, value_states)
@@ -122,7 +122,7 @@ class DynamicNormalCache(DynamicCache):
             if k_cache.stride(1) < kv_seq_len * k_cache.size(3):
                 new_k_cache, new_v_cache = init_kv_cache(
                     batch_size, num_heads, head_dim,
-                    k_cache.size(2), kv_seq_len + self.KV_ALLOC_BLOCK_LENGTH,
+                    k_cache.size(2), self.get_alloc_length(kv_seq_len),
                     key_states.dtype, key_states.device
                 )
                 new_k_cache[...] = k_cache[...]
@@ -135,6 +135,10 @@ class DynamicNormalCache(DynamicCache):
 
         return self.key_cache[layer_idx], self.value_cache[layer_idx]
 
+    def get_alloc_length(self, kv_seq_len: int) -> int:
+        """Number of tokens to allocate room for when a layer holds `kv_seq_len` tokens."""
+        return kv_seq_len + self.KV_ALLOC_BLOCK_LENGTH
+
     @classmethod
     def from_reserved(cls, layers: int,
                       bsz: int, n_head: int, length: int, head_dim: int,
@@ -151,6 +155,36 @@ class DynamicNormalCache(DynamicCache):
         return past_key_values
 
 
+class GeometricKVCache(DynamicNormalCache):
+    """
+    A `DynamicNormalCache` which grows the cache of a layer geometrically in units of
+    `GROWTH_UNIT` (64) tokens, instead of by `KV_ALLOC_BLOCK_LENGTH` tokens.
+
+    Like `DynamicNormalCache`, the keys and values of a layer are views of one contiguous
+    buffer with free room, new tokens are written in place and `update` returns the views
+    without copying, and all tokens are copied into a new buffer when the room runs out.
+    `DynamicNormalCache` re-allocates a buffer only `KV_ALLOC_BLOCK_LENGTH` tokens larger,
+    i.e. O(n^2) bytes are copied over a sequence of n tokens. Here a buffer has a number of
+    units of the size classes 1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 14, 16, 20, ... (four per
+    doubling), so it is re-allocated O(log n) times and O(n) bytes are copied, at the cost
+    of up to a fifth of a buffer of more than 8 units being unused.
+    """
+    GROWTH_UNIT = 64
+
+    @staticmethod
+    def get_size_class(num_units: int) -> int:
+        if num_units <= 4:
+            return num_units
+        # round up to a multiple of the power of 2 below the 3 highest bits
+        shift = num_units.bit_length() - 3
+        return -(-num_units >> shift) << shift
+
+    def get_alloc_length(self, kv_seq_len: int) -> int:
+        # leave room for at least one more token
+        num_units = kv_seq_len // self.GROWTH_UNIT + 1
+        return self.get_size_class(num_units) * self.GROWTH_UNIT
+
+
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     """
@@ -0,0 +1,164 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Lazy materialization of decoder layers for `load_low_bit(lazy_load=True)`.
+# Decoder layers stay on meta device after loading and are loaded from the low-bit
+# safetensors shards on their first forward, optionally prefetched in background.
+
+import mmap
+import time
+import threading
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger, read_safetensors_header, load_low_bit_safetensors
+
+
+def find_decoder_layers(model):
+    """
+    Return the name and the `nn.ModuleList` of the decoder layers of `model`,
+    i.e. the first `nn.ModuleList` with `num_hidden_layers` (or `num_layers`) modules.
+    """
+    num_layers = getattr(model.config, "num_hidden_layers", None) or \
+        getattr(model.config, "num_layers", None)
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == num_layers:
+            return name, module
+    invalidInputError(False, f"Cannot find the decoder layers of {type(model).__name__}, "
+                             "lazy_load is not supported for this model.")
+
+
+class LazyLayerLoader:
+    """
+    Keeps the decoder layers of a model on meta device and materializes each one from
+    the low-bit safetensors shards right before its first forward.
+
+    `nn.Module._apply` of layers not materialized yet (e.g. `model.to('xpu')` or
+    `model.half()`) is recorded and replayed after materialization. If `prefetch_layers`
+    is larger than 0, the forward of a layer also materializes the next `prefetch_layers`
+    layers in a background thread, so that they are ready when the forward reaches them.
+
+    Args:
+        model: a model loaded by `load_low_bit` with all tensors except the decoder
+            layers loaded.
+        checkpoint_files (`List[str]`): the low-bit safetensors shards of `model`.
+        dtype (`torch.dtype`): dtype of floating point tensors which are not low-bit.
+        prefetch_layers (`int`): number of following layers to materialize in background.
+    """
+
+    def __init__(self, model, checkpoint_files: List[str], dtype=None, prefetch_layers=0):
+        layers_name, layers = find_decoder_layers(model)
+        self.layers = layers
+        self.dtype = dtype
+        self.prefetch_layers = prefetch_layers
+        self.prefixes = [f"{layers_name}.{idx}." for idx in range(len(layers))]
+
+        # only open the shards containing a layer when materializing it
+        self.layer_files = [[] for _ in layers]
+        for checkpoint_file in checkpoint_files:
+            _, header = read_safetensors_header(checkpoint_file)
+            for idx, prefix in enumerate(self.prefixes):
+                if checkpoint_file not in self.layer_files[idx] and \
+                        any(name.startswith(prefix) for name in header):
+                    self.layer_files[idx].append(checkpoint_file)
+
+        self.locks = [threading.Lock() for _ in layers]
+        self.materialized = [False] * len(layers)
+        self.pending_applies = [[] for _ in layers]
+        self.timings = [None] * len(layers)
+        self.prefetching = set()
+        self.prefetcher = None
+        if prefetch_layers > 0:
+            self.prefetcher = ThreadPoolExecutor(max_workers=1,
+                                                 thread_name_prefix="ipex-llm-prefetch")
+        self.hook_handles = []
+        for idx, layer in enumerate(layers):
+            layer._apply = partial(self.lazy_apply, idx, layer._apply)
+            self.hook_handles.append(
+                layer.register_forward_pre_hook(partial(self.pre_forward_hook, idx)))
+
+    def lazy_apply(self, idx, apply, fn, *args, **kwargs):
+        with self.locks[idx]:
+            if not self.materialized[idx]:
+                self.pending_applies[idx].append((fn, args, kwargs))
+                return self.layers[idx]
+        return apply(fn, *args, **kwargs)
+
+    def materialize(self, idx, prefetched=False):
+        with self.locks[idx]:
+            if self.materialized[idx]:
+                return
+            start = time.perf_counter()
+            layer = self.layers[idx]
+            load_low_bit_safetensors(layer, self.layer_files[idx], dtype=self.dtype,
+                                     prefix=self.prefixes[idx])
+            del layer._apply
+            for fn, args, kwargs in self.pending_applies[idx]:
+                layer._apply(fn, *args, **kwargs)
+            self.pending_applies[idx] = []
+            if prefetched:
+                self.warm_up(layer)
+            self.timings[idx] = {"layer": idx,
+                                 "seconds": time.perf_counter() - start,
+                                 "prefetched": prefetched}
+            self.materialized[idx] = True
+
+        if all(self.materialized):
+            logger.info(f"All {len(self.layers)} decoder layers are materialized in "
+                        f"{sum(timing['seconds'] for timing in self.timings):.2f}s")
+            for handle in self.hook_handles:
+                handle.remove()
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown(wait=False)
+
+    def warm_up(self, layer):
+        # low-bit weights are views of the mmap-ed shards, read one byte of each page
+        # so that the forward does not wait for them to be paged in
+        for param in layer.parameters():
+            if param.device.type == "cpu" and param.dtype == torch.uint8:
+                param.data.view(-1)[::mmap.PAGESIZE].sum()
+
+    def prefetch(self, idx):
+        try:
+            self.materialize(idx, prefetched=True)
+        except Exception as e:
+            # the forward materializes it again and reports the error
+            logger.warning(f"Failed to prefetch decoder layer {idx}: {e}")
+        finally:
+            self.prefetching.discard(idx)
+
+    def pre_forward_hook(self, idx, module, args):
+        self.materialize(idx)
+        if self.prefetcher is None:
+            return
+        for next_idx in range(idx + 1, min(idx + 1 + self.prefetch_layers, len(self.layers))):
+            if not self.materialized[next_idx] and next_idx not in self.prefetching:
+                self.prefetching.add(next_idx)
+                self.prefetcher.submit(self.prefetch, next_idx)
+
+    def materialize_all(self):
+        """Materializes all remaining decoder layers in the calling thread."""
+        for idx in range(len(self.layers)):
+            self.materialize(idx)
+
+    def get_timings(self):
+        """
+        Returns `{"layer", "seconds", "prefetched"}` of each materialized decoder layer,
+        where `prefetched` means the layer was materialized by the background prefetcher.
+        """
+        return [timing for timing in self.timings if timing is not None]
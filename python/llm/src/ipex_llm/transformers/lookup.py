@@ -122,6 +122,10 @@ def generate(
                                         prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
                                         **kwargs)
 
+    if getattr(self, "prefix_cache", None) is not None:
+        from ipex_llm.transformers.prefix_cache import prefix_cache_generate_kwargs
+        kwargs = prefix_cache_generate_kwargs(self, inputs, generation_config, kwargs)
+
     return original_generate(self,
                              inputs=inputs,
                              generation_config=generation_config,
@@ -136,10 +140,6 @@ def generate(
 GenerationMixin.generate = generate
 
 
-def tensor2key(key_tensor: torch.LongTensor):
-    return tuple(key_tensor.tolist())
-
-
 # This class is copied from https://github.com/huggingface/transformers/blob/main/src
 # /transformers/generation/candidate_generator.py
 class PromptLookupCandidateGenerator():
@@ -151,11 +151,19 @@ class PromptLookupCandidateGenerator():
     Read the following blog post for more information:
     https://github.com/apoorvumang/prompt-lookup-decoding
 
+    The continuations are looked up in an incremental n-gram table, which maps each
+    n-gram to the most recent positions it was followed by another token and counts
+    how often each next token follows it. The table is updated in O(max_matching_ngram_size)
+    per accepted token. Among the recent continuations, the one starting with the most
+    frequent next token is proposed, and ties are broken by recency.
+
     Args:
         max_matching_ngram_size (`int`):
             The maximum ngram size to be considered for matching in the prompt
         num_output_tokens (`int`):
             The number of tokens to be output as candidate tokens.
+        max_branches (`int`):
+            The max number of recent continuations kept per n-gram.
     """
 
     def __init__(
@@ -163,9 +171,11 @@ class PromptLookupCandidateGenerator():
         num_output_tokens: int = 10,
         max_matching_ngram_size: int = None,
         device: str = "arc",
+        max_branches: int = 4,
     ):
         self.num_output_tokens = num_output_tokens
         self.max_matching_ngram_size = max_matching_ngram_size if max_matching_ngram_size else 2
+        self.max_branches = max_branches
 
         if device in ["mtl", "lnl"]:
             self.max_candidates = 3
@@ -174,33 +184,45 @@ class PromptLookupCandidateGenerator():
             self.max_candidates = 9
             self.min_candidates = 0
 
+        # all tokens seen so far
+        self.tokens = []
+        # n-gram -> start indices of its most recent continuations, latest last
         self.lookup_table = {}
+        # n-gram -> {next token: count}
+        self.next_token_counts = {}
         invalidInputError(self.max_matching_ngram_size > 0 and self.num_output_tokens > 0,
                           "Invalid max_matching_ngram_size or num_output_tokens")
 
+    def add_token(self, token: int):
+        # index the n-grams ending at the previous token, now that they have a continuation
+        tokens = self.tokens
+        cur_len = len(tokens)
+        for ngram_size in range(1, min(self.max_matching_ngram_size, cur_len) + 1):
+            window = tuple(tokens[cur_len - ngram_size:])
+            positions = self.lookup_table.get(window)
+            if positions is None:
+                self.lookup_table[window] = [cur_len]
+                self.next_token_counts[window] = {token: 1}
+            else:
+                positions.append(cur_len)
+                if len(positions) > self.max_branches:
+                    del positions[0]
+                counts = self.next_token_counts[window]
+                counts[token] = counts.get(token, 0) + 1
+        tokens.append(token)
+
     def init_look_up_table(self,
                            input_ids: torch.LongTensor):
-        for ngram_size in range(min(self.max_matching_ngram_size, input_ids.shape[1]), 0, -1):
-            # Create sliding windows of size ngram_size
-            windows = input_ids.cpu().unfold(dimension=1, size=ngram_size, step=1)
-            for idx in range(windows.size(1)):
-                window = tensor2key(windows[0, idx])
-                if window not in self.lookup_table:
-                    self.lookup_table[window] = idx
+        self.tokens = []
+        self.lookup_table = {}
+        self.next_token_counts = {}
+        self.update_look_up_table(input_ids)
 
     def update_look_up_table(self,
                              new_input_ids: torch.LongTensor):
-        # Maintain a look up table
-        window = tensor2key(new_input_ids[0, -self.max_matching_ngram_size:])
-        for ngram_size in range(self.max_matching_ngram_size):
-            if window[ngram_size:] not in self.lookup_table:
-                self.lookup_table[window[ngram_size:]] = \
-                    new_input_ids.size(1)-self.max_matching_ngram_size+ngram_size
-
-    def get_n_gram_idx(self,
-                       ngram_tensor: torch.LongTensor):
-        key = tensor2key(ngram_tensor)
-        return self.lookup_table[key]
+        # only index tokens which are not seen yet
+        for token in new_input_ids[0, len(self.tokens):].tolist():
+            self.add_token(token)
 
     def get_candidates(self,
                        input_ids: torch.LongTensor)-> Tuple[torch.LongTensor,
@@ -219,23 +241,19 @@ class PromptLookupCandidateGenerator():
         """
         if self.num_output_tokens == 0:
             return input_ids, None
-        input_length = input_ids.size(1)
+        self.update_look_up_table(input_ids)
 
+        tokens = self.tokens
+        input_length = len(tokens)
         chosen_ids = None
         for ngram_size in range(min(self.max_matching_ngram_size, input_length - 1), 0, -1):
-            # Convert ngram to a tensor for comparison
-            ngram_tensor = input_ids[0, -ngram_size:]
-
-            # # Get the indices of matches
-            idx = self.get_n_gram_idx(ngram_tensor)
-
-            # Iterate through match indices to find a valid continuation
-            start_idx = idx + ngram_size
-            end_idx = start_idx + self.num_output_tokens
-            end_idx = min(end_idx, input_length)
-
-            if start_idx < end_idx:
-                chosen_ids = input_ids[0, start_idx:end_idx]
+            window = tuple(tokens[-ngram_size:])
+            positions = self.lookup_table.get(window)
+            if positions is not None:
+                # use the most recent continuation of the most frequent next token
+                counts = self.next_token_counts[window]
+                start_idx = max(reversed(positions), key=lambda idx: counts[tokens[idx]])
+                chosen_ids = tokens[start_idx:start_idx + self.num_output_tokens]
                 break
 
         if chosen_ids is None or len(chosen_ids) == 0:
@@ -244,7 +262,8 @@ class PromptLookupCandidateGenerator():
             return input_ids, None
 
         # Now need extend input_ids with chosen_ids
-        chosen_ids = chosen_ids.unsqueeze(0)
+        chosen_ids = torch.tensor(chosen_ids, dtype=input_ids.dtype,
+                                  device=input_ids.device).unsqueeze(0)
         candidate_input_ids = torch.cat((input_ids, chosen_ids), dim=1)
         # assisted_generation expects logits as well, but we don't have those here,
         # so returning None
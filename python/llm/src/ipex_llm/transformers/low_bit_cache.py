@@ -0,0 +1,243 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# On-disk cache of converted low-bit models for `from_pretrained`.
+# The first load of a checkpoint saves the converted model with `save_low_bit`,
+# later loads with the same checkpoint and conversion arguments use `load_low_bit`.
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import transformers
+from typing import Any, Dict, Optional, Tuple
+from .utils import logger
+
+CACHE_INFO_NAME = "ipex_llm_cache.json"
+# files of a checkpoint that affect the converted model
+CHECKPOINT_SUFFIXES = (".safetensors", ".bin", ".json", ".py")
+# huggingface hub cache stores files as blobs named by their sha256
+_HUB_BLOB_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# `from_pretrained` kwargs passed to `load_low_bit` on a cache hit
+LOAD_LOW_BIT_KWARGS = ["modules_to_not_convert", "cpu_embedding", "disk_embedding",
+                       "embedding_qtype", "torch_dtype", "trust_remote_code"]
+# `from_pretrained` kwargs which only affect how a model is loaded or converted,
+# not the converted weights, these are not part of the key
+NON_WEIGHT_KWARGS = ["convert_threads", "streaming_load", "low_cpu_mem_usage",
+                     "device_map", "trust_remote_code", "cache_dir", "force_download",
+                     "resume_download", "proxies", "local_files_only", "token",
+                     "use_auth_token"]
+
+
+def get_ipex_llm_version():
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version("ipex-llm")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def checkpoint_fingerprint(model_dir):
+    """
+    Fingerprint the checkpoint files in `model_dir`. Files in the huggingface hub cache
+    are identified by their blob sha256, other files by their size and modification time,
+    which avoids hashing hundreds of GB of weights at every load.
+    """
+    fingerprint = {}
+    for name in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, name)
+        if not name.endswith(CHECKPOINT_SUFFIXES) or not os.path.isfile(path):
+            continue
+        real_path = os.path.realpath(path)
+        blob = os.path.basename(real_path)
+        if _HUB_BLOB_PATTERN.match(blob):
+            fingerprint[name] = blob
+        else:
+            stat = os.stat(real_path)
+            fingerprint[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def resolve_model_dir(pretrained_model_name_or_path, revision=None):
+    """
+    Return the local directory of a checkpoint, or `None` if it is neither a local
+    directory nor downloaded to the huggingface hub cache.
+    """
+    pretrained_model_name_or_path = str(pretrained_model_name_or_path)
+    if os.path.isdir(pretrained_model_name_or_path):
+        return pretrained_model_name_or_path
+    try:
+        from huggingface_hub import snapshot_download
+        return snapshot_download(pretrained_model_name_or_path, revision=revision,
+                                 local_files_only=True)
+    except Exception:
+        return None
+
+
+class LowBitCache:
+    """
+    A directory of low-bit models converted by `from_pretrained`, each saved by
+    `save_low_bit(safe_serialization=True)` in a sub-directory named by its key.
+
+    The key hashes the checkpoint fingerprint, the low-bit type and the conversion
+    arguments which affect the converted weights, together with the ipex-llm and
+    transformers versions. Entries are evicted
+    in least recently used order once their total size exceeds `max_cache_size`.
+
+    Args:
+        cache_dir (`str`): the cache directory.
+        max_cache_size (`int` or `str`): size limit in bytes or a string like ``"100GB"``,
+            `None` means no limit.
+    """
+
+    def __init__(self, cache_dir, max_cache_size=None):
+        from transformers.utils.hub import convert_file_size_to_int
+        self.cache_dir = cache_dir
+        if max_cache_size is not None:
+            max_cache_size = convert_file_size_to_int(max_cache_size)
+        self.max_cache_size = max_cache_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, model_path, low_bit, optimize_model, imatrix_file=None, revision=None,
+                **kwargs) -> Tuple[Optional[str], Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Returns the key of converting `model_path` with `low_bit` and other `from_pretrained`
+        arguments, the information hashed into the key and the local directory of the
+        checkpoint, or `(None, None, None)` if the checkpoint is not available locally.
+        """
+        model_dir = resolve_model_dir(model_path, revision)
+        if model_dir is None:
+            return None, None, None
+        key_info = {
+            "checkpoint": checkpoint_fingerprint(model_dir),
+            "low_bit": low_bit,
+            "optimize_model": optimize_model,
+            "imatrix": file_sha256(imatrix_file) if imatrix_file is not None else None,
+            "kwargs": {name: value for name, value in kwargs.items()
+                       if name not in NON_WEIGHT_KWARGS and
+                       (isinstance(value, (type(None), bool, int, float, str, list, tuple))
+                        or name == "torch_dtype")},
+            "ipex_llm": get_ipex_llm_version(),
+            "transformers": transformers.__version__,
+        }
+        key_json = json.dumps(key_info, sort_keys=True, default=str)
+        return hashlib.sha256(key_json.encode()).hexdigest(), key_info, model_dir
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key) -> Optional[str]:
+        """
+        Returns the directory of a complete entry of `key` and marks it recently used,
+        or `None` on a miss.
+        """
+        entry_dir = self.entry_dir(key)
+        info_file = os.path.join(entry_dir, CACHE_INFO_NAME)
+        if not os.path.isfile(info_file):
+            return None
+        try:
+            with open(info_file, "r") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            info = None
+        if info is None or info.get("key", None) != key:
+            logger.warning(f"Removing invalid low-bit cache entry {entry_dir}")
+            self.remove(key)
+            return None
+        os.utime(entry_dir)
+        return entry_dir
+
+    def load(self, model_cls, key, optimize_model, **kwargs):
+        entry_dir = self.lookup(key)
+        if entry_dir is None:
+            return None
+        logger.info(f"Loading the converted low-bit model from cache {entry_dir}")
+        load_kwargs = {name: kwargs[name] for name in LOAD_LOW_BIT_KWARGS if name in kwargs}
+        if load_kwargs.get("torch_dtype", None) == "auto":
+            # `load_low_bit` reads the dtype from the saved config by default
+            load_kwargs.pop("torch_dtype")
+        try:
+            return model_cls.load_low_bit(entry_dir, optimize_model=optimize_model,
+                                          **load_kwargs)
+        except Exception as e:
+            logger.warning(f"Failed to load low-bit cache entry {entry_dir}: {e}, "
+                           "will convert the model again.")
+            self.remove(key)
+            return None
+
+    def save(self, model, key, key_info, model_dir):
+        """
+        Saves the converted `model` as the entry of `key`, with the `key_info` and
+        `model_dir` returned by `get_key`. The entry is written to a temporary directory
+        first and renamed, so that readers never see a partial entry.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        try:
+            model.save_low_bit(tmp_dir, safe_serialization=True)
+            # remote code of `trust_remote_code` models
+            for name in os.listdir(model_dir):
+                if name.endswith(".py") and not os.path.exists(os.path.join(tmp_dir, name)):
+                    shutil.copy(os.path.join(model_dir, name), tmp_dir)
+            with open(os.path.join(tmp_dir, CACHE_INFO_NAME), "w") as f:
+                json.dump({"key": key, **key_info}, f, indent=2, default=str)
+            os.rename(tmp_dir, self.entry_dir(key))
+        except Exception as e:
+            # e.g. another process saved the same entry first, the disk is full, or
+            # safetensors can't save tensors which partially share memory,
+            # the converted model is still returned by `from_pretrained`
+            logger.warning(f"Failed to save low-bit cache entry of {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        logger.info(f"Saved the converted low-bit model to cache {self.entry_dir(key)}")
+        self.evict()
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def entries(self):
+        """Returns `(key, size, last_used)` of all entries, least recently used first."""
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.entry_dir(key)
+            if key.startswith(".tmp-") or not os.path.isdir(entry_dir):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, name))
+                       for root, _, names in os.walk(entry_dir) for name in names)
+            entries.append((key, size, os.path.getmtime(entry_dir)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        if self.max_cache_size is None:
+            return
+        entries = self.entries()
+        cache_size = sum(size for _, size, _ in entries)
+        # the newest entry is evicted as well if it alone exceeds the limit
+        for key, size, _ in entries:
+            if cache_size <= self.max_cache_size:
+                break
+            logger.info(f"Evicting low-bit cache entry {self.entry_dir(key)}")
+            self.remove(key)
+            cache_size -= size
@@ -49,7 +49,7 @@ import torch.distributed
 import torch.nn.functional as F
 from torch import Tensor, dtype, nn
 from operator import mul
-from functools import reduce
+from functools import reduce, partial
 from ipex_llm.transformers.xpu_customize_fwd import custom_fwd, custom_bwd
 from ipex_llm.transformers.utils import is_autocast_enabled, get_autocast_dtype
 from ipex_llm.transformers.utils import get_xpu_device_name
@@ -598,6 +598,8 @@ class LowBitLinear(nn.Linear):
         self.is_lm_head = self.in_len * self.out_len >= 32000 * 4096 and self.bias is None
         self.low_memory_mode = self.is_lm_head
         self.act_order = act_order
+        # `DequantizedWeightCache` of CPU prefill, set by `DequantizedWeightCache.attach`
+        self.dequant_cache = None
         if act_order:
             self.register_buffer(
                 "g_idx_map",
@@ -698,7 +700,13 @@ class LowBitLinear(nn.Linear):
                 # convert if necessary, and compute a linear result
                 if is_server() and (not is_spr()) and \
                         self.qtype == SYM_INT4 and x_2d.shape[0] >= TORCH_LINEAR_THRESHOLD:
-                    x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape, self.weight_length)
+                    if self.dequant_cache is not None:
+                        x0_fp32 = self.dequant_cache.get_weight(
+                            self, partial(ggml_int4_convert_fp32, x0, self.weight_shape,
+                                          self.weight_length))
+                    else:
+                        x0_fp32 = ggml_int4_convert_fp32(x0, self.weight_shape,
+                                                         self.weight_length)
                     result = F.linear(x.to(dtype=x0_fp32.dtype), x0_fp32)
                 else:
                     # Weight does not need a convert
@@ -38,9 +38,11 @@
 #
 
 import copy
+import os
 import torch
 import warnings
 import transformers
+from functools import partial
 from typing import List
 from unittest.mock import patch
 from transformers.configuration_utils import PretrainedConfig
@@ -51,6 +53,8 @@ from ipex_llm.transformers.gguf.api import load_gguf_model
 
 from .utils import logger, load_state_dict
 from .utils import extract_local_archive_file, get_local_shard_files, load_imatrix_data
+from .utils import get_local_safetensors_files, is_low_bit_safetensors, get_safetensors_dtype
+from .utils import save_low_bit_safetensors, load_low_bit_safetensors
 from .patches import patch_flash_attn_import
 
 patched_training_mode = None
@@ -67,19 +71,35 @@ def save_low_bit(self, *args, **kwargs):
     origin_device = self.device
     self.to('cpu')
 
+    # pickled `.bin` shards by default, `safe_serialization=True` saves mmap-able
+    # safetensors shards with low-bit metadata instead
+    safe_serialization = kwargs.pop('safe_serialization', False)
     kwargs['safe_serialization'] = False
 
     architectures = getattr(self.config, "architectures", None)
     model_type = getattr(self.config, "model_type", None)
     disk_embedding = getattr(self.config, "bigdl_disk_embedding", False)
 
+    def save_weights():
+        if safe_serialization:
+            from transformers.dynamic_module_utils import custom_object_save
+            os.makedirs(args[0], exist_ok=True)
+            if self._auto_class is not None:
+                custom_object_save(self, args[0], config=self.config)
+            save_low_bit_safetensors(self, args[0],
+                                     max_shard_size=kwargs.get("max_shard_size", "5GB"))
+        else:
+            self.save_pretrained(*args, **kwargs)
+
     if disk_embedding:
         from ipex_llm.transformers.embedding import DiskEmbedding
+        embedding_dir = next((m.embedding_dir for m in self.modules()
+                              if isinstance(m, DiskEmbedding)), None)
         self.apply(DiskEmbedding.restore_normal_embedding)
-        self.save_pretrained(*args, **kwargs)
-        self.apply(DiskEmbedding.replace_normal_embedding)
+        save_weights()
+        self.apply(partial(DiskEmbedding.replace_normal_embedding, embedding_dir=embedding_dir))
     else:
-        self.save_pretrained(*args, **kwargs)
+        save_weights()
 
     if architectures:
         self.config.update({"architectures": architectures})
@@ -91,7 +111,6 @@ def save_low_bit(self, *args, **kwargs):
         self.generation_config.save_pretrained(args[0])
 
     import json
-    import os
     # We conveniently save all the keys of the model to have them on hand,
     # so that when using 'low_cpumem load',
     # it's not necessary to load the entire model to extract its keys
@@ -138,11 +157,31 @@ class _BaseAutoModelClass:
                             Default to be ``False``.
         :param cpu_embedding: Whether to replace the Embedding layer, may need to set it
             to ``True`` when running BigDL-LLM on GPU on Windows. Default to be ``False``.
-        :param disk_embedding: Whether to put the Embedding layer on disk to save memory.
-            Default to be ``False``.
+        :param disk_embedding: Whether to put the Embedding layer on disk to save memory,
+            or a str value of the directory to put it in. Default to be ``False``.
         :param imatrix: str value, represent filename of importance matrix pretrained on
             specific datasets for use with the improved quantization methods recently
-            added to llama.cpp.
+            added to llama.cpp. It can be collected by
+            `ipex_llm.transformers.imatrix.collect_imatrix`.
+        :param streaming_load: boolean value, Whether to load a local safetensors checkpoint
+            tensor by tensor and quantize each linear as soon as its weight is loaded,
+            so that the full precision model is never materialized and peak memory is
+            close to the low-bit model plus one shard. Model-specific pre-optimizations
+            (e.g. merging qkv linears) are applied before the weights are loaded, models
+            whose pre-optimizations rescale or pad weights fall back to the default load
+            method. Default to be ``False``.
+        :param convert_threads: int value, the number of threads to quantize linears with.
+            Default to be ``None``, which reads ``IPEX_LLM_CONVERT_THREADS`` and falls
+            back to ``1``, i.e. serial conversion.
+        :param low_bit_cache_dir: str value, a directory to cache converted low-bit models in.
+            The first load saves the converted model there, later loads of the same
+            checkpoint with the same arguments and ipex-llm version load it with
+            ``load_low_bit`` instead of converting again. Default to be ``None``, which
+            reads ``IPEX_LLM_LOW_BIT_CACHE_DIR`` and disables the cache if it is not set.
+        :param low_bit_cache_size: int or str value, size limit of ``low_bit_cache_dir`` in
+            bytes or like ``"100GB"``, least recently used models are evicted beyond it.
+            Default to be ``None``, which reads ``IPEX_LLM_LOW_BIT_CACHE_SIZE`` and means
+            no limit if it is not set.
         :param model_hub: str value, options are ``'huggingface'`` and ``'modelscope'``,
             specify the model hub. Default to be ``'huggingface'``.
         :param embedding_qtype: str value, options are ``'q2_k'``, ``'q4_k'`` now.
@@ -154,6 +193,13 @@ class _BaseAutoModelClass:
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
             to run pipeline parallel inference on multiple GPUs.
+        :param prefix_cache_bytes: int value, byte budget of the cross-request prefix KV cache.
+            If set, ``generate`` reuses the KV cache of the longest previously seen prompt
+            prefix and only prefills the remaining tokens. Default to be ``None``.
+        :param dequant_cache_bytes: int value, byte budget of dequantized sym_int4 weights
+            kept for CPU prefill on servers without AMX, which otherwise dequantize the
+            weight of a linear at every prefill. Default to be ``None``, which disables the
+            cache. Hit rate and memory usage are reported by ``model.dequant_cache.get_stats()``.
         :return: a model instance
         """
         pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path", None) \
@@ -188,8 +234,14 @@ class _BaseAutoModelClass:
         user_quantization_config = kwargs.pop("quantization_config", None)
         speculative = kwargs.pop("speculative", False)
         pipeline_parallel_stages = kwargs.pop("pipeline_parallel_stages", 1)
+        prefix_cache_bytes = kwargs.pop("prefix_cache_bytes", None)
+        dequant_cache_bytes = kwargs.pop("dequant_cache_bytes", None)
         torch_dtype = kwargs.pop("torch_dtype", None)
         embedding_qtype = kwargs.pop("embedding_qtype", None)
+        low_bit_cache_dir = kwargs.pop("low_bit_cache_dir",
+                                       os.environ.get("IPEX_LLM_LOW_BIT_CACHE_DIR", None))
+        low_bit_cache_size = kwargs.pop("low_bit_cache_size",
+                                        os.environ.get("IPEX_LLM_LOW_BIT_CACHE_SIZE", None))
 
         if user_quantization_config is not None and \
                 "BitsAndBytesConfig" in str(user_quantization_config.__class__):
@@ -346,7 +398,28 @@ class _BaseAutoModelClass:
                 imatrix_data = load_imatrix_data(imatrix_file)
                 kwargs["imatrix_data"] = imatrix_data
             kwargs["embedding_qtype"] = embedding_qtype
-            model = cls.load_convert(q_k, optimize_model, *args, **kwargs)
+
+            low_bit_cache = None
+            cache_key = None
+            if low_bit_cache_dir is not None and model_hub == "huggingface" and \
+                    kwargs.get("quantization_config", None) is None:
+                from .low_bit_cache import LowBitCache
+                low_bit_cache = LowBitCache(low_bit_cache_dir, low_bit_cache_size)
+                cache_key, cache_key_info, cache_model_dir = low_bit_cache.get_key(
+                    pretrained_model_name_or_path, q_k, optimize_model, imatrix_file, **kwargs)
+            model = None
+            if cache_key is not None:
+                model = low_bit_cache.load(cls, cache_key, optimize_model, **kwargs)
+            if model is None:
+                model = cls.load_convert(q_k, optimize_model, *args, **kwargs)
+                if low_bit_cache is not None:
+                    if cache_key is None:
+                        # the checkpoint may be just downloaded
+                        cache_key, cache_key_info, cache_model_dir = low_bit_cache.get_key(
+                            pretrained_model_name_or_path, q_k, optimize_model, imatrix_file,
+                            **kwargs)
+                    if cache_key is not None:
+                        low_bit_cache.save(model, cache_key, cache_key_info, cache_model_dir)
 
             if pipeline_parallel_stages > 1:
                 if speculative:
@@ -381,6 +454,14 @@ class _BaseAutoModelClass:
             model.lookup_generate = types.MethodType(lookup_generate, model)
             if model.config.model_type == "minicpmv" and hasattr(model, 'llm'):
                 model.llm.lookup_generate = types.MethodType(lookup_generate, model.llm)
+
+            if prefix_cache_bytes is not None:
+                from .prefix_cache import PrefixCache
+                model.prefix_cache = PrefixCache(prefix_cache_bytes)
+            if dequant_cache_bytes is not None:
+                from .dequant_cache import DequantizedWeightCache
+                model.dequant_cache = DequantizedWeightCache(dequant_cache_bytes)
+                model.dequant_cache.attach(model)
         else:
             # load default
             model = cls.HF_Model.from_pretrained(*args, **kwargs)
@@ -438,10 +519,24 @@ class _BaseAutoModelClass:
         if embedding_qtype is not None:
             embedding_qtype = ggml_tensor_qtype[embedding_qtype]
         disable_optimize_pre = kwargs.pop("disable_optimize_pre", False)
+        streaming_load = kwargs.pop("streaming_load", False)
+        convert_threads = kwargs.pop("convert_threads", None)
         _args = copy.deepcopy(args)
         _kwargs = copy.deepcopy(kwargs)
         awq_config = None
 
+        model = None
+        checkpoint_files = None
+        if streaming_load and quant_config is None:
+            pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path", None) \
+                if len(args) == 0 else args[0]
+            checkpoint_files = get_local_safetensors_files(pretrained_model_name_or_path,
+                                                           kwargs.get("subfolder", ""),
+                                                           kwargs.get("variant", None))
+            if checkpoint_files is None:
+                logger.info("`streaming_load` only supports local safetensors checkpoints, "
+                            "will fall to the default load method.")
+
         if quant_config and quant_config.quant_method == "awq":
             # The latest transformers only support cuda version
             # This load awq ckpt logic is copied from
@@ -484,7 +579,21 @@ class _BaseAutoModelClass:
                 device_map=device_map,
                 offload_dir=None
             )
-        else:
+        elif checkpoint_files is not None:
+            model = cls.load_convert_streaming(checkpoint_files, qtype, *args,
+                                               optimize_model=optimize_model and
+                                               not disable_optimize_pre,
+                                               modules_to_not_convert=modules_to_not_convert,
+                                               imatrix_data=imatrix_data,
+                                               mixed_precision=mixed_precision,
+                                               **kwargs)
+            if model is None:
+                logger.info("`streaming_load` doesn't support this model, "
+                            "will fall to the default load method.")
+            else:
+                # optimize_pre is applied while loading already
+                disable_optimize_pre = True
+        if model is None:
             if quant_config is not None:
                 kwargs["quantization_config"] = quant_config
             try:
@@ -506,14 +615,17 @@ class _BaseAutoModelClass:
                                      imatrix_data=imatrix_data,
                                      embedding_qtype=embedding_qtype,
                                      mixed_precision=mixed_precision,
-                                     disable_optimize_pre=disable_optimize_pre)
+                                     disable_optimize_pre=disable_optimize_pre,
+                                     convert_threads=convert_threads)
 
         if disk_embedding:
             from ipex_llm.transformers.embedding import DiskEmbedding
-            model.apply(DiskEmbedding.replace_normal_embedding)
+            embedding_dir = disk_embedding if isinstance(disk_embedding, str) else None
+            model.apply(partial(DiskEmbedding.replace_normal_embedding,
+                                embedding_dir=embedding_dir))
 
         model.config.update({"bigdl_transformers_low_bit": q_k,
-                             "bigdl_disk_embedding": disk_embedding})
+                             "bigdl_disk_embedding": bool(disk_embedding)})
 
         # enable tie_word_embeddings for MPT
         # refer to https://huggingface.co/mosaicml/mpt-7b-chat/blob/main/modeling_mpt.py#L232
@@ -527,6 +639,139 @@ class _BaseAutoModelClass:
 
         return model
 
+    @classmethod
+    def load_convert_streaming(cls, checkpoint_files, qtype, *args, **kwargs):
+        """
+        Build the model on meta device and load `checkpoint_files` (safetensors) into it
+        tensor by tensor. Each linear is converted to `qtype` as soon as its weights are
+        loaded and the full precision weight is freed, the remaining modules are left to
+        `ggml_convert_low_bit`. With `optimize_model`, `_optimize_pre` is applied to the
+        model on meta device first, so e.g. q, k and v are loaded into the merged qkv_proj
+        which is converted then. Returns `None` if this model can't be loaded this way.
+        """
+        from safetensors import safe_open
+        from accelerate.big_modeling import init_empty_weights
+        from accelerate.utils import set_module_tensor_to_device
+        from transformers import AutoConfig
+        from transformers.generation.configuration_utils import GenerationConfig
+        from transformers.modeling_utils import no_init_weights
+        from transformers.utils.generic import ContextManagers
+        from .convert import replace_with_low_bit_linear_for_loaded_module, \
+            optimize_pre_on_meta, get_enable_ipex
+
+        optimize_model = kwargs.pop("optimize_model", True)
+        modules_to_not_convert = kwargs.pop("modules_to_not_convert", None)
+        imatrix_data = kwargs.pop("imatrix_data", None)
+        mixed_precision = kwargs.pop("mixed_precision", False)
+        pretrained_model_name_or_path = kwargs.pop("pretrained_model_name_or_path", None) \
+            if len(args) == 0 else args[0]
+        trust_remote_code = kwargs.pop("trust_remote_code", None)
+        torch_dtype = kwargs.pop("torch_dtype", "auto")
+        config = kwargs.pop("config", None)
+        for key in ["low_cpu_mem_usage", "device_map", "variant"]:
+            kwargs.pop(key, None)
+
+        if config is None:
+            config, kwargs = AutoConfig.from_pretrained(pretrained_model_name_or_path,
+                                                        return_unused_kwargs=True,
+                                                        trust_remote_code=trust_remote_code,
+                                                        **kwargs)
+        if torch_dtype == "auto":
+            torch_dtype = getattr(config, "torch_dtype", None) or torch.float32
+        if isinstance(torch_dtype, str):
+            torch_dtype = getattr(torch, torch_dtype)
+
+        if config.architectures is not None and config.architectures[0] in \
+           ["ChatGLMModel", "ChatGLMForConditionalGeneration"]:
+            # ChatGLMModel uses skip_init which places modules on cpu by default
+            kwargs["device"] = "meta"
+        with ContextManagers([no_init_weights(_enable=True), init_empty_weights()]):
+            model = cls.HF_Model.from_config(config, trust_remote_code=trust_remote_code,
+                                             torch_dtype=torch_dtype, **kwargs)
+        model.eval()
+
+        expected_keys = set(model.state_dict().keys())
+        prefix = model.base_model_prefix
+        # checkpoint parameters moved or merged by `_optimize_pre`
+        key_map = {}
+        if optimize_model and not get_enable_ipex():
+            key_map = optimize_pre_on_meta(model, qtype)
+            if key_map is None:
+                return None
+        # rows of merged parameters which are not loaded yet
+        pending_rows = {}
+
+        # a tied lm_head shares the embedding weight and is converted later
+        tied_module = None
+        if getattr(config, "tie_word_embeddings", False):
+            tied_module = model.get_output_embeddings()
+
+        def to_model_key(key):
+            if key in expected_keys:
+                return key
+            if prefix and f"{prefix}.{key}" in expected_keys:
+                return f"{prefix}.{key}"
+            if prefix and key.startswith(f"{prefix}.") and \
+                    key[len(prefix) + 1:] in expected_keys:
+                return key[len(prefix) + 1:]
+            return None
+
+        unexpected_keys = []
+        for checkpoint_file in checkpoint_files:
+            with safe_open(checkpoint_file, framework="pt", device="cpu") as f:
+                for key in f.keys():
+                    model_key = to_model_key(key)
+                    if model_key is None:
+                        unexpected_keys.append(key)
+                        continue
+                    model_key, offset = key_map.get(model_key, (model_key, None))
+                    module_name, _, param_name = model_key.rpartition(".")
+                    module = model.get_submodule(module_name)
+                    tensor = f.get_tensor(key)
+                    param_dtype = torch_dtype if tensor.is_floating_point() else None
+                    if offset is None:
+                        set_module_tensor_to_device(model, model_key, "cpu", value=tensor,
+                                                    dtype=param_dtype)
+                    else:
+                        param = getattr(module, param_name)
+                        if param.device.type == "meta":
+                            set_module_tensor_to_device(
+                                model, model_key, "cpu",
+                                value=torch.empty(param.shape, dtype=param_dtype or tensor.dtype))
+                            pending_rows[model_key] = param.size(0)
+                        getattr(module, param_name).data[offset:offset + tensor.size(0)] = tensor
+                        pending_rows[model_key] -= tensor.size(0)
+                    del tensor
+                    if isinstance(module, torch.nn.Linear) and module is not tied_module and \
+                            all(param.device.type != "meta"
+                                for param in module.parameters(recurse=False)) and \
+                            all(pending_rows.get(f"{module_name}.{name}", 0) == 0
+                                for name, _ in module.named_parameters(recurse=False)):
+                        replace_with_low_bit_linear_for_loaded_module(
+                            model, qtype, module_name,
+                            modules_to_not_convert=modules_to_not_convert,
+                            imatrix_data=imatrix_data,
+                            mixed_precision=mixed_precision,
+                        )
+        if len(unexpected_keys) > 0:
+            logger.warning(f"Some weights of the checkpoint were not used: {unexpected_keys}")
+
+        model.tie_weights()
+        missing_keys = [name for name, param in model.named_parameters()
+                        if param.device.type == "meta"]
+        missing_keys += [name for name, rows in pending_rows.items() if rows > 0]
+        invalidInputError(len(missing_keys) == 0,
+                          f"Some weights are missing in the checkpoint: {missing_keys}, "
+                          "please load this model without `streaming_load`.")
+
+        if model.can_generate():
+            try:
+                model.generation_config = GenerationConfig.from_pretrained(
+                    pretrained_model_name_or_path)
+            except (OSError, TypeError):
+                pass
+        return model
+
     @classmethod
     @patch("transformers.dynamic_module_utils.get_imports", patch_flash_attn_import)
     def load_low_bit(cls,
@@ -542,6 +787,21 @@ class _BaseAutoModelClass:
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
             to run pipeline parallel inference on multiple GPUs.
+        :param prefix_cache_bytes: int value, byte budget of the cross-request prefix KV cache.
+            Default to be ``None``, which disables the prefix cache.
+        :param dequant_cache_bytes: int value, byte budget of dequantized sym_int4 weights
+            kept for CPU prefill. Default to be ``None``, which disables the cache.
+        :param lazy_load: boolean value, whether to leave decoder layers on meta device and
+            materialize each one on its first forward, so that the model is returned before
+            all layers are loaded. Only models saved by
+            ``save_low_bit(safe_serialization=True)`` support it, except models which do
+            not support ``low_cpu_mem_usage``, these are built and quantized on CPU before
+            loading and load all layers instead. Per-layer materialization
+            timings are reported by ``model.lazy_loader.get_timings()``.
+            Default to be ``False``.
+        :param lazy_prefetch_layers: int value, number of following decoder layers to
+            materialize in a background thread during the forward of a layer, only used
+            when ``lazy_load=True``. Default to be ``0``.
 
         :return: a model instance
         """
@@ -589,6 +849,12 @@ class _BaseAutoModelClass:
         sharded_metadata = None
 
         pipeline_parallel_stages = kwargs.pop("pipeline_parallel_stages", 1)
+        prefix_cache_bytes = kwargs.pop("prefix_cache_bytes", None)
+        dequant_cache_bytes = kwargs.pop("dequant_cache_bytes", None)
+        lazy_load = kwargs.pop("lazy_load", False)
+        lazy_prefetch_layers = kwargs.pop("lazy_prefetch_layers", 0)
+        invalidInputError(not (lazy_load and pipeline_parallel_stages > 1),
+                          "lazy_load is not supported with pipeline_parallel_stages > 1.")
 
         config_dict, _ = PretrainedConfig.get_config_dict(pretrained_model_name_or_path)
         bigdl_transformers_low_bit = config_dict.pop("bigdl_transformers_low_bit", False)
@@ -637,16 +903,33 @@ class _BaseAutoModelClass:
         elif type(config) in cls.HF_Model._model_mapping.keys():
             model_class = _get_model_class(config, cls.HF_Model._model_mapping)
 
-        resolved_archive_file, is_sharded = extract_local_archive_file(
-            pretrained_model_name_or_path,
-            subfolder,
-            variant)
-
-        if is_sharded:
-            resolved_archive_file, sharded_metadata = \
-                get_local_shard_files(pretrained_model_name_or_path,
-                                      resolved_archive_file,
-                                      subfolder=subfolder)
+        # prefer the safetensors layout saved by `save_low_bit(safe_serialization=True)`
+        safetensors_files = get_local_safetensors_files(pretrained_model_name_or_path,
+                                                        subfolder, variant)
+        if safetensors_files is not None and not is_low_bit_safetensors(safetensors_files[0]):
+            safetensors_files = None
+        if lazy_load and safetensors_files is None:
+            warnings.warn("lazy_load requires a model saved by "
+                          "save_low_bit(safe_serialization=True), load all layers instead.")
+            lazy_load = False
+        if lazy_load and not bigdl_lcmu_enabled:
+            # the model is built and quantized on cpu before any weight is loaded
+            warnings.warn("lazy_load is not supported for a model which does not support "
+                          "low_cpu_mem_usage, load all layers instead.")
+            lazy_load = False
+
+        is_sharded = False
+        if safetensors_files is None:
+            resolved_archive_file, is_sharded = extract_local_archive_file(
+                pretrained_model_name_or_path,
+                subfolder,
+                variant)
+
+            if is_sharded:
+                resolved_archive_file, sharded_metadata = \
+                    get_local_shard_files(pretrained_model_name_or_path,
+                                          resolved_archive_file,
+                                          subfolder=subfolder)
 
         # set dtype to instantiate the model under:
         # 1. If torch_dtype is not None, we use that dtype
@@ -663,7 +946,10 @@ class _BaseAutoModelClass:
                         torch_dtype = config.torch_dtype
 
                     else:
-                        if is_sharded and "dtype" in sharded_metadata:
+                        if safetensors_files is not None:
+                            torch_dtype = get_safetensors_dtype(safetensors_files[0]) \
+                                or torch.float32
+                        elif is_sharded and "dtype" in sharded_metadata:
                             torch_dtype = sharded_metadata["dtype"]
                         else:
                             one_state_dict = load_state_dict(resolved_archive_file[0])
@@ -702,49 +988,61 @@ class _BaseAutoModelClass:
                                      cpu_embedding=cpu_embedding,
                                      embedding_qtype=embedding_qtype, torch_dtype=torch_dtype)
 
-        if is_sharded:
-            loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
-        else:
-            import os
-            import json
-            with open(os.path.join(pretrained_model_name_or_path,
-                                   "load_keys.json"), "r") as json_file:
-                loaded_data = json.load(json_file)
-            loaded_state_dict_keys = loaded_data["all_checkpoint_keys"]
-
         # restore default dtype
         if dtype_orig is not None:
             torch.set_default_dtype(dtype_orig)
 
-        (
-            model,
-            missing_keys,
-            unexpected_keys,
-            mismatched_keys,
-            offload_index,
-            error_msgs,
-        ) = model_class._load_pretrained_model(
-            model,
-            None,
-            loaded_state_dict_keys,  # XXX: rename?
-            resolved_archive_file,
-            pretrained_model_name_or_path,
-            sharded_metadata=sharded_metadata,
-            _fast_init=False,  # always false to avoid pre-init behaviors
-            low_cpu_mem_usage=bigdl_lcmu_enabled,
-            offload_folder=offload_folder,
-            offload_state_dict=offload_state_dict,
-            dtype=torch_dtype,
-            keep_in_fp32_modules=[],
-        )
+        if safetensors_files is not None:
+            if lazy_load:
+                from .lazy_layers import LazyLayerLoader
+                lazy_loader = LazyLayerLoader(model, safetensors_files, dtype=torch_dtype,
+                                              prefetch_layers=lazy_prefetch_layers)
+                load_low_bit_safetensors(model, safetensors_files, dtype=torch_dtype,
+                                         skip_prefixes=lazy_loader.prefixes)
+                model.lazy_loader = lazy_loader
+            else:
+                load_low_bit_safetensors(model, safetensors_files, dtype=torch_dtype)
+        else:
+            if is_sharded:
+                loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
+            else:
+                import json
+                with open(os.path.join(pretrained_model_name_or_path,
+                                       "load_keys.json"), "r") as json_file:
+                    loaded_data = json.load(json_file)
+                loaded_state_dict_keys = loaded_data["all_checkpoint_keys"]
+
+            (
+                model,
+                missing_keys,
+                unexpected_keys,
+                mismatched_keys,
+                offload_index,
+                error_msgs,
+            ) = model_class._load_pretrained_model(
+                model,
+                None,
+                loaded_state_dict_keys,  # XXX: rename?
+                resolved_archive_file,
+                pretrained_model_name_or_path,
+                sharded_metadata=sharded_metadata,
+                _fast_init=False,  # always false to avoid pre-init behaviors
+                low_cpu_mem_usage=bigdl_lcmu_enabled,
+                offload_folder=offload_folder,
+                offload_state_dict=offload_state_dict,
+                dtype=torch_dtype,
+                keep_in_fp32_modules=[],
+            )
 
         # make sure token embedding weights are still tied if needed
         model.tie_weights()
 
         if disk_embedding:
             from ipex_llm.transformers.embedding import DiskEmbedding
-            model.apply(DiskEmbedding.replace_normal_embedding)
-            model.config.update({"bigdl_disk_embedding": disk_embedding})
+            embedding_dir = disk_embedding if isinstance(disk_embedding, str) else None
+            model.apply(partial(DiskEmbedding.replace_normal_embedding,
+                                embedding_dir=embedding_dir))
+            model.config.update({"bigdl_disk_embedding": True})
 
         # Set model in evaluation mode to deactivate DropOut modules by default
         model.eval()
@@ -782,6 +1080,14 @@ class _BaseAutoModelClass:
         if model.config.model_type == "minicpmv" and hasattr(model, 'llm'):
             model.llm.lookup_generate = types.MethodType(lookup_generate, model.llm)
 
+        if prefix_cache_bytes is not None:
+            from .prefix_cache import PrefixCache
+            model.prefix_cache = PrefixCache(prefix_cache_bytes)
+        if dequant_cache_bytes is not None:
+            from .dequant_cache import DequantizedWeightCache
+            model.dequant_cache = DequantizedWeightCache(dequant_cache_bytes)
+            model.dequant_cache.attach(model)
+
         return model
 
 
@@ -32,6 +32,9 @@ def merge_linear(linears: List[torch.nn.Linear]) -> torch.nn.Linear:
         new_linear.weight = torch.nn.Parameter(new_weight, requires_grad=False)
         new_linear.in_features = new_weight.size(1)
         new_linear.out_features = new_weight.size(0)
+        if new_weight.device.type == "meta":
+            # weights are loaded later, see `optimize_pre_on_meta`
+            new_linear.merged_linears = linears
         return new_linear
     else:
         return None
@@ -47,10 +47,11 @@ from transformers.models.llama.modeling_llama import apply_rotary_pos_emb
 from ipex_llm.transformers.models.common import merge_qkv_base
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
 from ipex_llm.transformers.models.utils import make_cache_contiguous_inplaced
-from ipex_llm.transformers.models.utils import use_quantize_kv_cache
+from ipex_llm.transformers.models.utils import use_quantize_kv_cache, use_geometric_kv_cache
 from ipex_llm.transformers.models.utils import should_use_compresskv, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache
 from ipex_llm.transformers.kv import DynamicCompressCache, DynamicCompressFp8Cache
+from ipex_llm.transformers.kv import GeometricKVCache
 
 
 def llama_model_forward(
@@ -78,6 +79,7 @@ def llama_model_forward(
         isinstance(past_key_values, DynamicCompressCache)
     # disable llama3.2 1b for prefill performance and output quality
     use_compresskv = use_compresskv and self.config.hidden_size != 2048
+    use_geometric_kv = use_geometric_kv_cache() or isinstance(past_key_values, GeometricKVCache)
     if use_cache:
         if use_compresskv and not isinstance(past_key_values, DynamicCompressCache):
             if use_quantize_kv:
@@ -86,9 +88,12 @@ def llama_model_forward(
                 past_key_values = DynamicCompressCache.from_legacy_cache(past_key_values)
         elif use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+        elif use_geometric_kv and not isinstance(past_key_values, GeometricKVCache):
+            past_key_values = GeometricKVCache.from_legacy_cache(past_key_values)
         elif (
             not use_quantize_kv
             and not use_compresskv
+            and not use_geometric_kv
             and not isinstance(past_key_values, DynamicNormalCache)
         ):
             past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
@@ -47,9 +47,10 @@ from ipex_llm.transformers.models.common import merge_qkv_base
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
 from ipex_llm.transformers.models.utils import should_use_fuse_rope, apply_rotary_pos_emb
 from ipex_llm.transformers.models.utils import should_use_compresskv, is_enough_kv_cache_room_4_36
-from ipex_llm.transformers.models.utils import use_quantize_kv_cache
+from ipex_llm.transformers.models.utils import use_quantize_kv_cache, use_geometric_kv_cache
 from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
 from ipex_llm.transformers.kv import DynamicCompressCache, DynamicCompressFp8Cache
+from ipex_llm.transformers.kv import GeometricKVCache
 KV_CACHE_ALLOC_BLOCK_LENGTH = int(os.environ.get("KV_CACHE_ALLOC_BLOCK_LENGTH", 256))
 
 
@@ -75,6 +76,7 @@ def mistral_model_forward(
                                             self.config.num_key_value_heads)
     use_compress_kv = should_use_compresskv(inputs, inputs.size(1)) or \
         isinstance(past_key_values, DynamicCompressCache)
+    use_geometric_kv = use_geometric_kv_cache() or isinstance(past_key_values, GeometricKVCache)
 
     if use_cache:
         if use_compress_kv and not isinstance(past_key_values, DynamicCompressCache):
@@ -84,9 +86,12 @@ def mistral_model_forward(
                 past_key_values = DynamicCompressCache.from_legacy_cache(past_key_values)
         elif use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+        elif use_geometric_kv and not isinstance(past_key_values, GeometricKVCache):
+            past_key_values = GeometricKVCache.from_legacy_cache(past_key_values)
         elif (
             not use_quantize_kv
             and not use_compress_kv
+            and not use_geometric_kv
             and not isinstance(past_key_values, DynamicNormalCache)
         ):
             past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
@@ -47,10 +47,10 @@ from ipex_llm.transformers.models.common import merge_qkv_base
 from ipex_llm.transformers.models.common import scaled_dot_product_attention
 from ipex_llm.transformers.models.utils import SILU, mlp_fusion_check
 from ipex_llm.transformers.models.utils import should_use_fuse_rope
-from ipex_llm.transformers.models.utils import use_quantize_kv_cache, \
+from ipex_llm.transformers.models.utils import use_quantize_kv_cache, use_geometric_kv_cache, \
     should_use_compresskv, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
-    DynamicCompressCache, DynamicCompressFp8Cache
+    DynamicCompressCache, DynamicCompressFp8Cache, GeometricKVCache
 
 from transformers.models.qwen2.modeling_qwen2 import Qwen2Model, Qwen2Attention, Qwen2MLP
 from transformers.models.qwen2.modeling_qwen2 import apply_rotary_pos_emb
@@ -83,6 +83,7 @@ def qwen2_model_forward(
 
     use_compress_kv = should_use_compresskv(inputs, inputs.shape[1]) or \
         isinstance(past_key_values, DynamicCompressCache)
+    use_geometric_kv = use_geometric_kv_cache() or isinstance(past_key_values, GeometricKVCache)
 
     if use_cache:
         if use_compress_kv and not isinstance(past_key_values, DynamicCompressCache):
@@ -93,8 +94,11 @@ def qwen2_model_forward(
         elif use_quantize_kv and not use_compress_kv and not isinstance(past_key_values,
                                                                         DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
-        if not use_quantize_kv and not use_compress_kv and not isinstance(past_key_values,
-                                                                          DynamicNormalCache):
+        elif use_geometric_kv and not use_quantize_kv and not use_compress_kv \
+                and not isinstance(past_key_values, GeometricKVCache):
+            past_key_values = GeometricKVCache.from_legacy_cache(past_key_values)
+        if not use_quantize_kv and not use_compress_kv and not use_geometric_kv \
+                and not isinstance(past_key_values, DynamicNormalCache):
             past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
     # ipex-llm changes end
 
@@ -330,6 +330,10 @@ def should_use_compresskv(x: torch.Tensor, prompt_len: int):
             return x.device.type == 'xpu' and use_compress_kv == "1"
 
 
+def use_geometric_kv_cache() -> bool:
+    return os.environ.get("IPEX_LLM_GEOMETRIC_KV_CACHE", "0") == "1"
+
+
 def get_compresskv_attn_mask(key_states: torch.Tensor,
                              attention_mask: torch.Tensor):
     if attention_mask is not None:
@@ -0,0 +1,287 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Cross-request prefix (prompt) KV cache for `generate`.
+# Prompt KV cache snapshots are indexed by their token ids in a radix tree,
+# a new request restores the longest cached prefix and only prefills the rest.
+
+import threading
+import torch
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Tuple
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache
+from ipex_llm.utils.common import invalidInputError
+
+
+class _RadixNode:
+    __slots__ = ("edge", "parent", "children", "cache")
+
+    def __init__(self, edge: Tuple[int, ...]=(), parent: Optional["_RadixNode"] = None):
+        self.edge = edge
+        self.parent = parent
+        self.children: Dict[int, _RadixNode] = {}
+        self.cache = None
+
+
+def _common_prefix_len(a: Sequence[int], b: Sequence[int], start: int) -> int:
+    n = min(len(a), len(b) - start)
+    i = 0
+    while i < n and a[i] == b[start + i]:
+        i += 1
+    return i
+
+
+def _set_seen_tokens(cache, seen_tokens: int):
+    if hasattr(cache, "_seen_tokens"):
+        # 4.39 uses `_seen_tokens`
+        cache._seen_tokens = seen_tokens
+    else:
+        # 4.37 uses `seen_tokens`
+        cache.seen_tokens = seen_tokens
+
+
+def _copy_kv(cache: torch.Tensor, length: int, reserve: int) -> torch.Tensor:
+    bsz, num_heads, _, head_dim = cache.shape
+    storage = torch.empty(bsz, num_heads, length + reserve, head_dim,
+                          dtype=cache.dtype, device=cache.device)
+    new_cache = storage.as_strided((bsz, num_heads, length, head_dim),
+                                   storage.stride(), storage_offset=0)
+    new_cache.copy_(cache[:, :, :length, :])
+    return new_cache
+
+
+def copy_kv_cache(past_key_values, length: int, reserve: int = 0):
+    """
+    Copy the first `length` tokens of a `DynamicNormalCache` or `DynamicFp8Cache`
+    into a new cache of the same type, with `reserve` tokens of free room per layer.
+    """
+    new_cache = past_key_values.__class__()
+    for k_cache, v_cache in zip(past_key_values.key_cache, past_key_values.value_cache):
+        new_cache.key_cache.append(_copy_kv(k_cache, length, reserve))
+        new_cache.value_cache.append(_copy_kv(v_cache, length, reserve))
+    _set_seen_tokens(new_cache, length)
+    return new_cache
+
+
+def kv_cache_nbytes(past_key_values) -> int:
+    return sum(cache.numel() * cache.element_size()
+               for cache in past_key_values.key_cache + past_key_values.value_cache)
+
+
+class PrefixCache:
+    """
+    A cross-request prompt KV cache.
+
+    KV cache snapshots of previous prompts are stored in a radix tree keyed by token ids,
+    a new prompt restores the longest prefix it shares with any cached prompt (cropping
+    a longer snapshot if needed), so only the remaining suffix has to be prefilled.
+    Snapshots are evicted in LRU order once their total size exceeds `max_cache_bytes`.
+
+    Args:
+        max_cache_bytes (`int`):
+            Byte budget of all cached KV snapshots.
+        min_prefix_len (`int`):
+            Cached prefixes shorter than this are not restored nor stored.
+    """
+
+    def __init__(self, max_cache_bytes: int, min_prefix_len: int = 16):
+        invalidInputError(max_cache_bytes > 0, "max_cache_bytes should be positive")
+        self.max_cache_bytes = max_cache_bytes
+        self.min_prefix_len = min_prefix_len
+        self.root = _RadixNode()
+        self.lru: "OrderedDict[_RadixNode, int]" = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+        self.num_requests = 0
+        self.num_hits = 0
+        self.num_prompt_tokens = 0
+        self.num_saved_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self.lru)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hits / self.num_requests if self.num_requests > 0 else 0.0
+
+    @property
+    def saved_token_rate(self) -> float:
+        if self.num_prompt_tokens == 0:
+            return 0.0
+        return self.num_saved_tokens / self.num_prompt_tokens
+
+    def get_stats(self) -> Dict[str, float]:
+        return {
+            "num_requests": self.num_requests,
+            "num_hits": self.num_hits,
+            "hit_rate": self.hit_rate,
+            "num_prompt_tokens": self.num_prompt_tokens,
+            "num_saved_tokens": self.num_saved_tokens,
+            "saved_token_rate": self.saved_token_rate,
+            "num_entries": len(self),
+            "cache_bytes": self.cache_bytes,
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.num_requests = 0
+            self.num_hits = 0
+            self.num_prompt_tokens = 0
+            self.num_saved_tokens = 0
+
+    def clear(self):
+        with self.lock:
+            self.root = _RadixNode()
+            self.lru.clear()
+            self.cache_bytes = 0
+
+    def match(self, tokens: Sequence[int]) -> Tuple[int, Optional[_RadixNode]]:
+        """
+        Returns the length of the longest prefix `tokens` shares with a cached prompt,
+        and the node holding that prompt's snapshot.
+        """
+        node, pos = self.root, 0
+        best_len, best_node = 0, None
+        while True:
+            if node.cache is not None:
+                best_len, best_node = pos, node
+            child = node.children.get(tokens[pos]) if pos < len(tokens) else None
+            if child is None:
+                break
+            matched = _common_prefix_len(child.edge, tokens, pos)
+            pos += matched
+            node = child
+            if matched < len(child.edge):
+                break
+        if pos > best_len:
+            # every leaf holds a snapshot, any snapshot below `node` shares `pos` tokens
+            while node.cache is None and node.children:
+                node = next(iter(node.children.values()))
+            if node.cache is not None:
+                best_len, best_node = pos, node
+        return best_len, best_node
+
+    def insert(self, tokens: Sequence[int], past_key_values):
+        node, pos = self.root, 0
+        while pos < len(tokens):
+            child = node.children.get(tokens[pos])
+            if child is None:
+                child = _RadixNode(tuple(tokens[pos:]), node)
+                node.children[tokens[pos]] = child
+                node = child
+                break
+            matched = _common_prefix_len(child.edge, tokens, pos)
+            if matched < len(child.edge):
+                # split the edge
+                mid = _RadixNode(child.edge[:matched], node)
+                node.children[tokens[pos]] = mid
+                child.edge = child.edge[matched:]
+                child.parent = mid
+                mid.children[child.edge[0]] = child
+                child = mid
+            node = child
+            pos += matched
+
+        if node.cache is not None:
+            self.cache_bytes -= self.lru.pop(node)
+        nbytes = kv_cache_nbytes(past_key_values)
+        node.cache = past_key_values
+        self.lru[node] = nbytes
+        self.cache_bytes += nbytes
+        while self.cache_bytes > self.max_cache_bytes and len(self.lru) > 1:
+            self._remove(next(iter(self.lru)))
+
+    def _remove(self, node: _RadixNode):
+        self.cache_bytes -= self.lru.pop(node)
+        node.cache = None
+        # prune nodes which hold no snapshot and have no children
+        while node.parent is not None and node.cache is None and not node.children:
+            del node.parent.children[node.edge[0]]
+            node = node.parent
+
+    def restore(self, tokens: Sequence[int]):
+        """
+        Returns a private copy of the longest cached prefix of `tokens` and its length,
+        or `(0, None)` on a miss.
+        """
+        with self.lock:
+            self.num_requests += 1
+            self.num_prompt_tokens += len(tokens)
+            prefix_len, node = self.match(tokens)
+            if node is None or prefix_len < self.min_prefix_len:
+                return 0, None
+            self.lru.move_to_end(node)
+            self.num_hits += 1
+            self.num_saved_tokens += prefix_len
+            return prefix_len, copy_kv_cache(node.cache, prefix_len,
+                                             DynamicNormalCache.KV_ALLOC_BLOCK_LENGTH)
+
+    def store(self, tokens: Sequence[int], past_key_values):
+        if len(tokens) < self.min_prefix_len:
+            return
+        snapshot = copy_kv_cache(past_key_values, len(tokens))
+        if kv_cache_nbytes(snapshot) > self.max_cache_bytes:
+            return
+        with self.lock:
+            self.insert(tokens, snapshot)
+
+    @torch.no_grad()
+    def prefill(self, model, input_ids: torch.LongTensor):
+        """
+        Prefill all prompt tokens except the last one, reusing the longest cached prefix.
+        Returns the resulting `past_key_values` which `generate` continues from, or `None`
+        if nothing could be reused.
+        """
+        tokens = input_ids[0].tolist()
+        # keep at least one token for `generate` to produce the first logits
+        tokens = tokens[:-1]
+        prefix_len, past_key_values = self.restore(tokens)
+        if prefix_len < len(tokens):
+            output = model(input_ids=input_ids[:, prefix_len:len(tokens)],
+                           past_key_values=past_key_values,
+                           use_cache=True, return_dict=True)
+            past_key_values = output.past_key_values
+            if isinstance(past_key_values, (DynamicNormalCache, DynamicFp8Cache)):
+                self.store(tokens, past_key_values)
+            elif prefix_len == 0:
+                # this model doesn't use ipex-llm's kv cache, nothing was reused
+                return None
+        return past_key_values
+
+
+def prefix_cache_generate_kwargs(model, inputs, generation_config, kwargs):
+    """
+    Prefill with `model.prefix_cache` and add the restored `past_key_values` to the
+    `generate` kwargs, `kwargs` is returned unchanged if the request is unsupported.
+    """
+    input_ids = inputs if inputs is not None else kwargs.get("input_ids", None)
+    generation_config = generation_config or getattr(model, "generation_config", None)
+    num_beams = kwargs.get("num_beams", getattr(generation_config, "num_beams", 1))
+    if (
+        input_ids is None
+        or input_ids.dim() != 2
+        or input_ids.size(0) != 1
+        or input_ids.size(1) < 2
+        or kwargs.get("past_key_values", None) is not None
+        or kwargs.get("inputs_embeds", None) is not None
+        or num_beams not in [None, 1]
+    ):
+        return kwargs
+    past_key_values = model.prefix_cache.prefill(model, input_ids)
+    if past_key_values is not None:
+        kwargs["past_key_values"] = past_key_values
+    return kwargs
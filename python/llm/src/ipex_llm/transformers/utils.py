@@ -40,6 +40,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import json
 from transformers.modeling_utils import _add_variant
 from ipex_llm.ggml.quantize import ggml_tensor_qtype, gguf_mixed_qtype
 from ..utils.common import invalidInputError
@@ -56,6 +57,18 @@ logger = logging.getLogger(__name__)
 
 WEIGHTS_NAME = "pytorch_model.bin"
 WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+# safetensors header metadata of packed low-bit weights, `{name: {"qtype":, "shape":}}`
+LOW_BIT_METADATA_KEY = "ipex_llm_low_bit"
+# safetensors header metadata of weights sharing another saved weight, `{name: saved_name}`
+TIED_WEIGHTS_METADATA_KEY = "ipex_llm_tied_weights"
+SAFETENSORS_FLOAT_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+}
 
 
 def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant=None):
@@ -130,6 +143,208 @@ def get_local_shard_files(pretrained_model_name_or_path, index_filename, subfold
     return shard_filenames, sharded_metadata
 
 
+def get_local_safetensors_files(pretrained_model_name_or_path, subfolder="", variant=None):
+    """
+    Return the safetensors files of a local checkpoint, or `None` if
+    `pretrained_model_name_or_path` is not a local safetensors checkpoint.
+    """
+    pretrained_model_name_or_path = str(pretrained_model_name_or_path)
+    folder = os.path.join(pretrained_model_name_or_path, subfolder)
+    if os.path.isfile(os.path.join(folder, _add_variant(SAFE_WEIGHTS_NAME, variant))):
+        return [os.path.join(folder, _add_variant(SAFE_WEIGHTS_NAME, variant))]
+    index_filename = os.path.join(folder, _add_variant(SAFE_WEIGHTS_INDEX_NAME, variant))
+    if os.path.isfile(index_filename):
+        shard_filenames, _ = get_local_shard_files(pretrained_model_name_or_path,
+                                                   index_filename, subfolder)
+        return shard_filenames
+    return None
+
+
+def read_safetensors_header(checkpoint_file):
+    """
+    Return the header size and the header of a safetensors file.
+    """
+    with open(checkpoint_file, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        return header_size, json.loads(f.read(header_size))
+
+
+def get_low_bit_metadata(header):
+    metadata = header.get("__metadata__", {})
+    return json.loads(metadata.get(LOW_BIT_METADATA_KEY, "{}"))
+
+
+def get_tied_weights_metadata(header):
+    metadata = header.get("__metadata__", {})
+    return json.loads(metadata.get(TIED_WEIGHTS_METADATA_KEY, "{}"))
+
+
+def is_low_bit_safetensors(checkpoint_file):
+    _, header = read_safetensors_header(checkpoint_file)
+    return LOW_BIT_METADATA_KEY in header.get("__metadata__", {})
+
+
+def get_safetensors_dtype(checkpoint_file):
+    """
+    Return the dtype of the first full precision floating tensor in a low-bit
+    safetensors file, or `None` if there isn't any.
+    """
+    _, header = read_safetensors_header(checkpoint_file)
+    low_bit_metadata = get_low_bit_metadata(header)
+    for name, info in header.items():
+        if name != "__metadata__" and name not in low_bit_metadata and \
+                info["dtype"] in SAFETENSORS_FLOAT_DTYPES:
+            return SAFETENSORS_FLOAT_DTYPES[info["dtype"]]
+    return None
+
+
+def save_low_bit_safetensors(model, save_directory, max_shard_size="5GB"):
+    """
+    Save the weights of a low-bit `model` as safetensors shards.
+
+    Packed low-bit weights are stored as uint8 tensors, and their qtype and original shape
+    are kept in the header metadata, so that `load_low_bit_safetensors` can map them
+    without copying.
+    """
+    from safetensors.torch import save_file
+    from transformers.utils.hub import convert_file_size_to_int
+    from ipex_llm.transformers.low_bit_linear import FP4Params
+
+    max_shard_size = convert_file_size_to_int(max_shard_size)
+    shards, shard_size = [{}], 0
+    # storage -> name of the saved tensor, and name -> saved name of tied tensors
+    saved_storages, tied_weights = {}, {}
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        if tensor.numel() > 0:
+            # tied weights are only saved once and tied again by `load_low_bit_safetensors`
+            storage = (tensor.data_ptr(), tensor.numel() * tensor.element_size())
+            if storage in saved_storages:
+                tied_weights[name] = saved_storages[storage]
+                continue
+            saved_storages[storage] = name
+        tensor_size = tensor.numel() * tensor.element_size()
+        if shard_size > 0 and shard_size + tensor_size > max_shard_size:
+            shards.append({})
+            shard_size = 0
+        shards[-1][name] = tensor
+        shard_size += tensor_size
+
+    weight_map = {}
+    total_size = 0
+    for idx, shard in enumerate(shards):
+        if len(shards) == 1:
+            shard_file = SAFE_WEIGHTS_NAME
+        else:
+            shard_file = f"model-{idx + 1:05d}-of-{len(shards):05d}.safetensors"
+        low_bit_metadata = {name: {"qtype": tensor.qtype, "shape": list(tensor._shape)}
+                            for name, tensor in shard.items()
+                            if isinstance(tensor, FP4Params)}
+        tensors = {name: tensor.detach().contiguous() for name, tensor in shard.items()}
+        save_file(tensors, os.path.join(save_directory, shard_file),
+                  metadata={"format": "pt",
+                            LOW_BIT_METADATA_KEY: json.dumps(low_bit_metadata),
+                            TIED_WEIGHTS_METADATA_KEY: json.dumps(tied_weights)})
+        for name, tensor in tensors.items():
+            weight_map[name] = shard_file
+            total_size += tensor.numel() * tensor.element_size()
+
+    if len(shards) > 1:
+        index = {"metadata": {"total_size": total_size}, "weight_map": weight_map}
+        with open(os.path.join(save_directory, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+
+def load_low_bit_safetensors(model, checkpoint_files, dtype=None, prefix="", skip_prefixes=()):
+    """
+    Load the safetensors files saved by `save_low_bit_safetensors` into `model`, whose
+    linears are already converted on meta device.
+
+    Packed low-bit weights become `FP4Params` viewing a copy-on-write mmap of the file, so
+    they are not copied into memory and are shared through the page cache with other
+    processes loading the same checkpoint. Other tensors are copied and floating ones
+    are cast to `dtype`.
+
+    If `model` is a submodule, `prefix` is its name in the saved model and only tensors
+    under it are loaded. Tensors under `skip_prefixes` are left on meta device.
+    """
+    from safetensors import safe_open
+    from accelerate.utils import set_module_tensor_to_device
+    from ipex_llm.transformers.low_bit_linear import FP4Params
+
+    expected_keys = set(model.state_dict().keys())
+    loaded_keys = set()
+    unexpected_keys = []
+    tied_weights = {}
+    for checkpoint_file in checkpoint_files:
+        header_size, header = read_safetensors_header(checkpoint_file)
+        low_bit_metadata = get_low_bit_metadata(header)
+        tied_weights.update(get_tied_weights_metadata(header))
+        data = np.memmap(checkpoint_file, dtype=np.uint8, mode='c')
+        data_start = 8 + header_size
+        with safe_open(checkpoint_file, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                if not key.startswith(prefix) or \
+                        any(key.startswith(skip_prefix) for skip_prefix in skip_prefixes):
+                    continue
+                name = key[len(prefix):]
+                if name not in expected_keys:
+                    unexpected_keys.append(name)
+                    continue
+                if key in low_bit_metadata:
+                    module_name, _, param_name = name.rpartition(".")
+                    module = model.get_submodule(module_name)
+                    start, end = header[key]["data_offsets"]
+                    old_param = module._parameters[param_name]
+                    qtype = low_bit_metadata[key]["qtype"]
+                    module._parameters[param_name] = FP4Params(
+                        torch.from_numpy(data[data_start + start:data_start + end]),
+                        requires_grad=False,
+                        quantized=True,
+                        _shape=torch.Size(low_bit_metadata[key]["shape"]),
+                        qtype=qtype,
+                        enable_scale_search=getattr(old_param, "enable_scale_search", False),
+                    )
+                    # the qtype may differ from the one the module is created with,
+                    # e.g. a q6_k lm_head with `mixed_precision`
+                    if hasattr(module, "qtype"):
+                        module.qtype = qtype
+                else:
+                    tensor = f.get_tensor(key)
+                    set_module_tensor_to_device(model, name, "cpu", value=tensor,
+                                                dtype=dtype if tensor.is_floating_point()
+                                                else None)
+                loaded_keys.add(name)
+
+    for key, saved_key in tied_weights.items():
+        if not key.startswith(prefix) or not saved_key.startswith(prefix):
+            continue
+        name, saved_name = key[len(prefix):], saved_key[len(prefix):]
+        if name not in expected_keys or saved_name not in loaded_keys:
+            continue
+        module_name, _, param_name = name.rpartition(".")
+        saved_module_name, _, saved_param_name = saved_name.rpartition(".")
+        module = model.get_submodule(module_name)
+        saved_module = model.get_submodule(saved_module_name)
+        if param_name in module._parameters:
+            param = saved_module._parameters[saved_param_name]
+            module._parameters[param_name] = param
+            if hasattr(module, "qtype") and isinstance(param, FP4Params):
+                module.qtype = param.qtype
+        else:
+            module._buffers[param_name] = saved_module._buffers[saved_param_name]
+        loaded_keys.add(name)
+
+    if len(unexpected_keys) > 0:
+        logger.warning(f"Some weights of the checkpoint were not used: {unexpected_keys}")
+    missing_keys = sorted(key for key in expected_keys - loaded_keys
+                          if not any((prefix + key).startswith(skip_prefix)
+                                     for skip_prefix in skip_prefixes))
+    invalidInputError(len(missing_keys) == 0,
+                      f"Some weights of {model.__class__.__name__} are missing in the "
+                      f"checkpoint: {missing_keys}")
+    return model
+
+
 def fix_key(key):
     if "beta" in key:
         return key.replace("beta", "bias")
@@ -42,6 +42,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
 import concurrent.futures
 import copy
 import enum
@@ -57,6 +58,7 @@ import re
 import signal
 import struct
 import sys
+import time
 import zipfile
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
@@ -410,7 +412,7 @@ def dequantize_q4(qvalues_pack32: NDArray, scales: NDArray,
 
     # Then split out the two values per int8 (which requires an actual
     # conversion because numpy doesn't natively support int4s).
-    qvalues = np.zeros([qvalues_pack8.shape[0], qvalues_pack8.shape[1] * 2], dtype=np.uint8)
+    qvalues = np.empty([qvalues_pack8.shape[0], qvalues_pack8.shape[1] * 2], dtype=np.uint8)
     qvalues[:, 0::2] = qvalues_pack8 & 0xf
     qvalues[:, 1::2] = qvalues_pack8 >> 4
 
@@ -472,10 +474,26 @@ class Tensor(metaclass=ABCMeta):
 def bf16_to_fp32(bf16_arr: np.ndarray) -> np.ndarray:
     invalidInputError(bf16_arr.dtype == np.uint16,
                       f"Input array should be of dtype uint16, but got {bf16_arr.dtype}.")
-    fp32_arr = bf16_arr.astype(np.uint32) << 16
+    # widen and shift in one pass, without a uint32 temporary
+    fp32_arr = np.empty(bf16_arr.shape, dtype=np.uint32)
+    np.left_shift(bf16_arr, 16, out=fp32_arr, dtype=np.uint32)
     return fp32_arr.view(np.float32)
 
 
+def bf16_astype(bf16_arr: np.ndarray, dtype: 'np.dtype[Any]',
+                chunk_size: int = 1 << 22) -> np.ndarray:
+    '''Convert a bf16 (uint16) array to `dtype` through float32 chunks of `chunk_size`
+    elements, so that the full float32 copy is never materialized.'''
+    if dtype == np.float32:
+        return bf16_to_fp32(bf16_arr)
+    bf16_flat = np.ascontiguousarray(bf16_arr).reshape(-1)
+    out = np.empty(bf16_arr.shape, dtype=dtype)
+    out_flat = out.reshape(-1)
+    for start in range(0, bf16_flat.size, chunk_size):
+        out_flat[start:start + chunk_size] = bf16_to_fp32(bf16_flat[start:start + chunk_size])
+    return out
+
+
 class UnquantizedTensor(Tensor):
     def __init__(self, ndarray: NDArray) -> None:
         self.ndarray = ndarray
@@ -484,7 +502,7 @@ class UnquantizedTensor(Tensor):
     def astype(self, data_type: DataType) -> Tensor:
         dtype = DATA_TYPE_TO_NUMPY[data_type]
         if self.data_type == DT_BF16:
-            self.ndarray = bf16_to_fp32(self.ndarray)
+            return UnquantizedTensor(bf16_astype(self.ndarray, dtype))
         return UnquantizedTensor(self.ndarray.astype(dtype))
 
     def to_ggml(self) -> 'UnquantizedTensor':
@@ -1040,7 +1058,7 @@ def lazy_load_safetensors_file(fp: IO[bytes], path: Path) -> ModelPlus:
             return UnquantizedTensor(np.frombuffer(buf, dtype=numpy_dtype).reshape(shape))
         description = f'safetensors begin={begin} end={end} type={data_type} path={path}'
         return LazyTensor(load, shape, data_type, description)
-    model = {name: convert(info) for (name, info) in header.items()}
+    model = {name: convert(info) for (name, info) in header.items() if name != '__metadata__'}
     return ModelPlus(model=model, paths=[path], format='safetensors', vocab=None)
 
 
@@ -1151,26 +1169,49 @@ def lazy_load_file(path: Path) -> ModelPlus:
 
 In = TypeVar('In')
 Out = TypeVar('Out')
+_END = object()
 
 
 def bounded_parallel_map(func: Callable[[In], Out], iterable: Iterable[In],
-                         concurrency: int) -> Iterable[Out]:
+                         concurrency: int, max_bytes: Optional[int] = None,
+                         nbytes: Optional[Callable[[In], int]]=None) -> Iterable[Out]:
     '''Parallel map, but with backpressure.  If the caller doesn't call `next`
     fast enough, this will stop calling `func` at some point rather than
     letting results pile up in memory.  Specifically, there is a max of one
-    output value buffered per thread.'''
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        items_rev = list(iterable)[::-1]
-        for i in range(min(concurrency, len(items_rev))):
-            futures.append(executor.submit(func, items_rev.pop()))
-        while futures:
-            result = futures.pop(0).result()
-            if items_rev:
-                futures.append(executor.submit(func, items_rev.pop()))
+    output value buffered per thread, and if `max_bytes` is given, the items in
+    flight are also limited to `max_bytes` as estimated by `nbytes(item)`
+    (but there is always at least one).  Results are yielded in order.'''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending: 'collections.deque[Tuple[concurrent.futures.Future, int]]' = \
+            collections.deque()
+        inflight_bytes = 0
+        items = iter(iterable)
+        item = next(items, _END)
+        while True:
+            while item is not _END and len(pending) < concurrency:
+                size = nbytes(item) if nbytes is not None else 0
+                if max_bytes is not None and pending and inflight_bytes + size > max_bytes:
+                    break
+                pending.append((executor.submit(func, item), size))
+                inflight_bytes += size
+                item = next(items, _END)
+            if not pending:
+                break
+            future, size = pending.popleft()
+            result = future.result()
+            inflight_bytes -= size
             yield result
 
 
+def default_concurrency() -> int:
+    return int(os.environ.get("IPEX_LLM_CONVERT_WORKERS", os.cpu_count() or 8))
+
+
+def lazy_tensor_nbytes(item: Tuple[str, 'LazyTensor']) -> int:
+    # upper bound of the float32 intermediates of loading and converting a tensor
+    return math.prod(item[1].shape) * 4
+
+
 def check_vocab_size(params: Params, vocab: Vocab) -> None:
     if params.n_vocab != vocab.vocab_size:
         # GGMLVocab comes from the same file as the model so shouldn't mismatch:
@@ -1234,7 +1275,14 @@ class OutputFile:
 
     @staticmethod
     def write_all(fname_out: Path, params: Params, file_type: GGMLFileType, model: LazyModel,
-                  vocab: Vocab) -> None:
+                  vocab: Vocab, concurrency: Optional[int] = None,
+                  max_inflight_bytes: int = 4 * 1024 ** 3) -> None:
+        '''Write the model as a ggml file.  Tensors are loaded, permuted and converted
+        by `concurrency` worker threads (default to `IPEX_LLM_CONVERT_WORKERS` or the
+        number of CPUs) while the written tensors are streamed to the file in order,
+        with at most `max_inflight_bytes` of tensors being converted at a time.'''
+        if concurrency is None:
+            concurrency = default_concurrency()
         check_vocab_size(params, vocab)
         of = OutputFile(fname_out)
         of.write_file_header(params, file_type)
@@ -1245,7 +1293,9 @@ class OutputFile:
             name, lazy_tensor = item
             return lazy_tensor.load().to_ggml().ndarray
 
-        ndarrays = bounded_parallel_map(do_item, model.items(), concurrency=8)
+        ndarrays = bounded_parallel_map(do_item, model.items(), concurrency=concurrency,
+                                        max_bytes=max_inflight_bytes, nbytes=lazy_tensor_nbytes)
+        start = time.perf_counter()
         for i, ((name, lazy_tensor), ndarray) in enumerate(zip(model.items(), ndarrays)):
             size = ' x '.join(f"{dim:6d}" for dim in lazy_tensor.shape)
             padi = len(str(len(model)))
@@ -1253,6 +1303,8 @@ class OutputFile:
                   f"| type {lazy_tensor.data_type}")
             of.write_tensor_header(name, lazy_tensor.shape, lazy_tensor.data_type)
             ndarray.tofile(of.fout)
+        print(f"Wrote {of.fout.tell() / 1024 ** 3:.2f} GB in {time.perf_counter() - start:.2f}s "
+              f"with {concurrency} workers")
         of.fout.close()
 
 
@@ -105,5 +105,74 @@ class TestConvertModel(TestCase):
                                 model_path=tempdir)
             assert new_model is not None
 
+
+@pytest.mark.parametrize('low_bit, mixed_precision, tie_word_embeddings', [
+    ('sym_int4', False, False),
+    ('sym_int4', True, False),
+    ('sym_int4', False, True),
+    ('bf16', False, True),
+])
+def test_transformer_save_load_safetensors(low_bit, mixed_precision, tie_word_embeddings):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    config = LlamaConfig(vocab_size=512, hidden_size=256, intermediate_size=512,
+                         num_hidden_layers=2, num_attention_heads=4,
+                         tie_word_embeddings=tie_word_embeddings, torch_dtype="float32")
+    input_ids = torch.tensor([[1, 5, 9, 3, 7, 2]])
+
+    with tempfile.TemporaryDirectory() as model_dir, \
+            tempfile.TemporaryDirectory() as low_bit_dir:
+        torch.manual_seed(0)
+        LlamaForCausalLM(config).save_pretrained(model_dir)
+        model = AutoModelForCausalLM.from_pretrained(model_dir, load_in_low_bit=low_bit,
+                                                     mixed_precision=mixed_precision)
+        model.save_low_bit(low_bit_dir, safe_serialization=True)
+        assert os.path.isfile(os.path.join(low_bit_dir, "model.safetensors"))
+        new_model = AutoModelForCausalLM.load_low_bit(low_bit_dir)
+
+        for name, module in model.named_modules():
+            assert getattr(module, "qtype", None) == \
+                getattr(new_model.get_submodule(name), "qtype", None), name
+        with torch.inference_mode():
+            logits = model(input_ids).logits
+            new_logits = new_model(input_ids).logits
+        assert torch.equal(logits, new_logits)
+
+
+@pytest.mark.parametrize('prefetch_layers', [0, 2])
+def test_transformer_lazy_load(prefetch_layers):
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+    config = LlamaConfig(vocab_size=512, hidden_size=256, intermediate_size=512,
+                         num_hidden_layers=4, num_attention_heads=4, torch_dtype="float32")
+    input_ids = torch.tensor([[1, 5, 9, 3, 7, 2]])
+
+    with tempfile.TemporaryDirectory() as model_dir, \
+            tempfile.TemporaryDirectory() as low_bit_dir:
+        torch.manual_seed(0)
+        LlamaForCausalLM(config).save_pretrained(model_dir)
+        model = AutoModelForCausalLM.from_pretrained(model_dir, load_in_4bit=True)
+        model.save_low_bit(low_bit_dir, safe_serialization=True)
+
+        eager_model = AutoModelForCausalLM.load_low_bit(low_bit_dir)
+        lazy_model = AutoModelForCausalLM.load_low_bit(low_bit_dir, lazy_load=True,
+                                                       lazy_prefetch_layers=prefetch_layers)
+        assert all(param.device.type == "meta"
+                   for param in lazy_model.model.layers.parameters())
+        # recorded and replayed when each layer is materialized
+        eager_model = eager_model.to("cpu").half()
+        lazy_model = lazy_model.to("cpu").half()
+        with torch.inference_mode():
+            logits = eager_model(input_ids).logits
+            lazy_logits = lazy_model(input_ids).logits
+
+        assert all(param.device.type == "cpu" and param.dtype != torch.float32
+                   for param in lazy_model.model.layers.parameters())
+        timings = lazy_model.lazy_loader.get_timings()
+        assert sorted(timing["layer"] for timing in timings) == \
+            list(range(config.num_hidden_layers))
+        assert torch.equal(logits, lazy_logits)
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -169,5 +169,54 @@ def test_optimize_model(Model, Tokenizer, model_path, prompt):
         assert (diff/logits_base_model.flatten()).mean()<0.05
 
 
+@pytest.mark.parametrize('model_type', ['llama', 'mistral', 'qwen2'])
+def test_streaming_load(model_type):
+    from transformers import AutoConfig
+    from transformers import AutoModelForCausalLM as HFAutoModelForCausalLM
+    config = AutoConfig.for_model(model_type, vocab_size=128, hidden_size=64,
+                                  intermediate_size=256, num_hidden_layers=2,
+                                  num_attention_heads=4, num_key_value_heads=2,
+                                  torch_dtype="float32")
+    input_ids = torch.tensor([[1, 5, 9, 3, 7, 2]])
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        torch.manual_seed(0)
+        HFAutoModelForCausalLM.from_config(config).save_pretrained(tempdir)
+        with torch.inference_mode():
+            model = AutoModelForCausalLM.from_pretrained(tempdir, load_in_4bit=True)
+            logits_base_model = model(input_ids).logits
+            model = AutoModelForCausalLM.from_pretrained(tempdir, load_in_4bit=True,
+                                                         streaming_load=True)
+            # q, k and v are merged and converted while loading
+            assert hasattr(model.model.layers[0].self_attn, "qkv_proj")
+            logits_streaming_model = model(input_ids).logits
+            model.generate(input_ids, do_sample=False, max_new_tokens=4)
+
+    assert torch.allclose(logits_base_model, logits_streaming_model)
+
+
+def test_low_bit_cache_mixed_precision():
+    from transformers import LlamaConfig, LlamaForCausalLM
+    config = LlamaConfig(vocab_size=512, hidden_size=256, intermediate_size=512,
+                         num_hidden_layers=2, num_attention_heads=4, torch_dtype="float32")
+    input_ids = torch.tensor([[1, 5, 9, 3, 7, 2]])
+
+    with tempfile.TemporaryDirectory() as model_dir, \
+            tempfile.TemporaryDirectory() as cache_dir:
+        torch.manual_seed(0)
+        LlamaForCausalLM(config).save_pretrained(model_dir)
+        logits = []
+        # the first load converts and saves the model, the second one hits the cache
+        for _ in range(2):
+            model = AutoModelForCausalLM.from_pretrained(model_dir, load_in_4bit=True,
+                                                         mixed_precision=True,
+                                                         low_bit_cache_dir=cache_dir)
+            with torch.inference_mode():
+                logits.append(model(input_ids).logits)
+        assert len(os.listdir(cache_dir)) == 1
+
+    assert torch.equal(logits[0], logits[1])
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -0,0 +1,18 @@
+#!/bin/bash
+
+export ANALYTICS_ZOO_ROOT=${ANALYTICS_ZOO_ROOT}
+export LLM_HOME=${ANALYTICS_ZOO_ROOT}/python/llm/src
+export LLM_UNIT_TEST_DIR=${ANALYTICS_ZOO_ROOT}/python/llm/test/unit
+
+set -e
+
+echo "# Start testing unit"
+start=$(date "+%s")
+
+python -m pytest -s ${LLM_UNIT_TEST_DIR} -v
+
+now=$(date "+%s")
+time=$((now-start))
+
+echo "Bigdl-llm tests finished"
+echo "Time used:$time seconds"
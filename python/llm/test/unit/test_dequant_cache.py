@@ -0,0 +1,119 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+
+from ipex_llm.transformers.dequant_cache import DequantizedWeightCache
+
+# bytes of a dequantized float32 weight of `Linear`
+WEIGHT_BYTES = 4 * 4 * 4
+
+
+class Linear(torch.nn.Module):
+    """Stands in for a `LowBitLinear`, `dequantize` counts the dequantizations."""
+
+    def __init__(self, value: float):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.full((4, 4), value), requires_grad=False)
+        self.num_dequantized = 0
+
+    def dequantize(self) -> torch.Tensor:
+        self.num_dequantized += 1
+        return self.weight.data.clone()
+
+
+class TestDequantizedWeightCache(unittest.TestCase):
+
+    def test_min_prefill_count(self):
+        cache = DequantizedWeightCache(max_cache_bytes=1 << 20, min_prefill_count=3)
+        linear = Linear(1.0)
+        for _ in range(5):
+            weight = cache.get_weight(linear, linear.dequantize)
+            self.assertTrue(torch.equal(weight, linear.weight.data))
+        # dequantized by the first 3 prefills, then served from the cache
+        self.assertEqual(linear.num_dequantized, 3)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.cache_bytes, WEIGHT_BYTES)
+        self.assertEqual(cache.num_hits, 2)
+
+        cache.reset_stats()
+        self.assertEqual(cache.get_stats()["num_lookups"], 0)
+        self.assertEqual(cache.get_stats()["num_entries"], 1)
+
+    def test_dtype(self):
+        cache = DequantizedWeightCache(max_cache_bytes=1 << 20, dtype=torch.bfloat16,
+                                       min_prefill_count=1)
+        linear = Linear(1.0)
+        self.assertEqual(cache.get_weight(linear, linear.dequantize).dtype, torch.bfloat16)
+        self.assertEqual(cache.cache_bytes, WEIGHT_BYTES // 2)
+
+    def test_only_evict_colder(self):
+        # room for two weights
+        cache = DequantizedWeightCache(max_cache_bytes=2 * WEIGHT_BYTES, min_prefill_count=1)
+        hot, warm, cold = Linear(1.0), Linear(2.0), Linear(3.0)
+        for linear, num_prefills in [(hot, 3), (warm, 2)]:
+            for _ in range(num_prefills):
+                cache.get_weight(linear, linear.dequantize)
+        self.assertEqual(len(cache), 2)
+
+        # a weight used once does not evict hotter ones
+        cache.get_weight(cold, cold.dequantize)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.num_evictions, 0)
+        self.assertNotIn(id(cold), cache.lru)
+
+        # once it is hotter than `warm` it evicts it, even though `hot` is older in LRU order
+        for _ in range(2):
+            cache.get_weight(cold, cold.dequantize)
+        self.assertEqual(set(cache.lru), {id(hot), id(cold)})
+        self.assertEqual(cache.num_evictions, 1)
+        self.assertEqual(cache.cache_bytes, 2 * WEIGHT_BYTES)
+
+        # a weight larger than the budget is never cached
+        small_cache = DequantizedWeightCache(max_cache_bytes=WEIGHT_BYTES - 1,
+                                             min_prefill_count=1)
+        for _ in range(2):
+            small_cache.get_weight(hot, hot.dequantize)
+        self.assertEqual(len(small_cache), 0)
+        self.assertEqual(small_cache.cache_bytes, 0)
+
+    def test_data_ptr_invalidation(self):
+        cache = DequantizedWeightCache(max_cache_bytes=1 << 20, min_prefill_count=1)
+        linear = Linear(1.0)
+        cache.get_weight(linear, linear.dequantize)
+        cache.get_weight(linear, linear.dequantize)
+        self.assertEqual(linear.num_dequantized, 1)
+
+        # replacing the weight storage, e.g. by `model.to(...)`, invalidates the entry
+        linear.weight.data = torch.full((4, 4), 5.0)
+        weight = cache.get_weight(linear, linear.dequantize)
+        self.assertEqual(linear.num_dequantized, 2)
+        self.assertTrue(torch.equal(weight, torch.full((4, 4), 5.0)))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.cache_bytes, WEIGHT_BYTES)
+        self.assertTrue(torch.equal(cache.get_weight(linear, linear.dequantize),
+                                    torch.full((4, 4), 5.0)))
+        self.assertEqual(linear.num_dequantized, 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.cache_bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import asyncio
+import os
+import string
+import tempfile
+import unittest
+
+import torch
+from transformers import BertConfig, BertModel, BertTokenizerFast
+from ipex_llm.serving.fastchat.ipex_llm_worker import BigDLLLMWorker, EmbeddingBatcher
+
+
+class TestEmbeddingBatcher(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as tempdir:
+            vocab_file = os.path.join(tempdir, "vocab.txt")
+            with open(vocab_file, "w") as f:
+                f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] +
+                                  list(string.ascii_lowercase)))
+            tokenizer = BertTokenizerFast(vocab_file)
+        torch.manual_seed(0)
+        config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=32,
+                            num_hidden_layers=2, num_attention_heads=4, intermediate_size=64)
+        # a worker without a controller or a loaded checkpoint
+        worker = BigDLLLMWorker.__new__(BigDLLLMWorker)
+        worker.model = BertModel(config).eval()
+        worker.tokenizer = tokenizer
+        worker.device = "cpu"
+        worker.context_len = 512
+        worker.embed_in_truncate = False
+        worker.call_ct = 0
+        cls.worker = worker
+
+    def test_merge_concurrent_submits(self):
+        worker = self.worker
+        batcher = EmbeddingBatcher(worker, max_wait_ms=500)
+        batch_sizes = []
+        get_embeddings_batch = worker.get_embeddings_batch
+
+        def record_batch(params_list, input_ids_list=None):
+            # tokenized once on submit
+            self.assertIsNotNone(input_ids_list)
+            batch_sizes.append(len(params_list))
+            return get_embeddings_batch(params_list, input_ids_list)
+
+        # inputs of the same length, so that padding does not change the embeddings
+        params_list = [{"input": ["a b"]}, {"input": ["c d", "e f"]}, {"input": ["g h"]}]
+
+        async def submit_all():
+            return await asyncio.gather(*[batcher.submit(params) for params in params_list])
+
+        worker.get_embeddings_batch = record_batch
+        try:
+            rets = asyncio.run(submit_all())
+        finally:
+            del worker.get_embeddings_batch
+        self.assertEqual(batch_sizes, [3])
+
+        for params, ret in zip(params_list, rets):
+            expected = worker.get_embeddings(params)
+            self.assertEqual(len(ret["embedding"]), len(params["input"]))
+            self.assertEqual(ret["token_num"], expected["token_num"])
+            torch.testing.assert_close(torch.tensor(ret["embedding"]),
+                                       torch.tensor(expected["embedding"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
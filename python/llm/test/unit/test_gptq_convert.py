@@ -0,0 +1,90 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import numpy as np
+
+from ipex_llm.gptq.convert.convert_gptq_to_ggml import expandToInt4, to_ggml_int16, \
+    qzeros_to_zeros
+
+
+# the previous loop implementations, which the vectorized ones should match
+
+def loop_expandToInt4(qweight):
+    eweight = qweight.repeat(8, axis=2)
+    eweight = eweight.astype(np.uint32)
+    for i in range(0, eweight.shape[2]):
+        offset = i % (32 // 4) * 4
+        eweight[:, :, i] = eweight[:, :, i] >> offset & (2 ** 4 - 1)
+    return eweight
+
+
+def loop_to_ggml_int16(eweight):
+    qweight = np.zeros((eweight.shape[0], eweight.shape[1], eweight.shape[2] // 4), dtype=np.uint16)
+    eweight = np.asarray(eweight, dtype=np.uint16)
+    for i in range(0, qweight.shape[2]):
+        qweight[:, :, i] = eweight[:, :, i * 2 + 0]
+        qweight[:, :, i] |= eweight[:, :, i * 2 + 32] << 1 * 4
+        qweight[:, :, i] |= eweight[:, :, i * 2 + 1] << 2 * 4
+        qweight[:, :, i] |= eweight[:, :, i * 2 + 33] << 3 * 4
+    return qweight.astype(np.int16)
+
+
+def loop_qzeros_to_zeros(qzeros, bits=4):
+    zeros = np.zeros((qzeros.shape[0], qzeros.shape[1] * (32 // bits)), dtype=np.float32)
+    i = 0
+    col = 0
+    while col < qzeros.shape[1]:
+        for j in range(i, i + (32 // bits)):
+            zeros[:, j] = (qzeros[:, col] >> (bits * (j - i)) & (2 ** bits - 1)) + 1
+        i += 32 // bits
+        col += 1
+    return zeros
+
+
+def random_int32(*shape):
+    rng = np.random.default_rng(0)
+    return rng.integers(np.iinfo(np.int32).min, np.iinfo(np.int32).max, size=shape,
+                        dtype=np.int32, endpoint=True)
+
+
+class TestGPTQUnpack(unittest.TestCase):
+
+    def test_expand_to_int4(self):
+        qweight = random_int32(16, 4, 8)
+        expanded = expandToInt4(qweight)
+        np.testing.assert_array_equal(expanded, loop_expandToInt4(qweight))
+        # extreme values
+        qweight = np.array([-1, 0, np.iinfo(np.int32).min, np.iinfo(np.int32).max],
+                           dtype=np.int32).reshape(1, 1, 4).repeat(2, axis=2)
+        np.testing.assert_array_equal(expandToInt4(qweight), loop_expandToInt4(qweight))
+
+    def test_to_ggml_int16(self):
+        eweight = loop_expandToInt4(random_int32(16, 4, 8))
+        grouped = to_ggml_int16(eweight)
+        self.assertEqual(grouped.dtype, np.int16)
+        np.testing.assert_array_equal(grouped, loop_to_ggml_int16(eweight))
+
+    def test_qzeros_to_zeros(self):
+        qzeros = random_int32(5, 12)
+        zeros = qzeros_to_zeros(qzeros)
+        self.assertEqual(zeros.dtype, np.float32)
+        np.testing.assert_array_equal(zeros, loop_qzeros_to_zeros(qzeros))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import os
+import tempfile
+import unittest
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, MixtralConfig, MixtralForCausalLM
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.imatrix import ImatrixCollector, imatrix_entry_name
+from ipex_llm.transformers.utils import get_cur_qtype_and_imatrix, load_imatrix_data
+
+
+class TestImatrix(unittest.TestCase):
+
+    def setUp(self):
+        # seeds the routing too, so that every mixtral expert gets some tokens
+        torch.manual_seed(0)
+
+    def collect(self, model):
+        collector = ImatrixCollector(model)
+        with torch.inference_mode():
+            for batch_size in [2, 1]:
+                collector.num_sequences = batch_size
+                model(torch.randint(0, model.config.vocab_size, (batch_size, 8)),
+                      use_cache=False)
+        collector.remove()
+        return collector
+
+    def check_round_trip(self, model):
+        collector = self.collect(model)
+        with tempfile.TemporaryDirectory() as tempdir:
+            imatrix_file = os.path.join(tempdir, "model.imatrix")
+            collector.save(imatrix_file)
+            imatrix_data = load_imatrix_data(imatrix_file)
+
+        expected = collector.get_imatrix_data()
+        self.assertEqual(set(imatrix_data), set(expected))
+        for key, data in expected.items():
+            torch.testing.assert_close(imatrix_data[key], data)
+        # every linear but lm_head gets its importance matrix when it is quantized
+        names = [name for name, module in model.named_modules()
+                 if isinstance(module, torch.nn.Linear) and name != "lm_head"]
+        self.assertEqual(len(imatrix_data), len(names))
+        for name in names:
+            _, cur_imatrix = get_cur_qtype_and_imatrix(ggml_tensor_qtype["gguf_iq2_xxs"],
+                                                       name, imatrix_data, model.config)
+            self.assertIsNotNone(cur_imatrix, name)
+            in_features = model.get_submodule(name).in_features
+            self.assertEqual(cur_imatrix.shape, (in_features,))
+        return imatrix_data
+
+    def test_llama(self):
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4)
+        self.assertEqual(imatrix_entry_name("model.layers.1.self_attn.o_proj"),
+                         "blk.1.attn_output.weight")
+        self.assertEqual(imatrix_entry_name("model.layers.0.mlp.gate_proj"),
+                         "blk.0.ffn_gate.weight")
+        self.assertIsNone(imatrix_entry_name("lm_head"))
+        imatrix_data = self.check_round_trip(LlamaForCausalLM(config).eval())
+        self.assertIn("1_o", imatrix_data)
+        self.assertIn("0_gate", imatrix_data)
+
+    def test_mixtral(self):
+        config = MixtralConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                               num_hidden_layers=2, num_attention_heads=4,
+                               num_key_value_heads=2, num_local_experts=4,
+                               num_experts_per_tok=2)
+        self.assertEqual(imatrix_entry_name("model.layers.0.block_sparse_moe.experts.3.w1"),
+                         "blk.0.ffn_gate.3.weight")
+        self.assertEqual(imatrix_entry_name("model.layers.1.block_sparse_moe.experts.0.w2"),
+                         "blk.1.ffn_down.0.weight")
+        self.assertEqual(imatrix_entry_name("model.layers.1.block_sparse_moe.gate"),
+                         "blk.1.ffn_gate_inp.weight")
+        imatrix_data = self.check_round_trip(MixtralForCausalLM(config).eval())
+        self.assertIn("0_gate_3", imatrix_data)
+        self.assertIn("1_down_0", imatrix_data)
+        self.assertIn("1_gate_inp", imatrix_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
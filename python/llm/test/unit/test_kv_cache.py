@@ -0,0 +1,69 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+
+from ipex_llm.transformers.kv import DynamicNormalCache, GeometricKVCache
+from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_36
+
+
+class TestGeometricKVCache(unittest.TestCase):
+
+    def test_update(self):
+        normal_cache, geometric_cache = DynamicNormalCache(), GeometricKVCache()
+        keys, values = [], []
+        for seq_len in [100] + [1] * 300:
+            key_states = torch.randn(2, 4, seq_len, 8)
+            value_states = torch.randn(2, 4, seq_len, 8)
+            keys.append(key_states)
+            values.append(value_states)
+            for layer_idx in range(2):
+                geometric_room = is_enough_kv_cache_room_4_36(geometric_cache, layer_idx, seq_len)
+                k_cache, v_cache = geometric_cache.update(key_states, value_states, layer_idx)
+                normal_cache.update(key_states, value_states, layer_idx)
+                if geometric_room:
+                    # appended in place
+                    self.assertEqual(k_cache.data_ptr(),
+                                     geometric_cache.key_cache[layer_idx].data_ptr())
+        for layer_idx in range(2):
+            self.assertTrue(torch.equal(geometric_cache.key_cache[layer_idx], torch.cat(keys, dim=2)))
+            self.assertTrue(torch.equal(geometric_cache.value_cache[layer_idx],
+                                        torch.cat(values, dim=2)))
+            self.assertTrue(torch.equal(geometric_cache[layer_idx][0],
+                                        normal_cache[layer_idx][0]))
+        self.assertEqual(geometric_cache.get_seq_length(), 400)
+
+    def test_growth(self):
+        cache = GeometricKVCache()
+        num_allocs, data_ptr = 0, None
+        for _ in range(64 * GeometricKVCache.GROWTH_UNIT):
+            states = torch.zeros(1, 1, 1, 4)
+            k_cache, _ = cache.update(states, states, 0)
+            if k_cache.data_ptr() != data_ptr:
+                num_allocs, data_ptr = num_allocs + 1, k_cache.data_ptr()
+            capacity = k_cache.stride(1) // k_cache.size(3)
+            self.assertEqual(capacity % GeometricKVCache.GROWTH_UNIT, 0)
+            self.assertGreaterEqual(capacity, k_cache.size(2))
+            if capacity > 8 * GeometricKVCache.GROWTH_UNIT:
+                self.assertLessEqual(capacity - k_cache.size(2), capacity // 4)
+        # size classes 1, 2, 3, 4, 5, 6, 7, 8, 10, 12, ..., 48, 56 and 64 units
+        self.assertEqual(num_allocs, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
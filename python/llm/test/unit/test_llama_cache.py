@@ -0,0 +1,132 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import os
+import tempfile
+import unittest
+from collections import deque
+
+import numpy as np
+from ipex_llm.ggml.model.llama import llama_cpp
+from ipex_llm.ggml.model.llama.llama import LlamaCache, LlamaState, LogitsRing
+
+N_VOCAB = 4
+STATE_SIZE = 64
+
+
+def make_state(tokens):
+    """A fake state of 128 bytes for 4 tokens, with data derived from its tokens."""
+    eval_logits = LogitsRing(16)
+    eval_logits.extend(np.array([[token] * N_VOCAB for token in tokens], dtype=np.float32))
+    llama_state = (llama_cpp.c_uint8 * STATE_SIZE)(*[tokens[0]] * STATE_SIZE)
+    return LlamaState(deque(tokens), eval_logits, llama_state, STATE_SIZE)
+
+
+class TestLlamaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.spill_dir.cleanup()
+
+    def spilled_files(self):
+        return os.listdir(self.spill_dir.name)
+
+    def assertStateEqual(self, state, expected):
+        self.assertEqual(state.eval_tokens, expected.eval_tokens)
+        np.testing.assert_array_equal(state.eval_logits.to_numpy(),
+                                      expected.eval_logits.to_numpy())
+        self.assertEqual(state.llama_state_size, expected.llama_state_size)
+        self.assertEqual(bytes(state.llama_state), bytes(expected.llama_state))
+
+    def test_prefix_lookup(self):
+        cache = LlamaCache()
+        state_a, state_b, state_c = make_state([1, 2, 3, 4]), make_state([1, 2, 5, 6]), \
+            make_state([1, 2])
+        cache[[1, 2, 3, 4]] = state_a
+        # splits the edge of [1, 2, 3, 4] after [1, 2]
+        cache[[1, 2, 5, 6]] = state_b
+        mid = cache.root.children[1]
+        self.assertEqual(mid.edge, (1, 2))
+        self.assertIsNone(mid.state)
+        self.assertEqual({token: child.edge for token, child in mid.children.items()},
+                         {3: (3, 4), 5: (5, 6)})
+
+        self.assertIs(cache.get([1, 2, 3, 4, 9]), state_a)
+        self.assertIs(cache.get([1, 2, 5]), state_b)
+        # [1, 2] holds no state, any state below it shares the prefix
+        self.assertIn(cache.get([1, 2, 7]), [state_a, state_b])
+        cache[[1, 2]] = state_c
+        self.assertIs(cache.get([1, 2, 7]), state_c)
+        self.assertIs(cache[[1, 2, 3]], state_a)
+        self.assertIsNone(cache.get([9, 1, 2]))
+        self.assertNotIn([9], cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.cache_size, 96 + 2 * 128)
+
+    def test_spill_and_promote(self):
+        cache = LlamaCache(capacity_bytes=256, spill_dir=self.spill_dir.name)
+        states = {key: make_state(list(key)) for key in [(1, 1, 1, 1), (2, 2, 2, 2),
+                                                         (3, 3, 3, 3)]}
+        for key, state in states.items():
+            cache[key] = state
+        # the least recently used state is written to the spill dir
+        self.assertEqual(len(cache), 3)
+        self.assertEqual((cache.cache_size, cache.spill_size), (256, 128))
+        self.assertEqual(len(self.spilled_files()), 1)
+        self.assertEqual([node.edge for node in cache.spill_lru], [(1, 1, 1, 1)])
+
+        # a hit reads it back into memory, which spills the next least recently used one
+        state = cache.get([1, 1, 1, 1, 5])
+        self.assertStateEqual(state, states[(1, 1, 1, 1)])
+        self.assertIs(cache.get([1, 1, 1, 1]), state)
+        self.assertEqual([node.edge for node in cache.memory_lru],
+                         [(3, 3, 3, 3), (1, 1, 1, 1)])
+        self.assertEqual([node.edge for node in cache.spill_lru], [(2, 2, 2, 2)])
+        self.assertEqual(len(self.spilled_files()), 1)
+        self.assertEqual((cache.cache_size, cache.spill_size), (256, 128))
+        self.assertStateEqual(cache.get([2, 2, 2, 2]), states[(2, 2, 2, 2)])
+
+    def test_spill_capacity(self):
+        cache = LlamaCache(capacity_bytes=256, spill_dir=self.spill_dir.name,
+                           spill_capacity_bytes=128)
+        for token in range(1, 5):
+            cache[[token] * 4] = make_state([token] * 4)
+        # [1] * 4 is spilled, then dropped to spill [2] * 4
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn([1], cache)
+        self.assertEqual([node.edge for node in cache.spill_lru], [(2, 2, 2, 2)])
+        self.assertEqual(len(self.spilled_files()), 1)
+        self.assertEqual((cache.cache_size, cache.spill_size), (256, 128))
+        self.assertEqual(list(cache.root.children), [2, 3, 4])
+
+    def test_clear(self):
+        cache = LlamaCache(capacity_bytes=128, spill_dir=self.spill_dir.name)
+        for token in range(1, 4):
+            cache[[token] * 4] = make_state([token] * 4)
+        self.assertEqual(len(self.spilled_files()), 2)
+        cache.clear()
+        self.assertEqual(self.spilled_files(), [])
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.cache_size, cache.spill_size), (0, 0))
+        self.assertIsNone(cache.get([1, 1, 1, 1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import random
+import unittest
+from collections import deque
+
+import numpy as np
+from ipex_llm.ggml.model.llama.llama import LogitsRing
+
+N_VOCAB = 3
+
+
+class TestLogitsRing(unittest.TestCase):
+
+    def assertRingEqual(self, ring, expected):
+        self.assertEqual(len(ring), len(expected))
+        array = ring.to_numpy()
+        self.assertEqual(len(array), len(expected))
+        for idx, row in enumerate(expected):
+            np.testing.assert_array_equal(array[idx], row)
+            np.testing.assert_array_equal(ring[idx], row)
+            np.testing.assert_array_equal(ring[idx - len(expected)], row)
+        for row, expected_row in zip(ring, expected):
+            np.testing.assert_array_equal(row, expected_row)
+
+    def test_against_deque(self):
+        rng = random.Random(0)
+        ring, expected = LogitsRing(7), deque(maxlen=7)
+        next_value = 0
+        for _ in range(500):
+            op = rng.random()
+            if op < 0.6:
+                # up to more rows than fit, to wrap around
+                n = rng.randint(0, 9)
+                rows = np.arange(next_value, next_value + n * N_VOCAB,
+                                 dtype=np.float32).reshape(n, N_VOCAB)
+                next_value += n * N_VOCAB
+                ring.extend(rows)
+                expected.extend(rows)
+            elif op < 0.85:
+                if len(expected) > 0:
+                    np.testing.assert_array_equal(ring.pop(), expected.pop())
+            elif op < 0.95:
+                copy = ring.copy()
+                self.assertEqual(copy.maxlen, ring.maxlen)
+                self.assertRingEqual(copy, expected)
+                # the copy does not share rows with the ring
+                copy.extend(np.full((7, N_VOCAB), -1, dtype=np.float32))
+                self.assertRingEqual(ring, expected)
+            else:
+                ring.clear()
+                expected.clear()
+            self.assertRingEqual(ring, expected)
+            self.assertLessEqual(len(ring.data) if ring.data is not None else 0, 7)
+
+    def test_pop(self):
+        ring = LogitsRing(3)
+        ring.extend(np.arange(12, dtype=np.float32).reshape(4, N_VOCAB))
+        row = ring.pop()
+        np.testing.assert_array_equal(row, [9, 10, 11])
+        # the popped row is a copy, which is not overwritten by the next rows
+        ring.extend(np.zeros((3, N_VOCAB), dtype=np.float32))
+        np.testing.assert_array_equal(row, [9, 10, 11])
+        for _ in range(3):
+            ring.pop()
+        with self.assertRaisesRegex(Exception, "pop from an empty LogitsRing"):
+            ring.pop()
+        with self.assertRaisesRegex(Exception, "index out of range"):
+            ring[0]
+
+    def test_grow(self):
+        ring = LogitsRing(100)
+        for value in range(10):
+            ring.extend(np.full((1, N_VOCAB), value, dtype=np.float32))
+        # grows geometrically up to maxlen instead of allocating maxlen rows
+        self.assertEqual(len(ring.data), 16)
+        self.assertEqual(ring.to_numpy()[:, 0].tolist(), list(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
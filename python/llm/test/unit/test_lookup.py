@@ -0,0 +1,88 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import unittest
+import torch
+
+from ipex_llm.transformers.lookup import PromptLookupCandidateGenerator
+
+
+class TestPromptLookupCandidateGenerator(unittest.TestCase):
+
+    def get_candidates(self, generator, tokens):
+        input_ids = torch.tensor([tokens])
+        candidate_input_ids, _ = generator.get_candidates(input_ids)
+        self.assertEqual(candidate_input_ids[:, :len(tokens)].tolist(), [tokens])
+        return candidate_input_ids[0, len(tokens):].tolist()
+
+    def test_add_token(self):
+        generator = PromptLookupCandidateGenerator(num_output_tokens=3,
+                                                   max_matching_ngram_size=2)
+        for token in [1, 2, 3, 1, 2, 4, 1, 2, 4]:
+            generator.add_token(token)
+        self.assertEqual(generator.lookup_table[(1, 2)], [2, 5, 8])
+        self.assertEqual(generator.lookup_table[(2,)], [2, 5, 8])
+        self.assertEqual(generator.lookup_table[(4, 1)], [7])
+        self.assertEqual(generator.next_token_counts[(1, 2)], {3: 1, 4: 2})
+        self.assertEqual(generator.next_token_counts[(1,)], {2: 3})
+        # the last 4 has no continuation yet
+        self.assertEqual(generator.lookup_table[(4,)], [6])
+
+    def test_update_look_up_table(self):
+        tokens = [5, 6, 7, 5, 6, 8, 5, 6]
+        generator = PromptLookupCandidateGenerator(max_matching_ngram_size=2)
+        generator.init_look_up_table(torch.tensor([tokens[:3]]))
+        generator.update_look_up_table(torch.tensor([tokens[:5]]))
+        generator.update_look_up_table(torch.tensor([tokens]))
+        expected = PromptLookupCandidateGenerator(max_matching_ngram_size=2)
+        expected.init_look_up_table(torch.tensor([tokens]))
+        self.assertEqual(generator.tokens, tokens)
+        self.assertEqual(generator.lookup_table, expected.lookup_table)
+        self.assertEqual(generator.next_token_counts, expected.next_token_counts)
+
+    def test_get_candidates(self):
+        generator = PromptLookupCandidateGenerator(num_output_tokens=3,
+                                                   max_matching_ngram_size=2)
+        # 4 follows (1, 2) more often than the more recent 3
+        self.assertEqual(self.get_candidates(generator, [1, 2, 4, 9, 1, 2, 4, 8, 1, 2, 3, 7,
+                                                         1, 2]),
+                         [4, 8, 1])
+        # ties are broken by recency
+        generator.init_look_up_table(torch.tensor([[1, 2, 4, 9, 1, 2, 3, 7]]))
+        self.assertEqual(self.get_candidates(generator, [1, 2, 4, 9, 1, 2, 3, 7, 1, 2]),
+                         [3, 7, 1])
+        # falls back to a shorter n-gram
+        generator.init_look_up_table(torch.tensor([[6, 2, 5]]))
+        self.assertEqual(self.get_candidates(generator, [6, 2, 5, 3, 2]), [5, 3, 2])
+        # no match, the input is returned unchanged
+        generator.init_look_up_table(torch.tensor([[1, 2, 3]]))
+        self.assertEqual(self.get_candidates(generator, [1, 2, 3, 4]), [])
+
+    def test_max_branches(self):
+        generator = PromptLookupCandidateGenerator(num_output_tokens=2,
+                                                   max_matching_ngram_size=1,
+                                                   max_branches=2)
+        tokens = [1, 3, 1, 3, 1, 3, 1, 4, 1, 4, 1]
+        self.assertEqual(self.get_candidates(generator, tokens), [4, 1])
+        # only the 2 most recent continuations of 1 are kept, but all are counted
+        self.assertEqual(generator.lookup_table[(1,)], [7, 9])
+        self.assertEqual(generator.next_token_counts[(1,)], {3: 3, 4: 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
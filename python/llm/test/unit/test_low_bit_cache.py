@@ -0,0 +1,76 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import tempfile
+import unittest
+
+from ipex_llm.transformers.low_bit_cache import LowBitCache
+
+
+class FailingModel:
+    def save_low_bit(self, save_dir, safe_serialization=False):
+        with open(os.path.join(save_dir, "model.safetensors"), "wb") as f:
+            f.write(b"partial")
+        raise RuntimeError("Some tensors share memory")
+
+
+class SavingModel:
+    def save_low_bit(self, save_dir, safe_serialization=False):
+        with open(os.path.join(save_dir, "model.safetensors"), "wb") as f:
+            f.write(b"weights")
+
+
+class TestLowBitCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.model_dir = os.path.join(self.tempdir.name, "model")
+        os.makedirs(self.model_dir)
+        with open(os.path.join(self.model_dir, "config.json"), "w") as f:
+            f.write("{}")
+        self.cache = LowBitCache(os.path.join(self.tempdir.name, "cache"))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_key(self):
+        key, _, model_dir = self.cache.get_key(self.model_dir, "sym_int4", True)
+        self.assertEqual(model_dir, self.model_dir)
+        # loading options don't change the converted weights
+        self.assertEqual(self.cache.get_key(self.model_dir, "sym_int4", True,
+                                            convert_threads=4, streaming_load=True)[0], key)
+        self.assertNotEqual(self.cache.get_key(self.model_dir, "sym_int4", True,
+                                               mixed_precision=True)[0], key)
+        self.assertNotEqual(self.cache.get_key(self.model_dir, "sym_int8", True)[0], key)
+
+    def test_save_and_lookup(self):
+        key, key_info, model_dir = self.cache.get_key(self.model_dir, "sym_int4", True)
+        self.assertIsNone(self.cache.lookup(key))
+        self.cache.save(SavingModel(), key, key_info, model_dir)
+        self.assertEqual(self.cache.lookup(key), self.cache.entry_dir(key))
+
+    def test_save_failure(self):
+        key, key_info, model_dir = self.cache.get_key(self.model_dir, "sym_int4", True)
+        # the error is logged instead of failing `from_pretrained`
+        self.cache.save(FailingModel(), key, key_info, model_dir)
+        self.assertIsNone(self.cache.lookup(key))
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+
+from ipex_llm.transformers.kv import DynamicNormalCache
+from ipex_llm.transformers.prefix_cache import PrefixCache, kv_cache_nbytes
+
+NUM_HEADS = 2
+HEAD_DIM = 4
+# bytes of one token of a one layer float32 snapshot
+TOKEN_BYTES = 2 * NUM_HEADS * HEAD_DIM * 4
+
+
+def make_cache(tokens):
+    # encode the token ids in the values so that restored snapshots can be checked
+    states = torch.tensor(tokens, dtype=torch.float32).view(1, 1, -1, 1)
+    states = states.expand(1, NUM_HEADS, len(tokens), HEAD_DIM).contiguous()
+    cache = DynamicNormalCache()
+    cache.update(states, states.clone(), 0)
+    return cache
+
+
+class TestPrefixCache(unittest.TestCase):
+
+    def test_match_longest_prefix(self):
+        prefix_cache = PrefixCache(max_cache_bytes=1 << 20, min_prefix_len=1)
+        prefix_cache.store(list(range(20)), make_cache(list(range(20))))
+        branch = list(range(10)) + [50, 51, 52]
+        prefix_cache.store(branch, make_cache(branch))
+
+        # a longer snapshot is cropped to the shared prefix
+        self.assertEqual(prefix_cache.match(list(range(15)) + [99])[0], 15)
+        self.assertEqual(prefix_cache.match(list(range(10)) + [50, 51, 52, 53])[0], 13)
+        self.assertEqual(prefix_cache.match(list(range(10)) + [77])[0], 10)
+        self.assertEqual(prefix_cache.match(list(range(25)))[0], 20)
+        self.assertEqual(prefix_cache.match([99, 0, 1]), (0, None))
+
+    def test_restore(self):
+        prefix_cache = PrefixCache(max_cache_bytes=1 << 20, min_prefix_len=4)
+        tokens = list(range(20))
+        prefix_cache.store(tokens, make_cache(tokens))
+
+        prefix_len, past_key_values = prefix_cache.restore(list(range(12)) + [99, 98])
+        self.assertEqual(prefix_len, 12)
+        self.assertEqual(past_key_values.get_seq_length(), 12)
+        self.assertEqual(past_key_values.key_cache[0][0, 0, :, 0].tolist(), list(range(12)))
+        # the restored cache is a private copy with free room to append to
+        past_key_values.key_cache[0].zero_()
+        self.assertEqual(prefix_cache.restore(tokens)[1].key_cache[0][0, 0, :, 0].tolist(),
+                         tokens)
+
+        # prefixes shorter than `min_prefix_len` are misses
+        self.assertEqual(prefix_cache.restore([0, 1, 2, 99]), (0, None))
+        self.assertEqual(prefix_cache.num_requests, 3)
+        self.assertEqual(prefix_cache.num_hits, 2)
+        self.assertEqual(prefix_cache.num_saved_tokens, 32)
+
+        prefix_cache.reset_stats()
+        self.assertEqual(prefix_cache.get_stats()["num_requests"], 0)
+        self.assertEqual(prefix_cache.get_stats()["num_entries"], 1)
+
+    def test_lru_eviction(self):
+        # room for two snapshots of 16 tokens
+        prefix_cache = PrefixCache(max_cache_bytes=32 * TOKEN_BYTES, min_prefix_len=1)
+        a, b, c = [list(range(start, start + 16)) for start in [0, 100, 200]]
+        prefix_cache.store(a, make_cache(a))
+        prefix_cache.store(b, make_cache(b))
+        # a hit makes `a` the most recently used
+        self.assertEqual(prefix_cache.restore(a)[0], 16)
+        prefix_cache.store(c, make_cache(c))
+
+        self.assertEqual(len(prefix_cache), 2)
+        self.assertEqual(prefix_cache.match(a)[0], 16)
+        self.assertEqual(prefix_cache.match(b), (0, None))
+        self.assertEqual(prefix_cache.match(c)[0], 16)
+        # the evicted leaf is pruned from the tree
+        self.assertNotIn(100, prefix_cache.root.children)
+
+    def test_byte_accounting(self):
+        prefix_cache = PrefixCache(max_cache_bytes=64 * TOKEN_BYTES, min_prefix_len=1)
+        a = list(range(16))
+        b = list(range(8)) + list(range(100, 108))
+        prefix_cache.store(a, make_cache(a))
+        prefix_cache.store(b, make_cache(b))
+        self.assertEqual(prefix_cache.cache_bytes, 32 * TOKEN_BYTES)
+        self.assertEqual(prefix_cache.cache_bytes,
+                         sum(kv_cache_nbytes(node.cache) for node in prefix_cache.lru))
+
+        # storing the same prompt again replaces its snapshot
+        prefix_cache.store(a, make_cache(a))
+        self.assertEqual(len(prefix_cache), 2)
+        self.assertEqual(prefix_cache.cache_bytes, 32 * TOKEN_BYTES)
+
+        # a snapshot larger than the budget is not stored
+        too_long = list(range(1000, 1065))
+        prefix_cache.store(too_long, make_cache(too_long))
+        self.assertEqual(prefix_cache.match(too_long), (0, None))
+        self.assertEqual(prefix_cache.cache_bytes, 32 * TOKEN_BYTES)
+
+        prefix_cache.clear()
+        self.assertEqual(len(prefix_cache), 0)
+        self.assertEqual(prefix_cache.cache_bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+import torch
+from fastapi import HTTPException
+from ipex_llm.serving.fastapi import api_server
+from ipex_llm.serving.fastapi.scheduler import RequestQueue
+
+
+def get(queue):
+    return asyncio.run(asyncio.wait_for(queue.get(), 1))
+
+
+class TestRequestQueue(unittest.TestCase):
+
+    def test_priority_order(self):
+        queue = RequestQueue()
+        for request_id, priority in enumerate(["batch", "interactive", "batch", "interactive"]):
+            self.assertIsNone(queue.admit(request_id, request_id, priority))
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual([get(queue) for _ in range(4)], [1, 3, 0, 2])
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.start_next())
+
+    def test_reject_when_full(self):
+        queue = RequestQueue(max_queue_size=2)
+        self.assertIsNone(queue.admit("a", "a"))
+        self.assertIsNone(queue.admit("b", "b"))
+        self.assertIsNotNone(queue.admit("c", "c"))
+        self.assertEqual(queue.get_stats()["num_rejected"], 1)
+        self.assertEqual(get(queue), "a")
+        self.assertIsNone(queue.admit("c", "c"))
+        self.assertEqual(queue.get_stats()["num_admitted"], 3)
+
+    def test_reject_after_deadline(self):
+        queue = RequestQueue()
+        # no throughput is learned yet, so any timeout is accepted
+        self.assertIsNone(queue.admit("a", "a", cost=1000, timeout=1))
+        queue.remove("a")
+        # finished 100 cost per second
+        queue.finished_cost, queue.busy_time = 100.0, 1.0
+        self.assertIsNotNone(queue.admit("b", "b", cost=1000, timeout=5))
+        self.assertIsNone(queue.admit("c", "c", "batch", cost=100, timeout=5))
+        # "batch" requests wait behind "c", "interactive" ones do not
+        self.assertIsNotNone(queue.admit("d", "d", "batch", cost=450, timeout=5))
+        self.assertIsNone(queue.admit("e", "e", "interactive", cost=450, timeout=5))
+
+    def test_admit_request_429(self):
+        api_server.tokenizer = lambda text, return_tensors: SimpleNamespace(
+            input_ids=torch.zeros(1, len(text.split()), dtype=torch.long))
+        queue = RequestQueue(max_queue_size=1)
+        request = api_server.InputsRequest(inputs="a b c", priority="batch")
+        asyncio.run(api_server.admit_request(queue, "a", request))
+        with self.assertRaises(HTTPException) as context:
+            asyncio.run(api_server.admit_request(queue, "b", request))
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertIn("Retry-After", context.exception.headers)
+        self.assertEqual(queue.qsize(), 1)
+        # the prompt inputs are queued for the worker, with the cost estimated from them
+        self.assertEqual(queue.waiting["a"].cost, 3 * api_server.Parameters().max_new_tokens)
+        request_id, inputs_request, prompt_inputs = get(queue)
+        self.assertEqual((request_id, inputs_request), ("a", request))
+        self.assertEqual(prompt_inputs.input_ids.shape, (1, 3))
+
+    def test_shed(self):
+        queue = RequestQueue()
+        queue.finished_cost, queue.busy_time = 100.0, 1.0
+        self.assertIsNone(queue.admit("a", "a", cost=10, timeout=0.2))
+        self.assertIsNone(queue.admit("b", "b", cost=10))
+
+        async def wait():
+            # no worker starts "a", so it is shed once it can not finish in its timeout
+            return await api_server.wait_streamer(queue, "a",
+                                                  asyncio.get_running_loop().create_future())
+        with self.assertRaises(HTTPException) as context:
+            asyncio.run(wait())
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertEqual(queue.get_stats()["num_shed"], 1)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(get(queue), "b")
+
+    def test_finish_releases_slot(self):
+        queue = RequestQueue(max_running=1)
+        released = []
+        queue.on_release = lambda: released.append(True)
+        queue.admit("a", "a")
+        queue.admit("b", "b")
+        self.assertEqual(get(queue), "a")
+        # "b" waits until "a" finishes
+        self.assertTrue(queue.empty())
+        queue.finish("a")
+        self.assertEqual(released, [True])
+        self.assertFalse(queue.empty())
+        self.assertEqual(get(queue), "b")
+        queue.finish("b")
+        # finishing an unknown or already finished request is a no-op
+        queue.finish("b")
+        self.assertEqual(len(released), 2)
+        self.assertEqual(queue.get_stats()["num_finished"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
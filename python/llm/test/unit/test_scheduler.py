@@ -0,0 +1,120 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.cache_utils import DynamicCache
+from ipex_llm.serving.fastapi.scheduler import ContinuousBatchingScheduler
+from ipex_llm.serving.fastapi.tgi_protocol import Parameters
+
+
+class RecordingStreamer:
+    def __init__(self):
+        self.token_ids = []
+        self.ended = False
+
+    def put(self, value):
+        self.token_ids.append(value.tolist())
+
+    def end(self):
+        self.ended = True
+
+
+class TruncatingModel(torch.nn.Module):
+    """Drops the kv of the first prompt token, like a compressed kv cache."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def forward(self, **kwargs):
+        output = self.model(**kwargs)
+        cache = output.past_key_values
+        if not isinstance(cache, DynamicCache):
+            cache = DynamicCache.from_legacy_cache(cache)
+            output.past_key_values = cache
+        for caches in [cache.key_cache, cache.value_cache]:
+            for layer_idx in range(len(caches)):
+                caches[layer_idx] = caches[layer_idx][:, :, 1:, :]
+        return output
+
+
+class TestContinuousBatchingScheduler(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=128, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4)
+        cls.model = LlamaForCausalLM(config).eval()
+
+    def add_request(self, scheduler, request_id, prompt_len, max_new_tokens):
+        input_ids = torch.randint(0, 128, (1, prompt_len))
+        streamer = RecordingStreamer()
+        scheduler.add_request(request_id, input_ids,
+                              Parameters(max_new_tokens=max_new_tokens), streamer, None)
+        return input_ids, streamer
+
+    def run_steps(self, scheduler):
+        while len(scheduler.running) > 0 or not scheduler.pending.empty():
+            scheduler.step()
+
+    def test_matches_greedy_generate(self):
+        scheduler = ContinuousBatchingScheduler(self.model, max_num_seqs=2)
+        requests = [self.add_request(scheduler, i, prompt_len, max_new_tokens)
+                    for i, (prompt_len, max_new_tokens) in enumerate([(5, 6), (9, 3), (3, 4)])]
+        self.run_steps(scheduler)
+
+        for input_ids, streamer in requests:
+            self.assertTrue(streamer.ended)
+            max_new_tokens = len(streamer.token_ids) - 1
+            expected = self.model.generate(input_ids, max_new_tokens=max_new_tokens,
+                                           min_new_tokens=max_new_tokens, do_sample=False)
+            output_ids = [token_ids[0] for token_ids in streamer.token_ids[1:]]
+            self.assertEqual(output_ids, expected[0, input_ids.size(1):].tolist())
+
+    def test_reject_incomplete_kv_cache(self):
+        scheduler = ContinuousBatchingScheduler(TruncatingModel(self.model))
+        _, streamer = self.add_request(scheduler, 0, 5, 4)
+        with self.assertRaisesRegex(Exception, "not supported by continuous batching"):
+            scheduler.step()
+        self.assertTrue(streamer.ended)
+        self.assertEqual(scheduler.running, [])
+
+    def test_fail_requests(self):
+        scheduler = ContinuousBatchingScheduler(self.model, max_num_seqs=1)
+        streamers = [self.add_request(scheduler, i, 4, 8)[1] for i in range(2)]
+        scheduler.step()
+        self.assertEqual(len(scheduler.running), 1)
+        self.assertEqual(len(scheduler.waiting), 1)
+        streamers.append(self.add_request(scheduler, 2, 4, 8)[1])
+
+        scheduler.fail_requests()
+        self.assertTrue(all(streamer.ended for streamer in streamers))
+        self.assertEqual(scheduler.running, [])
+        self.assertEqual(len(scheduler.waiting), 0)
+        self.assertTrue(scheduler.pending.empty())
+        self.assertIsNone(scheduler.past_key_values)
+
+
+if __name__ == '__main__':
+    unittest.main()